@@ -0,0 +1,720 @@
+"""
+BOSH benchmarks
+---------------
+
+In-process stand-in for a BOSH connection manager and XMPP server
+(FakeBOSHServer), and a benchmark suite measuring the BOSHClient on top of
+it, with no network and no real server:
+
+    python boshbench.py [--latency=SECONDS] [--logins=N] [concurrency levels...]
+    python boshbench.py test
+"""
+
+import BaseHTTPServer, SocketServer, gc, hashlib, hmac, optparse, os, resource, shutil, socket, sys, tempfile, threading, time, types
+from base64 import b64decode, b64encode
+from xml.etree import cElementTree as ElementTree
+
+import boshclient
+from boshclient import (NS_HTTPBIND, NS_SASL, NS_BIND, NS_REGISTER, NS_COMMANDS, NS_DATA, NS_STANZAS,
+                        NS_ADMIN, NS_DISCO_INFO, NS_DISCO_ITEMS, NS_PING, parse_sasl_params, xml_escape)
+
+
+NS_SESSION = 'urn:ietf:params:xml:ns:xmpp-session'
+
+
+def tag(ns, name):
+    """ElementTree name of an element"""
+    return '{%s}%s' % (ns, name)
+
+
+class FakeSession:
+    """State of a session of the FakeBOSHServer"""
+    
+    def __init__(self, sid, rid, wait):
+        self.sid = sid
+        self.rid = rid
+        self.wait = wait
+        self.user = None
+        self.authenticated = False
+        self.sasl = None
+        self.command_sessions = {}
+        self.lock = threading.Lock()
+        # Notified when a request arrives, to answer the held one
+        self.arrived = threading.Condition(self.lock)
+        # When the last request arrived or response was sent
+        self.last = time.time()
+
+
+class FakeBOSHServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server speaking enough BOSH and XMPP for the BOSHClient:
+    session creation, SASL (DIGEST-MD5, PLAIN, SCRAM-SHA-1), stream restart,
+    bind, session, ping, in-band registration, disco#info, disco#items and the
+    add-user and get-registered-users-num ad-hoc commands. Every request is
+    delayed by latency seconds. An empty request of an authenticated
+    session is held until the next request or for the wait of the session. With compression, it accepts gzip and deflate
+    request bodies and compresses the responses of at least compress_min
+    bytes.
+    
+    >>> server = FakeBOSHServer(users={'essai': 'essai'}).start()
+    >>> client = boshclient.BOSHClient(server.url, 'essai@localhost', 'essai', debug=False)
+    >>> client.prebind()[0]
+    u'essai@localhost/web'
+    >>> server.stop()
+    """
+    
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+    # Accept an ad-hoc command submitting its form in the execute request
+    one_shot_commands = True
+    # Session attributes, in seconds: the sessions idle (no request held)
+    # for longer than inactivity are terminated. The client may ask for a
+    # shorter wait.
+    wait = 60
+    polling = 5
+    inactivity = 60
+    # Requests a client may have outstanding (the 'requests' of the session)
+    window = 2
+    # The next drop requests get their connection closed, unanswered
+    drop = 0
+    
+    def __init__(self, users=None, host='localhost', latency=0, mechanisms=('DIGEST-MD5', 'PLAIN', 'SCRAM-SHA-1'), address=('127.0.0.1', 0),
+                 compression=True, compress_min=1024):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeBOSHHandler)
+        self.users = dict(users or {})
+        self.admins = set()
+        self.host = host
+        self.latency = latency
+        self.mechanisms = mechanisms
+        self.compression = compression
+        self.compress_min = compress_min
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.stopping = False
+        # The sockets of the clients connected
+        self.connections = set()
+        self.url = 'http://%s:%s/http-bind/' % self.server_address
+    
+    def start(self):
+        """Serve in a background thread. Returns the server."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+    
+    def stop(self):
+        self.stopping = True
+        self.shutdown()
+        self.server_close()
+        # Answer the held requests
+        for session in self.sessions.values():
+            with session.lock:
+                session.arrived.notify_all()
+        # The handlers waiting for another request on a keep-alive
+        # connection end
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+    
+    def get_request(self):
+        request = BaseHTTPServer.HTTPServer.get_request(self)
+        with self.lock:
+            self.connections.add(request[0])
+        return request
+    
+    def shutdown_request(self, request):
+        with self.lock:
+            self.connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+    
+    def take_drop(self):
+        """Should the request be dropped? (see drop)"""
+        self.lock.acquire()
+        try:
+            if self.drop > 0:
+                self.drop -= 1
+                return True
+            return False
+        finally:
+            self.lock.release()
+    
+    def handle_body(self, body):
+        """Process a <body/> and return the response (a string)"""
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            session = self.sessions.get(body.get('sid'))
+        finally:
+            self.lock.release()
+        if self.latency:
+            time.sleep(self.latency)
+        if body.get('sid') is None:
+            return self.create_session(body)
+        if session is None:
+            return "<body xmlns='%s' type='terminate' condition='item-not-found'/>" % NS_HTTPBIND
+        session.lock.acquire()
+        try:
+            # The RID must be in the window of the last one (a repeated
+            # request is simply processed again)
+            rid = int(body.get('rid', 0))
+            expired = self.inactivity and time.time() - session.last > self.inactivity
+            if expired or not session.rid - self.window < rid <= session.rid + self.window:
+                self.lock.acquire()
+                try:
+                    self.sessions.pop(session.sid, None)
+                finally:
+                    self.lock.release()
+                return "<body xmlns='%s' type='terminate' condition='item-not-found'/>" % NS_HTTPBIND
+            session.rid = max(session.rid, rid)
+            session.last = time.time()
+            session.arrived.notify_all()
+            replies = []
+            for stanza in body:
+                replies.extend(self.handle_stanza(session, stanza))
+            restart = body.get('{urn:xmpp:xbosh}restart') == 'true'
+            if not len(body) and session.authenticated and body.get('type') is None and not restart:
+                self.hold(session, rid)
+            if restart:
+                replies.append("<stream:features xmlns:stream='http://etherx.jabber.org/streams'><bind xmlns='%s'/><session xmlns='%s'/></stream:features>" % (NS_BIND, NS_SESSION))
+            if body.get('type') == 'terminate':
+                self.lock.acquire()
+                try:
+                    self.sessions.pop(session.sid, None)
+                finally:
+                    self.lock.release()
+                return "<body xmlns='%s' type='terminate'/>" % NS_HTTPBIND
+        finally:
+            session.last = time.time()
+            session.lock.release()
+        return "<body xmlns='%s'>%s</body>" % (NS_HTTPBIND, ''.join(replies))
+    
+    def hold(self, session, rid):
+        """Called with the lock of session: wait for a newer request (or the wait)"""
+        deadline = time.time() + session.wait
+        while session.rid == rid and not self.stopping and time.time() < deadline:
+            session.arrived.wait(min(deadline - time.time(), 0.5))
+    
+    def create_session(self, body):
+        sid = b64encode(os.urandom(12)).replace('/', '_')
+        session = FakeSession(sid, int(body.get('rid')), min(int(body.get('wait', self.wait)), self.wait))
+        self.lock.acquire()
+        try:
+            self.sessions[sid] = session
+        finally:
+            self.lock.release()
+        mechanisms = ''.join(['<mechanism>%s</mechanism>' % m for m in self.mechanisms])
+        accept = self.compression and " accept='deflate,gzip'" or ''
+        return ("<body xmlns='%s' sid='%s' wait='%s' requests='2' hold='1' polling='%s' inactivity='%s' authid='%s'%s "
+                "xmpp:version='1.0' xmlns:xmpp='urn:xmpp:xbosh'><stream:features xmlns:stream='http://etherx.jabber.org/streams'>"
+                "<mechanisms xmlns='%s'>%s</mechanisms></stream:features></body>"
+                % (NS_HTTPBIND, sid, session.wait, self.polling, self.inactivity, sid, accept, NS_SASL, mechanisms))
+    
+    def handle_stanza(self, session, stanza):
+        """Process a stanza and return the list of replies"""
+        if stanza.tag.startswith('{%s}' % NS_SASL):
+            return self.handle_sasl(session, stanza)
+        if stanza.tag.endswith('}iq') or stanza.tag == 'iq':
+            return self.handle_iq(session, stanza)
+        return []
+    
+    # SASL
+    
+    def handle_sasl(self, session, stanza):
+        name = stanza.tag.split('}')[1]
+        data = b64decode(stanza.text or '')
+        if name == 'auth':
+            session.sasl = {'mechanism': stanza.get('mechanism')}
+        mechanism = session.sasl and session.sasl['mechanism']
+        method = getattr(self, 'sasl_' + (mechanism or '').replace('-', '_').lower(), None)
+        if method is None:
+            return [self.sasl_failure('invalid-mechanism')]
+        return [method(session, name, data)]
+    
+    def sasl_failure(self, condition='not-authorized'):
+        return "<failure xmlns='%s'><%s/></failure>" % (NS_SASL, condition)
+    
+    def sasl_success(self, session, user, data=''):
+        session.user = user
+        session.authenticated = True
+        return "<success xmlns='%s'>%s</success>" % (NS_SASL, b64encode(data))
+    
+    def sasl_challenge(self, data):
+        return "<challenge xmlns='%s'>%s</challenge>" % (NS_SASL, b64encode(data))
+    
+    def sasl_plain(self, session, name, data):
+        try:
+            authzid, user, password = data.split('\0')
+        except ValueError:
+            return self.sasl_failure('malformed-request')
+        if self.users.get(user) != password:
+            return self.sasl_failure()
+        return self.sasl_success(session, user)
+    
+    def sasl_digest_md5(self, session, name, data):
+        state = session.sasl
+        if name == 'auth':
+            state['nonce'] = b64encode(os.urandom(12))
+            return self.sasl_challenge('realm="%s",nonce="%s",qop="auth",charset=utf-8,algorithm=md5-sess' % (self.host, state['nonce']))
+        if 'rspauth' in state:
+            return self.sasl_success(session, state['user'])
+        params = parse_sasl_params(data)
+        user = params.get('username')
+        if user not in self.users or params.get('nonce') != state['nonce']:
+            return self.sasl_failure()
+        # Compute the expected response with the client implementation
+        mechanism = boshclient.DigestMD5Mechanism(user, self.users[user], self.host, cnonce=params.get('cnonce'))
+        expected = parse_sasl_params(mechanism.respond(self.sasl_challenge_params(state)))
+        if expected['response'] != params.get('response'):
+            return self.sasl_failure()
+        state['user'] = user
+        state['rspauth'] = mechanism.rspauth
+        return self.sasl_challenge('rspauth=%s' % mechanism.rspauth)
+    
+    def sasl_challenge_params(self, state):
+        return 'realm="%s",nonce="%s",qop="auth"' % (self.host, state['nonce'])
+    
+    def sasl_scram_sha_1(self, session, name, data):
+        state = session.sasl
+        if name == 'auth':
+            params = dict([item.split('=', 1) for item in data.split(',')[2:]])
+            user = params.get('n')
+            if user not in self.users:
+                return self.sasl_failure()
+            state['user'] = user
+            state['client_first_bare'] = data.split(',', 2)[2]
+            state['nonce'] = params['r'] + b64encode(os.urandom(12))
+            state['salt'] = hashlib.sha1(user).digest()[:12]
+            state['server_first'] = 'r=%s,s=%s,i=4096' % (state['nonce'], b64encode(state['salt']))
+            return self.sasl_challenge(state['server_first'])
+        client_final, proof = data.rsplit(',p=', 1)
+        salted = boshclient.scram_salted_password('sha1', self.users[state['user']], state['salt'], 4096)
+        client_key = hmac.new(salted, 'Client Key', hashlib.sha1).digest()
+        auth_message = '%s,%s,%s' % (state['client_first_bare'], state['server_first'], client_final)
+        signature = hmac.new(hashlib.sha1(client_key).digest(), auth_message, hashlib.sha1).digest()
+        expected = ''.join([chr(ord(a) ^ ord(b)) for a, b in zip(client_key, signature)])
+        if b64decode(proof) != expected:
+            return self.sasl_failure()
+        server_key = hmac.new(salted, 'Server Key', hashlib.sha1).digest()
+        return self.sasl_success(session, state['user'], 'v=' + b64encode(hmac.new(server_key, auth_message, hashlib.sha1).digest()))
+    
+    # IQ
+    
+    def handle_iq(self, session, iq):
+        id = iq.get('id', '')
+        child = len(iq) and iq[0]
+        if child is None or not len(iq):
+            return [self.iq_error(id, 'bad-request')]
+        if child.tag == tag(NS_BIND, 'bind'):
+            resource = child.findtext(tag(NS_BIND, 'resource')) or 'fake'
+            return ["<iq type='result' id='%s'><bind xmlns='%s'><jid>%s@%s/%s</jid></bind></iq>" % (id, NS_BIND, session.user, self.host, xml_escape(resource))]
+        if child.tag in (tag(NS_SESSION, 'session'), tag(NS_PING, 'ping')):
+            return ["<iq type='result' id='%s'/>" % id]
+        if child.tag == tag(NS_REGISTER, 'query'):
+            return [self.handle_register(iq, child)]
+        if child.tag == tag(NS_DISCO_INFO, 'query'):
+            return ["<iq type='result' id='%s' from='%s'><query xmlns='%s'%s><identity category='server' type='im' name='Fake'/>"
+                    "<feature var='%s'/><feature var='%s'/></query></iq>"
+                    % (id, self.host, NS_DISCO_INFO, child.get('node') and " node='%s'" % child.get('node') or '', NS_DISCO_INFO, NS_COMMANDS)]
+        if child.tag == tag(NS_DISCO_ITEMS, 'query'):
+            items = ''
+            if child.get('node') == NS_COMMANDS:
+                items = ''.join(["<item jid='%s' node='%s#%s' name='%s'/>" % (self.host, NS_ADMIN, command, command)
+                                 for command in ('add-user', 'get-registered-users-num')])
+            return ["<iq type='result' id='%s' from='%s'><query xmlns='%s'%s>%s</query></iq>"
+                    % (id, self.host, NS_DISCO_ITEMS, child.get('node') and " node='%s'" % child.get('node') or '', items)]
+        if child.tag == tag(NS_COMMANDS, 'command'):
+            return [self.handle_command(session, iq, child)]
+        return [self.iq_error(id, 'service-unavailable')]
+    
+    def iq_error(self, id, condition, type='cancel'):
+        return "<iq type='error' id='%s'><error type='%s'><%s xmlns='%s'/></error></iq>" % (id, type, condition, NS_STANZAS)
+    
+    def add_account(self, user, password):
+        """Create an account, returns False if it exists"""
+        self.lock.acquire()
+        try:
+            if user in self.users:
+                return False
+            self.users[user] = password
+            return True
+        finally:
+            self.lock.release()
+    
+    def handle_register(self, iq, query):
+        id = iq.get('id')
+        if iq.get('type') == 'get':
+            return ("<iq type='result' id='%s'><query xmlns='%s'><instructions>Choose a username and password</instructions>"
+                    "<username/><password/></query></iq>" % (id, NS_REGISTER))
+        user = query.findtext(tag(NS_REGISTER, 'username'))
+        password = query.findtext(tag(NS_REGISTER, 'password'))
+        if not user or not password:
+            return self.iq_error(id, 'not-acceptable', 'modify')
+        if not self.add_account(user, password):
+            return self.iq_error(id, 'conflict')
+        return "<iq type='result' id='%s'/>" % id
+    
+    def handle_command(self, session, iq, command):
+        id = iq.get('id')
+        node = command.get('node')
+        if not session.authenticated:
+            return self.iq_error(id, 'forbidden', 'auth')
+        if self.admins and session.user not in self.admins:
+            return self.iq_error(id, 'forbidden', 'auth')
+        if node == NS_ADMIN + '#get-registered-users-num':
+            return ("<iq type='result' id='%s'><command xmlns='%s' node='%s' status='completed'><x xmlns='%s' type='result'>"
+                    "<field type='hidden' var='FORM_TYPE'><value>%s</value></field><field var='registeredusersnum' label='Number of registered users'>"
+                    "<value>%d</value></field></x></command></iq>" % (id, NS_COMMANDS, node, NS_DATA, NS_ADMIN, len(self.users)))
+        if node == NS_ADMIN + '#add-user':
+            form = command.find(tag(NS_DATA, 'x'))
+            if form is None:
+                sessionid = b64encode(os.urandom(6))
+                session.command_sessions[sessionid] = node
+                return ("<iq type='result' id='%s'><command xmlns='%s' node='%s' sessionid='%s' status='executing'><actions execute='complete'><complete/></actions>"
+                        "<x xmlns='%s' type='form'><title>Adding a User</title><field type='hidden' var='FORM_TYPE'><value>%s</value></field>"
+                        "<field label='The Jabber ID for the account to be added' type='jid-single' var='accountjid'><required/></field>"
+                        "<field label='The password for this account' type='text-private' var='password'/>"
+                        "<field label='Retype password' type='text-private' var='password-verify'/></x></command></iq>"
+                        % (id, NS_COMMANDS, node, sessionid, NS_DATA, NS_ADMIN))
+            sessionid = command.get('sessionid')
+            if sessionid is None and not self.one_shot_commands or sessionid is not None and session.command_sessions.pop(sessionid, None) != node:
+                return self.iq_error(id, 'bad-request', 'modify')
+            values = {}
+            for field in form.findall(tag(NS_DATA, 'field')):
+                values[field.get('var')] = field.findtext(tag(NS_DATA, 'value'))
+            if values.get('password') != values.get('password-verify') or not values.get('accountjid'):
+                return self.iq_error(id, 'bad-request', 'modify')
+            if not self.add_account(values['accountjid'].split('@')[0], values['password']):
+                return self.iq_error(id, 'conflict')
+            return "<iq type='result' id='%s'><command xmlns='%s' node='%s' sessionid='%s' status='completed'/></iq>" % (id, NS_COMMANDS, node, sessionid or b64encode(os.urandom(6)))
+        return self.iq_error(id, 'item-not-found')
+
+
+class FakeBOSHHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """HTTP side of the FakeBOSHServer"""
+    
+    protocol_version = 'HTTP/1.1'
+    # Headers are written one by one, don't let Nagle delay the body
+    disable_nagle_algorithm = True
+    
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get('content-length', 0)))
+        if self.server.take_drop():
+            self.close_connection = 1
+            return
+        encoding = self.headers.get('content-encoding')
+        try:
+            if encoding:
+                if not self.server.compression:
+                    raise SyntaxError(encoding)
+                data = boshclient.ContentDecoder(encoding).decode(data)
+            response = self.server.handle_body(ElementTree.fromstring(data))
+            status = 200
+        except (SyntaxError, boshclient.ConnectionError):
+            response = ''
+            status = 400
+        encoding = None
+        if self.server.compression and len(response) >= self.server.compress_min:
+            accepted = [e.strip() for e in self.headers.get('accept-encoding', '').split(',')]
+            for encoding in ('gzip', 'deflate', None):
+                if encoding in accepted:
+                    response = boshclient.compress_body(response, encoding)
+                    break
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+    
+    def log_message(self, format, *args):
+        pass
+
+
+# Benchmarks
+
+BENCH_USER = 'bench'
+BENCH_PASSWORD = 'bench'
+
+
+def login(client_class, url, instrumentation=None):
+    """
+    One full login on the given service: session, SASL, bind, then
+    logout. The AdminBOSHClient also runs an ad-hoc command. Returns
+    True on success.
+    """
+    client = client_class(url, '%s@localhost' % BENCH_USER, BENCH_PASSWORD, debug=False, instrumentation=instrumentation)
+    try:
+        client.init_connection()
+        client.request_bosh_session()
+        if not client.authenticate_xmpp():
+            return False
+        if isinstance(client, boshclient.AdminBOSHClient):
+            client.get_registred_users()
+        client.disconnect()
+        return True
+    finally:
+        client.close_connection()
+
+
+def benchmark_logins(client_class, url, concurrency, logins):
+    """
+    Run logins logins with concurrency threads, returns a dict of results
+    (logins per second, p50 and p99 login time, failures and the metrics
+    of the clients).
+    
+    >>> server = FakeBOSHServer(users={BENCH_USER: BENCH_PASSWORD}).start()
+    >>> result = benchmark_logins(boshclient.BOSHClient, server.url, 2, 4)
+    >>> result['logins'], result['failures']
+    (4, 0)
+    >>> server.stop()
+    """
+    metrics = boshclient.Metrics()
+    durations = boshclient.Histogram()
+    counts = {'failures': 0}
+    lock = threading.Lock()
+    
+    def work(count):
+        for i in xrange(count):
+            started = time.time()
+            try:
+                success = login(client_class, url, metrics)
+            except Exception:
+                success = False
+            lock.acquire()
+            try:
+                durations.add(time.time() - started)
+                if not success:
+                    counts['failures'] += 1
+            finally:
+                lock.release()
+    
+    threads = [threading.Thread(target=work, args=(logins // concurrency + (i < logins % concurrency),))
+               for i in xrange(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    return {
+        'logins': durations.count,
+        'failures': counts['failures'],
+        'logins_per_sec': durations.count / elapsed,
+        'p50': durations.percentile(50),
+        'p99': durations.percentile(99),
+        'metrics': metrics.snapshot(),
+    }
+
+
+def rss():
+    """Resident memory of the process, in bytes"""
+    try:
+        statm = open('/proc/self/statm').read().split()
+        return int(statm[1]) * resource.getpagesize()
+    except (IOError, IndexError):
+        # Peak usage only, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def benchmark_memory(client_class, url, sessions):
+    """
+    Memory per authenticated session: opens sessions clients and keeps
+    them connected while measuring. The stand-in server runs in the same
+    process, so its own per-session state is counted too.
+    """
+    clients = []
+    gc.collect()
+    before = rss()
+    try:
+        for i in xrange(sessions):
+            client = client_class(url, '%s@localhost' % BENCH_USER, BENCH_PASSWORD, debug=False)
+            clients.append(client)
+            client.init_connection()
+            client.request_bosh_session()
+            client.authenticate_xmpp()
+        gc.collect()
+        return (rss() - before) / float(sessions)
+    finally:
+        for client in clients:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+            client.close_connection()
+
+
+class InProcessClient(boshclient.BOSHClient):
+    """BOSHClient sending its bodies straight to a FakeBOSHServer, without HTTP"""
+    
+    def __init__(self, server, jid='', password='', resource='web'):
+        boshclient.BOSHClient.__init__(self, server.url, jid, password, resource, debug=False)
+        self.server = server
+    
+    def send_request(self, xml_stanza):
+        self.rid += 1
+        return boshclient.BOSHResponse(self.server.handle_body(ElementTree.fromstring(boshclient.utf8(xml_stanza))))
+
+
+def deep_size(objects, seen=None):
+    """
+    Bytes reachable from objects, not counting classes, functions and modules
+    (nor anything already in seen).
+    
+    >>> s = 'x' * 100
+    >>> deep_size([[s, s]]) == sys.getsizeof([s, s]) + sys.getsizeof(s)
+    True
+    """
+    if seen is None:
+        seen = set()
+    size = 0
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, types.ClassType, types.ModuleType, types.FunctionType)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+
+def benchmark_idle_sessions(count=1000):
+    """
+    Memory of an idle (authenticated, disconnected) session, in bytes:
+    parked as a BOSHClient, or as the SessionState it leaves behind.
+    The logins skip HTTP, so only the client side is measured; objects
+    shared by all sessions (interned JIDs, the server) count once.
+    """
+    server = FakeBOSHServer(users=dict([('user%d' % i, 'password') for i in xrange(count)]))
+    
+    def login(i):
+        client = InProcessClient(server, 'user%d@localhost' % i, 'password')
+        client.request_bosh_session()
+        client.authenticate_xmpp()
+        server.sessions.clear()
+        return client
+    
+    try:
+        clients = [login(i) for i in xrange(count)]
+        shared = set()
+        deep_size([server, boshclient.JID_CACHE, boshclient.SERVICES], shared)
+        return {'BOSHClient': deep_size(clients, set(shared)) / float(count),
+                'SessionState': deep_size([c.session_state() for c in clients], set(shared)) / float(count)}
+    finally:
+        server.server_close()
+
+
+def benchmark_resume(store_class, url, server, sessions=100):
+    """
+    Requests and time per session, over sessions users, to: log in and
+    checkpoint; resume the sessions saved in a store_class (in a new
+    process it would be the same); log in again after the server lost them.
+    """
+    directory = tempfile.mkdtemp(prefix='boshbench')
+    if store_class is boshclient.SQLiteSessionStore:
+        store = store_class(os.path.join(directory, 'sessions.db'))
+    else:
+        store = store_class(directory)
+    results = []
+    try:
+        for phase in ('login', 'resume', 'lost'):
+            if phase == 'lost':
+                server.sessions.clear()
+            requests = server.requests
+            started = time.time()
+            for i in xrange(sessions):
+                client = boshclient.BOSHClient(url, 'user%d@localhost' % i, 'password', debug=False)
+                client.session_store = store
+                client.init_connection()
+                if not client.resume() or client.resumed != (phase == 'resume'):
+                    raise AssertionError('%s of user%d failed' % (phase, i))
+                client.close_connection()
+            results.append((phase, (server.requests - requests) / float(sessions), (time.time() - started) / sessions))
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def benchmark_keepalive(sessions=50, duration=10, inactivity=4, polling=0.5, wait=2):
+    """
+    Keep sessions idle sessions alive with a KeepaliveScheduler for
+    duration seconds, on a server holding the polls for wait seconds and
+    terminating the sessions after inactivity seconds. Returns the
+    requests per session and per minute, and the sessions lost.
+    """
+    server = FakeBOSHServer(users=dict([('user%d' % i, 'password') for i in xrange(sessions)])).start()
+    server.inactivity = inactivity
+    server.polling = polling
+    server.wait = wait
+    # Every session may have a poll held at the same time
+    scheduler = boshclient.KeepaliveScheduler(workers=sessions).start()
+    clients = []
+    try:
+        for i in xrange(sessions):
+            client = boshclient.BOSHClient(server.url, 'user%d@localhost' % i, 'password', debug=False)
+            client.init_connection()
+            client.request_bosh_session()
+            if not client.authenticate_xmpp():
+                raise AssertionError('login of user%d failed' % i)
+            scheduler.add(client)
+            clients.append(client)
+        requests = server.requests
+        time.sleep(duration)
+        stats = scheduler.stats()
+        return {'requests_per_minute': (server.requests - requests) * 60.0 / duration / sessions,
+                'lost': sessions - stats['sessions'],
+                'polls': stats['polls']}
+    finally:
+        scheduler.stop()
+        server.stop()
+        for thread in scheduler.threads:
+            thread.join(1)
+        for client in clients:
+            client.close_connection()
+
+
+def run(levels=(1, 4, 16), logins=200, latency=0, sessions=100, idle=1000, output=sys.stdout):
+    """Run the whole suite and print a report"""
+    server = FakeBOSHServer(users={BENCH_USER: BENCH_PASSWORD}, latency=latency).start()
+    try:
+        output.write('%-16s %11s %10s %9s %9s %9s\n' % ('client', 'concurrency', 'logins/s', 'p50 ms', 'p99 ms', 'failures'))
+        for client_class in (boshclient.BOSHClient, boshclient.AdminBOSHClient):
+            for concurrency in levels:
+                result = benchmark_logins(client_class, server.url, concurrency, logins)
+                output.write('%-16s %11d %10.1f %9.2f %9.2f %9d\n' % (
+                    client_class.__name__, concurrency, result['logins_per_sec'],
+                    result['p50'] * 1000, result['p99'] * 1000, result['failures']))
+        for client_class in (boshclient.BOSHClient, boshclient.AdminBOSHClient):
+            output.write('%s: %.1f KiB per session (%d sessions)\n' % (
+                client_class.__name__, benchmark_memory(client_class, server.url, sessions) / 1024, sessions))
+        server.users.update([('user%d' % i, 'password') for i in xrange(sessions)])
+        for store_class in (boshclient.FileSessionStore, boshclient.SQLiteSessionStore):
+            for phase, requests, duration in benchmark_resume(store_class, server.url, server, sessions):
+                output.write('%s, %s: %.1f requests, %.2f ms per session\n' % (store_class.__name__, phase, requests, duration * 1000))
+    finally:
+        server.stop()
+    for name, size in sorted(benchmark_idle_sessions(idle).items()):
+        output.write('Idle session as %s: %d bytes (%d sessions)\n' % (name, size, idle))
+    result = benchmark_keepalive()
+    output.write('Keepalive: %.1f requests per session per minute (inactivity 4s, wait 2s), %d sessions lost\n' % (result['requests_per_minute'], result['lost']))
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] [concurrency levels...] | test')
+    parser.add_option('--logins', type='int', default=200, help='logins per concurrency level')
+    parser.add_option('--latency', type='float', default=0, help='latency of the server, in seconds')
+    parser.add_option('--sessions', type='int', default=100, help='sessions opened for the memory benchmark')
+    parser.add_option('--idle', type='int', default=1000, help='idle sessions parked for the memory benchmark')
+    options, args = parser.parse_args()
+    if args == ['test']:
+        import doctest
+        doctest.testmod()
+    else:
+        run([int(arg) for arg in args] or (1, 4, 16), options.logins, options.latency, options.sessions, options.idle)
@@ -3,497 +3,5283 @@ BOSH Client
 -----------
 
 Quite simple BOSH client used by Django-XMPPAuth
-For now, it only supports the DIGEST-MD5 text authentication method.
-You must install Twisted. Here is how to with Pip: pip install twisted
+It supports the SCRAM-SHA-256, SCRAM-SHA-1, DIGEST-MD5 and PLAIN SASL
+authentication methods, with no dependency outside the standard library.
+boshbench.py has a local stand-in server to test and benchmark it.
 
-TODO: write the SASL MD5 function: installing twisted (2.5Mb) just for the
-SASL part is too much.
-TODO: write the PLAIN authentication.
 TODO: make shortcuts functions (example: connect + bosh session + auth).
 TODO: make an interactive mode for the client (or just use Python??).
-TODO: add namespaces as global variables
 """
 
-import httplib, sys, random
+import Queue, asyncore, bisect, collections, hashlib, heapq, hmac, httplib, json, logging, math, os, re, socket, sys, random, select, threading, time, types, zlib
 from base64 import b64decode, b64encode
 from urlparse import urlparse
-from xml.dom import minidom
+from xml.parsers import expat
 
-from twisted.words.protocols.jabber.sasl_mechanisms import DigestMD5
 
+logger = logging.getLogger('boshclient')
 
+NS_HTTPBIND = 'http://jabber.org/protocol/httpbind'
+NS_SASL = 'urn:ietf:params:xml:ns:xmpp-sasl'
+NS_BIND = 'urn:ietf:params:xml:ns:xmpp-bind'
+NS_REGISTER = 'jabber:iq:register'
 NS_COMMANDS = 'http://jabber.org/protocol/commands'
+NS_DATA = 'jabber:x:data'
+NS_STANZAS = 'urn:ietf:params:xml:ns:xmpp-stanzas'
+NS_ADMIN = 'http://jabber.org/protocol/admin'
+NS_DISCO_INFO = 'http://jabber.org/protocol/disco#info'
+NS_DISCO_ITEMS = 'http://jabber.org/protocol/disco#items'
+NS_CAPS = 'http://jabber.org/protocol/caps'
+NS_PING = 'urn:xmpp:ping'
+# xml:lang, as named by the parser
+XML_LANG = 'http://www.w3.org/XML/1998/namespace lang'
 
 class ConnectionError(Exception):
     """Error raised when connection with server failed"""
     pass
 
 
+class Return(Exception):
+    """
+    Raised by a flow or a coroutine to return a value (generators can't
+    return a value by themselves).
+    """
+    
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of keep-alive HTTP connections, shared by many BOSHClient
+    instances so they can reuse warm sockets instead of opening a new TCP
+    connection per login.
+    
+    A host never gets more than max_per_host connections (idle + in use), idle
+    connections older than max_idle seconds are closed, and every connection
+    is checked before being handed out again.
+    
+    >>> pool = ConnectionPool(max_per_host=2)
+    >>> conn = pool.acquire('debian')
+    >>> pool.release(conn)
+    >>> pool.acquire('debian') is conn
+    True
+    >>> stats = pool.stats()
+    >>> stats['hits'], stats['misses']
+    (1, 1)
+    """
+    
+    def __init__(self, max_per_host=10, max_idle=30, timeout=None):
+        """
+        max_per_host: maximum number of connections opened to a single host.
+        max_idle: number of seconds an idle connection is kept alive.
+        timeout: how long acquire() waits for a free slot (None: forever).
+        """
+        self.max_per_host = max_per_host
+        self.max_idle = max_idle
+        self.timeout = timeout
+        
+        self.lock = threading.Condition()
+        # netloc -> list of (connection, last used time), most recent last
+        self.idle = {}
+        # netloc -> number of connections opened (idle + in use)
+        self.opened = {}
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'discarded': 0,
+        }
+    
+    def acquire(self, netloc):
+        """
+        Return a connection to netloc, reusing an idle one when possible.
+        Raises ConnectionError if no connection got free before the timeout.
+        """
+        self.lock.acquire()
+        try:
+            deadline = None
+            if self.timeout is not None:
+                deadline = time.time() + self.timeout
+            while True:
+                self._evict_idle()
+                idle = self.idle.get(netloc)
+                while idle:
+                    connection, last_used = idle.pop()
+                    if self._is_healthy(connection):
+                        self.counters['hits'] += 1
+                        return connection
+                    self._drop(connection)
+                    self.counters['discarded'] += 1
+                if self.opened.get(netloc, 0) < self.max_per_host:
+                    self.opened[netloc] = self.opened.get(netloc, 0) + 1
+                    self.counters['misses'] += 1
+                    break
+                if deadline is None:
+                    self.lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ConnectionError('No free connection to %s' % netloc)
+                    self.lock.wait(remaining)
+        finally:
+            self.lock.release()
+        # Connect out of the lock: httplib connects lazily anyway.
+        connection = httplib.HTTPConnection(netloc)
+        connection.pool_netloc = netloc
+        return connection
+    
+    def release(self, connection, reusable=True):
+        """
+        Give a connection back to the pool. Pass reusable=False when the
+        connection is in an unknown state (error in the middle of a request).
+        """
+        self.lock.acquire()
+        try:
+            if reusable and self._is_healthy(connection):
+                self.idle.setdefault(connection.pool_netloc, []).append((connection, time.time()))
+            else:
+                self._drop(connection)
+                self.counters['discarded'] += 1
+            self.lock.notify()
+        finally:
+            self.lock.release()
+    
+    def close(self):
+        """Close all the idle connections"""
+        self.lock.acquire()
+        try:
+            for connections in self.idle.values():
+                for connection, last_used in connections:
+                    self._drop(connection)
+            self.idle = {}
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+    
+    def stats(self):
+        """Return the pool counters, plus the number of idle/opened connections"""
+        self.lock.acquire()
+        try:
+            stats = dict(self.counters)
+            stats['idle'] = sum([len(c) for c in self.idle.values()])
+            stats['opened'] = sum(self.opened.values())
+            return stats
+        finally:
+            self.lock.release()
+    
+    def _evict_idle(self):
+        """Close the connections unused for more than max_idle seconds"""
+        limit = time.time() - self.max_idle
+        for netloc, connections in self.idle.items():
+            fresh = []
+            for connection, last_used in connections:
+                if last_used < limit:
+                    self._drop(connection)
+                    self.counters['evictions'] += 1
+                else:
+                    fresh.append((connection, last_used))
+            self.idle[netloc] = fresh
+    
+    def _drop(self, connection):
+        """Close the connection and free its slot"""
+        connection.close()
+        netloc = connection.pool_netloc
+        self.opened[netloc] = max(self.opened.get(netloc, 1) - 1, 0)
+    
+    def _is_healthy(self, connection):
+        """
+        A connection can be reused if no response is pending on it and the
+        server didn't close the socket (an idle socket must not be readable).
+        """
+        if getattr(connection, '_HTTPConnection__state', httplib._CS_IDLE) != httplib._CS_IDLE:
+            return False
+        if connection.sock is None:
+            # httplib reconnects on the next request
+            return True
+        try:
+            readable = select.select([connection.sock], [], [], 0)[0]
+        except (select.error, ValueError, TypeError):
+            return False
+        return not readable
+
+
+class Endpoint:
+    """
+    A BOSH connection manager known by an EndpointBalancer, with its load
+    (clients connected to it), its smoothed latency and its circuit breaker:
+    after failure_threshold failures in a row the circuit opens and the
+    endpoint gets no session for reset_timeout seconds, then a single
+    session is let through to probe it (half-open). A probe that didn't
+    report within probe_timeout seconds counts as a failure.
+    
+    >>> endpoint = Endpoint('http://cm1/http-bind/', failure_threshold=1, reset_timeout=10, probe_timeout=5)
+    >>> endpoint.record_failure(0)
+    >>> endpoint.available(5), endpoint.available(10)
+    (False, True)
+    >>> endpoint.probe(10)
+    >>> endpoint.available(12), endpoint.available(15), endpoint.state
+    (False, False, 'open')
+    >>> endpoint.available(25)
+    True
+    """
+    
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+    
+    def __init__(self, url, failure_threshold=3, reset_timeout=30, smoothing=0.2, probe_timeout=10):
+        self.url = url
+        self.service = urlparse(url)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_timeout = probe_timeout
+        self.smoothing = smoothing
+        self.clients = 0
+        self.latency = None
+        self.failures = 0
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.probed_at = None
+        self.counters = {
+            'sessions': 0,
+            'requests': 0,
+            'failures': 0,
+            'trips': 0,
+        }
+    
+    def available(self, now):
+        """Can a new session be sent there (the probe of a half-open circuit included)?"""
+        if self.state == self.OPEN:
+            return now - self.opened_at >= self.reset_timeout
+        if self.state == self.HALF_OPEN:
+            if now - self.probed_at >= self.probe_timeout:
+                # The probe never reported: back to open
+                self.state = self.OPEN
+                self.opened_at = now
+                self.counters['trips'] += 1
+            # Already probing
+            return False
+        return True
+    
+    def probe(self, now):
+        """A session is let through an open circuit"""
+        self.state = self.HALF_OPEN
+        self.probed_at = now
+    
+    def record_success(self, latency):
+        self.counters['requests'] += 1
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+        self.failures = 0
+        self.state = self.CLOSED
+    
+    def record_failure(self, now):
+        self.counters['requests'] += 1
+        self.counters['failures'] += 1
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.counters['trips'] += 1
+            self.state = self.OPEN
+            self.opened_at = now
+    
+    def __repr__(self):
+        return '<Endpoint %s %s, %d clients>' % (self.url, self.state, self.clients)
+
+
+class EndpointBalancer:
+    """
+    Thread-safe set of BOSH endpoints, shared by the BalancedBOSHClient
+    instances of a login tier to spread their sessions.
+    
+    Strategies:
+        * 'least-loaded': the endpoint with the fewest clients connected
+          (the fastest one on ties).
+        * 'latency': a random endpoint, weighted by the inverse of its
+          smoothed latency and load. Endpoints never measured are weighted
+          like the fastest one, so they get tried.
+    
+    >>> balancer = EndpointBalancer(['http://cm1/http-bind/', 'http://cm2/http-bind/'])
+    >>> first = balancer.acquire()
+    >>> second = balancer.acquire()
+    >>> first is not second
+    True
+    >>> for i in range(3):
+    ...     balancer.record_failure(first)
+    >>> balancer.acquire(exclude=[second])
+    Traceback (most recent call last):
+    ...
+    ConnectionError: No available BOSH endpoint
+    """
+    
+    STRATEGIES = ('least-loaded', 'latency')
+    
+    def __init__(self, urls, strategy='least-loaded', failure_threshold=3, reset_timeout=30, probe_timeout=10):
+        if strategy not in self.STRATEGIES:
+            raise ValueError('Unknown strategy %r' % strategy)
+        self.endpoints = [Endpoint(url, failure_threshold, reset_timeout, probe_timeout=probe_timeout) for url in urls]
+        self.strategy = strategy
+        self.lock = threading.Lock()
+    
+    def acquire(self, exclude=()):
+        """
+        Pick an endpoint for a new session and count the client on it.
+        Raises ConnectionError if every endpoint is excluded or has its
+        circuit open.
+        """
+        self.lock.acquire()
+        try:
+            now = time.time()
+            candidates = [e for e in self.endpoints if e not in exclude and e.available(now)]
+            if not candidates:
+                raise ConnectionError('No available BOSH endpoint')
+            if self.strategy == 'least-loaded':
+                endpoint = min(candidates, key=lambda e: (e.clients, e.latency))
+            else:
+                endpoint = self._weighted_choice(candidates)
+            if endpoint.state == Endpoint.OPEN:
+                endpoint.probe(now)
+            endpoint.clients += 1
+            endpoint.counters['sessions'] += 1
+            return endpoint
+        finally:
+            self.lock.release()
+    
+    def _weighted_choice(self, candidates):
+        known = [e.latency for e in candidates if e.latency is not None]
+        fastest = known and min(known) or 1.0
+        weights = [1.0 / (max(e.latency or fastest, 1e-6) * (e.clients + 1)) for e in candidates]
+        point = random.uniform(0, sum(weights))
+        for endpoint, weight in zip(candidates, weights):
+            point -= weight
+            if point <= 0:
+                return endpoint
+        return candidates[-1]
+    
+    def attach(self, endpoint):
+        """Count one more client on endpoint"""
+        self.lock.acquire()
+        try:
+            endpoint.clients += 1
+        finally:
+            self.lock.release()
+    
+    def release(self, endpoint):
+        """A client counted on endpoint left it"""
+        self.lock.acquire()
+        try:
+            endpoint.clients = max(endpoint.clients - 1, 0)
+        finally:
+            self.lock.release()
+    
+    def record_success(self, endpoint, latency):
+        self.lock.acquire()
+        try:
+            endpoint.record_success(latency)
+        finally:
+            self.lock.release()
+    
+    def record_failure(self, endpoint):
+        self.lock.acquire()
+        try:
+            endpoint.record_failure(time.time())
+        finally:
+            self.lock.release()
+    
+    def stats(self):
+        """Return the state, load, latency and counters of every endpoint, by URL"""
+        self.lock.acquire()
+        try:
+            stats = {}
+            for endpoint in self.endpoints:
+                stats[endpoint.url] = dict(endpoint.counters, state=endpoint.state,
+                                           clients=endpoint.clients, latency=endpoint.latency)
+            return stats
+        finally:
+            self.lock.release()
+
+
+class Histogram:
+    """
+    Histogram with logarithmic buckets (bounds growing by factor, from
+    start): cheap to update, good enough for percentiles of latencies.
+    
+    >>> histogram = Histogram()
+    >>> for value in (0.001, 0.002, 0.002, 0.5):
+    ...     histogram.add(value)
+    >>> histogram.count, histogram.max
+    (4, 0.5)
+    >>> histogram.percentile(50) <= 0.0025
+    True
+    """
+    
+    def __init__(self, start=0.0001, factor=1.25, size=80):
+        self.bounds = [start * factor ** i for i in xrange(size)]
+        self.buckets = [0] * (size + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+    
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+    
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the given percentile"""
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], self.max)
+                return self.max
+        return self.max
+    
+    def snapshot(self):
+        """Summary of the histogram, as a dict"""
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class Instrumentation:
+    """
+    Instrumentation hooks of the clients. This one does nothing (and costs
+    next to nothing): pass a Metrics, or your own subclass, to the clients to
+    measure them.
+    
+    The phases are: connect, session-request, sasl-step (every SASL round
+    trip), sasl (the whole exchange), restart-bind-session (pipelined as one
+    step) and disconnect.
+    """
+    
+    def phase(self, name):
+        """Context manager timing the phase name"""
+        return NULL_TIMER
+    
+    def record_phase(self, name, duration):
+        """Called with the duration of every phase"""
+        pass
+    
+    def record_request(self, sent, received, latency):
+        """Called for every HTTP request: bytes sent and received, latency"""
+        pass
+    
+    def record_session(self, requests):
+        """Called when a session ends, with the number of RIDs it used"""
+        pass
+
+
+class PhaseTimer:
+    """Context manager timing a phase for an Instrumentation"""
+    
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+    
+    def __enter__(self):
+        self.started = time.time()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.instrumentation.record_phase(self.name, time.time() - self.started)
+
+
+class NullTimer:
+    """Context manager doing nothing"""
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+NULL_INSTRUMENTATION = Instrumentation()
+
+
+class Metrics(Instrumentation):
+    """
+    Instrumentation recording per-phase timers, byte counters, and the
+    latency and RID (requests per session) histograms. It can be shared by
+    many clients (it's thread-safe). Export it with snapshot(), or push the
+    events to your metrics system with add_listener().
+    
+    >>> metrics = Metrics()
+    >>> events = []
+    >>> metrics.add_listener(lambda kind, name, value: events.append((kind, name)))
+    >>> with metrics.phase('connect'):
+    ...     pass
+    >>> metrics.record_request(120, 300, 0.01)
+    >>> snapshot = metrics.snapshot()
+    >>> snapshot['phases']['connect']['count'], snapshot['bytes_sent'], snapshot['bytes_received']
+    (1, 120, 300)
+    >>> events
+    [('phase', 'connect'), ('request', 'latency')]
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = collections.defaultdict(Histogram)
+        self.latency = Histogram()
+        self.rids = Histogram(start=1, factor=1.5, size=30)
+        self.counters = collections.defaultdict(int)
+        self.listeners = []
+    
+    def add_listener(self, listener):
+        """Call listener(kind, name, value) for every measure"""
+        self.listeners.append(listener)
+    
+    def notify(self, kind, name, value):
+        for listener in self.listeners:
+            listener(kind, name, value)
+    
+    def phase(self, name):
+        return PhaseTimer(self, name)
+    
+    def record_phase(self, name, duration):
+        with self.lock:
+            self.phases[name].add(duration)
+        self.notify('phase', name, duration)
+    
+    def record_request(self, sent, received, latency):
+        with self.lock:
+            self.counters['requests'] += 1
+            self.counters['bytes_sent'] += sent
+            self.counters['bytes_received'] += received
+            self.latency.add(latency)
+        self.notify('request', 'latency', latency)
+    
+    def record_session(self, requests):
+        with self.lock:
+            self.counters['sessions'] += 1
+            self.rids.add(requests)
+        self.notify('session', 'rids', requests)
+    
+    def snapshot(self):
+        """All the measures, as a dict"""
+        with self.lock:
+            snapshot = {
+                'phases': dict([(name, histogram.snapshot()) for name, histogram in self.phases.iteritems()]),
+                'latency': self.latency.snapshot(),
+                'rids': self.rids.snapshot(),
+            }
+            for name in ('requests', 'bytes_sent', 'bytes_received', 'sessions'):
+                snapshot[name] = self.counters[name]
+        return snapshot
+
+
+# Content encodings, in order of preference
+CONTENT_ENCODINGS = ('gzip', 'deflate')
+
+
+def compress_body(data, encoding):
+    """
+    Compress a request body with a content encoding (gzip or deflate).
+    
+    >>> ContentDecoder('gzip').decode(compress_body('<body/>', 'gzip'))
+    '<body/>'
+    """
+    if encoding == 'deflate':
+        return zlib.compress(data)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ContentDecoder:
+    """
+    Incremental decoder of the body of a response, according to its
+    Content-Encoding (gzip, deflate or identity). size counts the encoded
+    bytes. Some servers send raw deflate data as 'deflate', it's handled too.
+    
+    >>> data = zlib.compress('<body/>')
+    >>> decoder = ContentDecoder('deflate')
+    >>> decoder.decode(data[:4]) + decoder.decode(data[4:]) + decoder.flush()
+    '<body/>'
+    >>> decoder.size == len(data)
+    True
+    """
+    
+    def __init__(self, encoding=None):
+        self.encoding = (encoding or 'identity').strip().lower()
+        self.size = 0
+        if self.encoding in ('gzip', 'x-gzip'):
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self.decompressor = zlib.decompressobj()
+        elif self.encoding == 'identity':
+            self.decompressor = None
+        else:
+            raise ConnectionError('Unsupported content encoding: %s' % self.encoding)
+    
+    def decode(self, data):
+        if self.decompressor is None:
+            self.size += len(data)
+            return data
+        try:
+            decoded = self.decompressor.decompress(data)
+        except zlib.error, e:
+            if self.encoding != 'deflate' or self.size:
+                raise ConnectionError('Cannot decode the response: %s' % e)
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            decoded = self.decompressor.decompress(data)
+        self.size += len(data)
+        return decoded
+    
+    def flush(self):
+        if self.decompressor is None:
+            return ''
+        return self.decompressor.flush()
+
+
+class Element(object):
+    """
+    Lightweight XML element built by BodyParser: local name, namespace,
+    attributes, children and text. Much cheaper than a minidom node.
+    """
+    
+    __slots__ = ('name', 'ns', 'attrs', 'children', 'text')
+    
+    def __init__(self, name, ns=None, attrs=None):
+        self.name = name
+        self.ns = ns
+        self.attrs = attrs or {}
+        self.children = []
+        self.text = u''
+    
+    def get(self, name, default=''):
+        """Return the value of the attribute name"""
+        return self.attrs.get(name, default)
+    
+    def iter(self):
+        """Iterate over this element and all its descendants, in document order"""
+        stack = [self]
+        while stack:
+            element = stack.pop()
+            yield element
+            stack.extend(reversed(element.children))
+    
+    def find(self, name, ns=None):
+        """
+        Return the first descendant (or self) with the given local name (and
+        namespace, if given), or None.
+        """
+        for element in self.iter():
+            if element.name == name and (ns is None or element.ns == ns):
+                return element
+        return None
+    
+    def findall(self, name, ns=None):
+        """Return all the descendants (or self) matching name and ns"""
+        return [element for element in self.iter()
+                if element.name == name and (ns is None or element.ns == ns)]
+    
+    def __repr__(self):
+        return '<Element %s%s>' % (self.ns and '{%s}' % self.ns or '', self.name)
+
+
+class BodyParser:
+    """
+    Incremental (expat) parser of a BOSH <body/>: feed it the response as it
+    arrives and get a tree of Element back with close(). on_child, if given,
+    is called with every child of the <body/> as soon as it's complete.
+    
+    >>> parser = BodyParser()
+    >>> parser.feed("<body xmlns='http://jabber.org/protocol/httpbind' sid='s1'><success xmlns='urn:ietf:p")
+    >>> parser.feed("arams:xml:ns:xmpp-sasl'>yes</success></body>")
+    >>> body = parser.close()
+    >>> body.get('sid'), body.find('success', NS_SASL).text
+    (u's1', u'yes')
+    """
+    
+    def __init__(self, on_child=None):
+        self.on_child = on_child
+        self.root = None
+        self.stack = []
+        self.parser = expat.ParserCreate(namespace_separator=' ')
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.characters
+        self.parser.buffer_text = True
+    
+    def feed(self, data):
+        """Parse the next piece of the document"""
+        self.parser.Parse(data, False)
+    
+    def close(self):
+        """End of the document. Returns the root Element."""
+        self.parser.Parse('', True)
+        return self.root
+    
+    def start_element(self, name, attrs):
+        ns, sep, local = name.rpartition(' ')
+        element = Element(local, ns or None, attrs)
+        if self.stack:
+            self.stack[-1].children.append(element)
+        else:
+            self.root = element
+        self.stack.append(element)
+    
+    def end_element(self, name):
+        element = self.stack.pop()
+        if len(self.stack) == 1 and self.on_child is not None:
+            self.on_child(element)
+    
+    def characters(self, data):
+        if self.stack:
+            self.stack[-1].text += data
+
+
+def parse_body(data):
+    """Parse a whole document and return its root Element"""
+    parser = BodyParser()
+    parser.feed(data)
+    return parser.close()
+
+
+class BOSHResponse(str):
+    """
+    Data of a BOSH response (a str, as before), carrying its parsed <body/>
+    so the parsing happens only once, whoever needs it.
+    
+    >>> data = BOSHResponse("<body xmlns='http://jabber.org/protocol/httpbind' type='terminate'/>")
+    >>> data.body.get('type')
+    u'terminate'
+    >>> data.body is data.body
+    True
+    """
+    
+    def __new__(cls, data, body=None):
+        response = str.__new__(cls, data)
+        response.parsed = body
+        return response
+    
+    @property
+    def body(self):
+        """The root Element of the response, parsed on first use"""
+        if self.parsed is None:
+            self.parsed = parse_body(str(self))
+        return self.parsed
+
+
+XML_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', "'": '&apos;', '"': '&quot;'}
+XML_ESCAPE_RE = re.compile(r'[&<>\'"]')
+
+def xml_escape(value):
+    """
+    Escape a value for XML text or attribute (quoted with ' or ").
+    
+    >>> xml_escape("Tom & 'Jerry' <3")
+    'Tom &amp; &apos;Jerry&apos; &lt;3'
+    """
+    if not isinstance(value, basestring):
+        value = str(value)
+    if XML_ESCAPE_RE.search(value) is None:
+        return value
+    return XML_ESCAPE_RE.sub(lambda match: XML_ESCAPES[match.group()], value)
+
+
+class StanzaTemplate:
+    """
+    Stanza compiled once, rendered many times in a single pass. %(name)s
+    slots are XML-escaped, %(name)x slots are inserted as is (markup).
+    
+    >>> template = StanzaTemplate("<message to='%(to)s'><body>%(text)s</body>%(extra)x</message>")
+    >>> template.render(to='me@debian', text='1 < 2', extra='<active/>')
+    "<message to='me@debian'><body>1 &lt; 2</body><active/></message>"
+    """
+    
+    SLOT_RE = re.compile(r'%\((\w+)\)([sx])')
+    
+    def __init__(self, template):
+        self.template = template
+        # The template is compiled into a %-format string and the list of
+        # its slots, so rendering is a single formatting operation.
+        self.slots = []
+        parts = []
+        position = 0
+        for match in self.SLOT_RE.finditer(template):
+            parts.append(template[position:match.start()].replace('%', '%%'))
+            parts.append('%s')
+            self.slots.append((match.group(1), match.group(2) == 'x'))
+            position = match.end()
+        parts.append(template[position:].replace('%', '%%'))
+        self.format = ''.join(parts)
+    
+    def render(self, **values):
+        """Return the rendered stanza"""
+        return self.format % tuple([raw and values[name] or xml_escape(values[name])
+                                    for name, raw in self.slots])
+    
+    def write(self, buffer, values):
+        """Append the rendered stanza to buffer (a list of strings)"""
+        buffer.append(self.render(**values))
+
+
+class StanzaBuilder:
+    """
+    Build stanzas into a reusable buffer: the string is joined only once, by
+    getvalue(). Attributes and text are XML-escaped.
+    
+    >>> builder = StanzaBuilder()
+    >>> builder.start('iq', [('type', 'set'), ('id', 'reg2')]).start('query', [('xmlns', NS_REGISTER)])
+    <StanzaBuilder iq/query>
+    >>> builder.element('username', 'me & you').element('password', '').end().end().getvalue()
+    "<iq type='set' id='reg2'><query xmlns='jabber:iq:register'><username>me &amp; you</username><password/></query></iq>"
+    >>> builder.reset().empty('presence', {'type': 'unavailable'}).getvalue()
+    "<presence type='unavailable'/>"
+    """
+    
+    def __init__(self):
+        self.parts = []
+        self.stack = []
+    
+    def reset(self):
+        """Empty the buffer so the builder can be used again"""
+        del self.parts[:]
+        del self.stack[:]
+        return self
+    
+    def open_tag(self, name, attrs):
+        if hasattr(attrs, 'iteritems'):
+            attrs = attrs.iteritems()
+        self.parts.append('<' + name + ''.join([" %s='%s'" % (key, xml_escape(value)) for key, value in attrs]))
+    
+    def start(self, name, attrs=()):
+        """Open the element name"""
+        self.open_tag(name, attrs)
+        self.parts.append('>')
+        self.stack.append(name)
+        return self
+    
+    def end(self):
+        """Close the last opened element"""
+        self.parts.append('</%s>' % self.stack.pop())
+        return self
+    
+    def empty(self, name, attrs=()):
+        """Add an empty element"""
+        self.open_tag(name, attrs)
+        self.parts.append('/>')
+        return self
+    
+    def element(self, name, text='', attrs=()):
+        """Add an element containing only text"""
+        if text == '':
+            return self.empty(name, attrs)
+        self.start(name, attrs)
+        self.parts.append(xml_escape(text))
+        return self.end()
+    
+    def text(self, data):
+        """Add escaped text"""
+        self.parts.append(xml_escape(data))
+        return self
+    
+    def raw(self, xml):
+        """Add markup as is"""
+        self.parts.append(xml)
+        return self
+    
+    def template(self, template, **values):
+        """Render a StanzaTemplate into the buffer"""
+        template.write(self.parts, values)
+        return self
+    
+    def getvalue(self):
+        """Return the stanza built so far"""
+        return ''.join(self.parts)
+    
+    def __repr__(self):
+        return '<StanzaBuilder %s>' % '/'.join(self.stack)
+
+
+BODY = StanzaTemplate("<body rid='%(rid)s' sid='%(sid)s' %(more_body)x xmlns='http://jabber.org/protocol/httpbind'>%(stanza)x</body>")
+EMPTY_BODY = StanzaTemplate("<body rid='%(rid)s' sid='%(sid)s' %(more_body)x xmlns='http://jabber.org/protocol/httpbind' />")
+SESSION_REQUEST = StanzaTemplate("<body rid='%(rid)s' xmlns='http://jabber.org/protocol/httpbind' to='%(to)s' xml:lang='en' wait='%(wait)s' hold='%(hold)s' window='%(window)s' content='text/xml; charset=utf-8' ver='1.6' accept='gzip,deflate' xmpp:version='1.0' xmlns:xmpp='urn:xmpp:xbosh'/>")
+RESTART = StanzaTemplate("to='%(to)s' xml:lang='en' xmpp:restart='true' xmlns:xmpp='urn:xmpp:xbosh'")
+SASL_AUTH = StanzaTemplate("<auth xmlns='urn:ietf:params:xml:ns:xmpp-sasl' mechanism='%(mechanism)s'/>")
+SASL_AUTH_INITIAL = StanzaTemplate("<auth xmlns='urn:ietf:params:xml:ns:xmpp-sasl' mechanism='%(mechanism)s'>%(initial)s</auth>")
+SASL_RESPONSE = StanzaTemplate("<response xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>%(response)s</response>")
+BIND = StanzaTemplate("<iq id='bind_1' type='set' xmlns='jabber:client'><bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'><resource>%(resource)s</resource></bind></iq>")
+IM_SESSION = "<iq type='set' id='bind_2'><session xmlns='urn:ietf:params:xml:ns:xmpp-session'/></iq>"
+REGISTER_FIELDS = "<iq type='get' id='reg1'><query xmlns='jabber:iq:register'/></iq>"
+DISCO_INFO = StanzaTemplate("<iq type='get' from='%(from)s' to='%(to)s' id='%(id)s'><query xmlns='http://jabber.org/protocol/disco#info'/></iq>")
+DISCO_INFO_NODE = StanzaTemplate("<iq type='get' from='%(from)s' to='%(to)s' id='%(id)s'><query xmlns='http://jabber.org/protocol/disco#info' node='%(node)s'/></iq>")
+DISCO_ITEMS = StanzaTemplate("<iq type='get' from='%(from)s' to='%(to)s' id='%(id)s'><query xmlns='http://jabber.org/protocol/disco#items'/></iq>")
+DISCO_ITEMS_NODE = StanzaTemplate("<iq type='get' from='%(from)s' to='%(to)s' id='%(id)s'><query xmlns='http://jabber.org/protocol/disco#items' node='%(node)s'/></iq>")
+PING = StanzaTemplate("<iq type='get' to='%(to)s' id='%(id)s'><ping xmlns='urn:xmpp:ping'/></iq>")
+UNAVAILABLE = "<presence type='unavailable' xmlns='jabber:client'/>"
+
+
+class SASLError(Exception):
+    """Error raised when a SASL exchange goes wrong (bad challenge, bad server signature)"""
+    pass
+
+
+def utf8(value):
+    """Return value as an UTF-8 encoded str"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def parse_sasl_params(data):
+    """
+    Parse a DIGEST-MD5 challenge (key="value",key=value...) into a dict.
+    
+    >>> sorted(parse_sasl_params('realm="debian",nonce="a,b",qop="auth",charset=utf-8').items())
+    [('charset', 'utf-8'), ('nonce', 'a,b'), ('qop', 'auth'), ('realm', 'debian')]
+    """
+    params = {}
+    for key, value in re.findall(r'([\w-]+)=("(?:[^"\\]|\\.)*"|[^,]*)', data):
+        if value.startswith('"'):
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        params[key] = value
+    return params
+
+
+class SASLMechanism:
+    """
+    Client side of a SASL mechanism, without any I/O: authenticate_flow
+    sends the initial response, feeds the challenges to respond() and checks
+    the additional data of the <success/> with verify().
+    """
+    
+    name = None
+    
+    def __init__(self, username, password, host, service='xmpp', cnonce=None):
+        self.username = utf8(username)
+        self.password = utf8(password)
+        self.host = utf8(host)
+        self.service = service
+        self.cnonce = cnonce or b64encode(os.urandom(18))
+    
+    def initial_response(self):
+        """Data sent with the <auth/> element (None: nothing)"""
+        return None
+    
+    def respond(self, challenge):
+        """Return the response to the (decoded) challenge"""
+        raise SASLError('%s does not expect any challenge' % self.name)
+    
+    def verify(self, data):
+        """Check the additional data of the <success/> element"""
+        return True
+
+
+class PlainMechanism(SASLMechanism):
+    """
+    PLAIN (RFC 4616): only use it over TLS.
+    
+    >>> PlainMechanism('me', 'secret', 'debian').initial_response()
+    '\\x00me\\x00secret'
+    """
+    
+    name = 'PLAIN'
+    
+    def initial_response(self):
+        return '\0%s\0%s' % (self.username, self.password)
+
+
+class DigestMD5Mechanism(SASLMechanism):
+    """
+    DIGEST-MD5 (RFC 2831). With the example of the RFC:
+    
+    >>> mechanism = DigestMD5Mechanism('chris', 'secret', 'elwood.innosoft.com', 'imap', cnonce='OA6MHXh6VqTrRk')
+    >>> response = mechanism.respond('realm="elwood.innosoft.com",nonce="OA6MG9tEQGm2hh",qop="auth",algorithm=md5-sess,charset=utf-8')
+    >>> parse_sasl_params(response)['response']
+    'd388dad90d4bbd760a152321f2143af7'
+    >>> mechanism.respond('rspauth=ea40f60335c427b5527b84dbabcdfffd')
+    ''
+    """
+    
+    name = 'DIGEST-MD5'
+    
+    def respond(self, challenge):
+        params = parse_sasl_params(challenge)
+        if 'rspauth' in params:
+            # Second challenge: the server proves it knows the password
+            if params['rspauth'] != self.rspauth:
+                raise SASLError('Bad DIGEST-MD5 server response')
+            return ''
+        if 'nonce' not in params:
+            raise SASLError('Bad DIGEST-MD5 challenge')
+        realm = params.get('realm', self.host)
+        nonce = params['nonce']
+        digest_uri = '%s/%s' % (self.service, self.host)
+        nc = '00000001'
+        qop = 'auth'
+        a1 = '%s:%s:%s' % (hashlib.md5('%s:%s:%s' % (self.username, realm, self.password)).digest(), nonce, self.cnonce)
+        
+        def digest(a2):
+            return hashlib.md5(':'.join([hashlib.md5(a1).hexdigest(), nonce, nc, self.cnonce, qop,
+                                         hashlib.md5(a2).hexdigest()])).hexdigest()
+        
+        self.rspauth = digest(':' + digest_uri)
+        return ('username="%s",realm="%s",nonce="%s",cnonce="%s",nc=%s,qop=%s,digest-uri="%s",response=%s,charset=utf-8'
+                % (self.username, realm, nonce, self.cnonce, nc, qop, digest_uri, digest('AUTHENTICATE:' + digest_uri)))
+    
+    def verify(self, data):
+        # Some servers send the rspauth with the <success/> (RFC 6120)
+        params = parse_sasl_params(data)
+        return 'rspauth' not in params or params['rspauth'] == self.rspauth
+
+
+# (hash name, password digest, salt, iterations) -> salted password
+SCRAM_CACHE = collections.OrderedDict()
+SCRAM_CACHE_SIZE = 10000
+SCRAM_CACHE_LOCK = threading.Lock()
+
+def scram_salted_password(hash_name, password, salt, iterations):
+    """
+    PBKDF2 salted password of SCRAM. The result is cached (LRU), so the
+    following logins of a user skip the expensive derivation.
+    """
+    key = (hash_name, hashlib.sha256(password).digest(), salt, iterations)
+    with SCRAM_CACHE_LOCK:
+        salted = SCRAM_CACHE.pop(key, None)
+        if salted is not None:
+            SCRAM_CACHE[key] = salted
+            return salted
+    salted = hashlib.pbkdf2_hmac(hash_name, password, salt, iterations)
+    with SCRAM_CACHE_LOCK:
+        SCRAM_CACHE[key] = salted
+        while len(SCRAM_CACHE) > SCRAM_CACHE_SIZE:
+            SCRAM_CACHE.popitem(last=False)
+    return salted
+
+
+class ScramMechanism(SASLMechanism):
+    """
+    SCRAM (RFC 5802), without channel binding. With the example of the RFC:
+    
+    >>> mechanism = ScramSHA1Mechanism('user', 'pencil', 'debian', cnonce='fyko+d2lbbFgONRv9qkxdawL')
+    >>> mechanism.initial_response()
+    'n,,n=user,r=fyko+d2lbbFgONRv9qkxdawL'
+    >>> mechanism.respond('r=fyko+d2lbbFgONRv9qkxdawL3rfcNHYJY1ZVvWVs7j,s=QSXCR+Q6sek8bf92,i=4096')
+    'c=biws,r=fyko+d2lbbFgONRv9qkxdawL3rfcNHYJY1ZVvWVs7j,p=v0X8v3Bz2T0CJGbJQyF0X+HI4Ts='
+    >>> mechanism.verify('v=rmF9pqV8S7suAoZWja4dJRkFsKQ=')
+    True
+    
+    Some servers send the server-final message as a last challenge, then
+    an empty <success/>: that one is only accepted once the signature is
+    verified.
+    
+    >>> mechanism.respond('v=rmF9pqV8S7suAoZWja4dJRkFsKQ=')
+    ''
+    >>> mechanism.verify('')
+    True
+    >>> ScramSHA1Mechanism('user', 'pencil', 'debian').verify('')
+    False
+    """
+    
+    hash_name = None
+    server_signature = None
+    # Whether the server signature was checked
+    verified = False
+    
+    def initial_response(self):
+        username = self.username.replace('=', '=3D').replace(',', '=2C')
+        self.client_first_bare = 'n=%s,r=%s' % (username, self.cnonce)
+        return 'n,,' + self.client_first_bare
+    
+    def respond(self, challenge):
+        params = dict([item.split('=', 1) for item in challenge.split(',') if '=' in item])
+        if 'v' in params or 'e' in params:
+            # Server-final message sent as a challenge
+            if not self.verify(challenge):
+                raise SASLError('Bad %s server signature' % self.name)
+            return ''
+        try:
+            nonce, salt, iterations = params['r'], b64decode(params['s']), int(params['i'])
+        except (KeyError, ValueError, TypeError):
+            raise SASLError('Bad %s challenge' % self.name)
+        if not nonce.startswith(self.cnonce):
+            raise SASLError('Bad %s nonce' % self.name)
+        digestmod = getattr(hashlib, self.hash_name)
+        salted = scram_salted_password(self.hash_name, self.password, salt, iterations)
+        client_key = hmac.new(salted, 'Client Key', digestmod).digest()
+        server_key = hmac.new(salted, 'Server Key', digestmod).digest()
+        client_final = 'c=biws,r=%s' % nonce
+        auth_message = '%s,%s,%s' % (self.client_first_bare, challenge, client_final)
+        signature = hmac.new(digestmod(client_key).digest(), auth_message, digestmod).digest()
+        proof = ''.join([chr(ord(a) ^ ord(b)) for a, b in zip(client_key, signature)])
+        self.server_signature = hmac.new(server_key, auth_message, digestmod).digest()
+        return '%s,p=%s' % (client_final, b64encode(proof))
+    
+    def verify(self, data):
+        if not data:
+            # The signature came with the last challenge
+            return self.verified
+        params = dict([item.split('=', 1) for item in data.split(',') if '=' in item])
+        if self.server_signature is None or 'v' not in params:
+            return False
+        try:
+            self.verified = b64decode(params['v']) == self.server_signature
+        except TypeError:
+            self.verified = False
+        return self.verified
+
+
+class ScramSHA1Mechanism(ScramMechanism):
+    name = 'SCRAM-SHA-1'
+    hash_name = 'sha1'
+
+
+class ScramSHA256Mechanism(ScramMechanism):
+    name = 'SCRAM-SHA-256'
+    hash_name = 'sha256'
+
+
+# Supported mechanisms, the strongest first
+SASL_MECHANISMS = [ScramSHA256Mechanism, ScramSHA1Mechanism, DigestMD5Mechanism, PlainMechanism]
+
+def select_mechanism(server_auth):
+    """
+    Return the strongest mechanism class supported by both sides, or None.
+    
+    >>> select_mechanism([u'PLAIN', u'DIGEST-MD5']).name
+    'DIGEST-MD5'
+    """
+    for mechanism in SASL_MECHANISMS:
+        if mechanism.name in server_auth:
+            return mechanism
+    return None
+
+
+def benchmark_stanzas(number=100000):
+    """
+    Measure the stanza building throughput (stanzas per second) of the
+    precompiled templates, of the StanzaBuilder and of plain % formatting.
+    """
+    legacy = "<iq id='bind_1' type='set' xmlns='jabber:client'><bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'><resource>%s</resource></bind></iq>"
+    builder = StanzaBuilder()
+    
+    def build():
+        builder.reset()
+        builder.start('iq', (('id', 'bind_1'), ('type', 'set'), ('xmlns', 'jabber:client')))
+        builder.start('bind', (('xmlns', NS_BIND),)).element('resource', 'web').end().end()
+        return builder.getvalue()
+    
+    candidates = [
+        ('template', lambda: BIND.render(resource='web')),
+        ('builder', build),
+        ('format', lambda: legacy % 'web'),
+    ]
+    import timeit
+    results = {}
+    for name, function in candidates:
+        duration = min(timeit.repeat(function, number=number, repeat=3))
+        results[name] = number / duration
+    return results
+
+
+def stanza_error(stanza):
+    """
+    Return the defined condition of an error stanza (conflict, forbidden...),
+    or None if the stanza isn't an error.
+    """
+    error = stanza is not None and stanza.find('error')
+    if not error:
+        return None
+    for child in error.children:
+        if child.ns == NS_STANZAS and child.name != 'text':
+            return child.name
+    return 'undefined-condition'
+
+
+def iq_result(username, iq):
+    """ProvisioningResult of an account from the reply <iq/> (None: no reply)"""
+    if iq is None:
+        return ProvisioningResult(username, False, 'timeout')
+    if iq.get('type') == 'result':
+        return ProvisioningResult(username, True, None)
+    return ProvisioningResult(username, False, stanza_error(iq) or 'unexpected-reply')
+
+
+Identity = collections.namedtuple('Identity', 'category type name lang')
+DiscoItem = collections.namedtuple('DiscoItem', 'jid node name')
+
+
+class DiscoInfo:
+    """
+    Result of a disco#info query (http://xmpp.org/extensions/xep-0030.html):
+    the identities, the features and the extended forms (XEP-0128, as
+    DataForm) of jid (at node).
+    ver() is the XEP-0115 verification string of the entity capabilities.
+    
+    >>> info = DiscoInfo('romeo@montague.lit/orchard', None,
+    ...                  [Identity('client', 'pc', 'Exodus 0.9.1', None)],
+    ...                  ['http://jabber.org/protocol/caps', NS_DISCO_INFO,
+    ...                   NS_DISCO_ITEMS, 'http://jabber.org/protocol/muc'])
+    >>> info.ver()
+    'QgayPKawpkPSDYmwT/WM94uAlu0='
+    >>> info.has_feature('http://jabber.org/protocol/muc')
+    True
+    
+    The extended forms are part of the verification string, as in the
+    complex example of XEP-0115:
+    
+    >>> iq = parse_body("<body xmlns='http://jabber.org/protocol/httpbind'><iq type='result' from='benvolio@capulet.lit/230193'>"
+    ...     "<query xmlns='http://jabber.org/protocol/disco#info'><identity xml:lang='en' category='client' name='Psi 0.11' type='pc'/>"
+    ...     "<identity xml:lang='el' category='client' name='&#936; 0.11' type='pc'/><feature var='http://jabber.org/protocol/caps'/>"
+    ...     "<feature var='http://jabber.org/protocol/disco#info'/><feature var='http://jabber.org/protocol/disco#items'/>"
+    ...     "<feature var='http://jabber.org/protocol/muc'/><x xmlns='jabber:x:data' type='result'>"
+    ...     "<field var='FORM_TYPE' type='hidden'><value>urn:xmpp:dataforms:softwareinfo</value></field>"
+    ...     "<field var='ip_version'><value>ipv4</value><value>ipv6</value></field><field var='os'><value>Mac</value></field>"
+    ...     "<field var='os_version'><value>10.5.1</value></field><field var='software'><value>Psi</value></field>"
+    ...     "<field var='software_version'><value>0.11</value></field></x></query></iq></body>").children[0]
+    >>> parse_disco_info(iq).ver()
+    'q07IKJEyjvHSyhy//CH0CxmKi8w='
+    """
+    
+    kind = 'info'
+    
+    def __init__(self, jid, node, identities, features, forms=()):
+        self.jid = jid
+        self.node = node
+        self.identities = tuple(identities)
+        self.features = frozenset(features)
+        self.forms = tuple(forms)
+        self._ver = None
+    
+    def has_feature(self, feature):
+        return feature in self.features
+    
+    def ver(self):
+        """XEP-0115 verification string (sha-1)"""
+        if self._ver is None:
+            parts = []
+            for identity in sorted(self.identities, key=lambda i: (i.category, i.type, i.lang or '', i.name or '')):
+                parts.append('%s/%s/%s/%s<' % (identity.category, identity.type, identity.lang or '', identity.name or ''))
+            for feature in sorted(self.features):
+                parts.append('%s<' % feature)
+            # The forms without a FORM_TYPE are left out
+            forms = [(form.get('FORM_TYPE'), form) for form in self.forms if form.get('FORM_TYPE')]
+            for form_type, form in sorted(forms, key=lambda item: item[0]):
+                parts.append('%s<' % form_type)
+                for field in sorted([f for f in form.fields if f.var and f.var != 'FORM_TYPE'], key=lambda f: f.var):
+                    parts.append('%s<' % field.var)
+                    for value in sorted([v or u'' for v in field.values]):
+                        parts.append('%s<' % value)
+            self._ver = b64encode(hashlib.sha1(utf8(''.join(parts))).digest())
+        return self._ver
+    
+    def __repr__(self):
+        return '<DiscoInfo %s%s: %d identities, %d features>' % (
+            self.jid, self.node and ' (%s)' % self.node or '', len(self.identities), len(self.features))
+
+
+class DiscoItems:
+    """Result of a disco#items query: the items (DiscoItem) of jid (at node)"""
+    
+    kind = 'items'
+    
+    def __init__(self, jid, node, items):
+        self.jid = jid
+        self.node = node
+        self.items = tuple(items)
+    
+    def __iter__(self):
+        return iter(self.items)
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def __repr__(self):
+        return '<DiscoItems %s%s: %d items>' % (self.jid, self.node and ' (%s)' % self.node or '', len(self.items))
+
+
+def parse_disco_info(iq, jid=None):
+    """
+    DiscoInfo of a disco#info reply <iq/> (from jid, the sender by default),
+    or None if it isn't a result.
+    """
+    query = iq is not None and iq.get('type') == 'result' and iq.find('query', NS_DISCO_INFO)
+    if not query:
+        return None
+    identities = [Identity(identity.get('category'), identity.get('type'), identity.get('name') or None,
+                           identity.get(XML_LANG) or None)
+                  for identity in query.children if identity.name == 'identity']
+    features = [feature.get('var') for feature in query.children if feature.name == 'feature']
+    forms = [parse_form(x) for x in query.children if x.name == 'x' and x.ns == NS_DATA]
+    return DiscoInfo(jid or iq.get('from'), query.get('node') or None, identities, features, forms)
+
+
+def parse_disco_items(iq, jid=None):
+    """DiscoItems of a disco#items reply <iq/>, or None if it isn't a result"""
+    query = iq is not None and iq.get('type') == 'result' and iq.find('query', NS_DISCO_ITEMS)
+    if not query:
+        return None
+    items = [DiscoItem(item.get('jid'), item.get('node') or None, item.get('name') or None)
+             for item in query.children if item.name == 'item']
+    return DiscoItems(jid or iq.get('from'), query.get('node') or None, items)
+
+
+class DiscoCache:
+    """
+    Thread-safe cache of service discovery results, shared by all the
+    clients (see DISCO_CACHE) so the features of a server are only queried
+    once for thousands of sessions.
+    Results are keyed by jid and node and expire after ttl seconds. The
+    entity capabilities (XEP-0115) announced in presences invalidate the
+    info of an entity when its verification string changes; a disco#info
+    matching an announced verification string is kept by hash, for every
+    entity announcing it, without expiration.
+    
+    >>> cache = DiscoCache(ttl=60)
+    >>> info = DiscoInfo('debian', None, [Identity('server', 'im', None, None)], [NS_COMMANDS])
+    >>> cache.put(info)
+    >>> cache.get_info('debian') is info
+    True
+    >>> cache.update_caps('debian', 'changed=')
+    >>> cache.get_info('debian') is None
+    True
+    """
+    
+    def __init__(self, ttl=300, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # (kind, jid, node) -> [result, expiration time]
+        self.results = collections.OrderedDict()
+        # jid -> announced verification string
+        self.caps = collections.OrderedDict()
+        # verification string -> verified DiscoInfo
+        self.by_ver = collections.OrderedDict()
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'invalidated': 0,
+        }
+    
+    def get_info(self, jid, node=None):
+        """Cached DiscoInfo of jid (at node), or None"""
+        return self.get('info', jid, node)
+    
+    def get_items(self, jid, node=None):
+        """Cached DiscoItems of jid (at node), or None"""
+        return self.get('items', jid, node)
+    
+    def get(self, kind, jid, node):
+        with self.lock:
+            if kind == 'info' and node is None and jid in self.caps:
+                info = self.by_ver.get(self.caps[jid])
+                if info is not None:
+                    self.counters['hits'] += 1
+                    return info
+            key = (kind, jid, node)
+            entry = self.results.get(key)
+            if entry is not None and entry[1] < time.time():
+                del self.results[key]
+                self.counters['expired'] += 1
+                entry = None
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            self.counters['hits'] += 1
+            return entry[0]
+    
+    def put(self, result):
+        """Cache a DiscoInfo or DiscoItems"""
+        with self.lock:
+            key = (result.kind, result.jid, result.node)
+            self.results.pop(key, None)
+            self.results[key] = [result, time.time() + self.ttl]
+            if result.kind == 'info' and result.node is None and self.caps.get(result.jid) == result.ver():
+                self.by_ver[result.ver()] = result
+            self._trim()
+    
+    def update_caps(self, jid, ver):
+        """
+        jid announced the verification string ver: forget its info if it
+        doesn't match any more.
+        """
+        with self.lock:
+            self.caps.pop(jid, None)
+            self.caps[jid] = ver
+            entry = self.results.get(('info', jid, None))
+            if entry is not None:
+                if entry[0].ver() == ver:
+                    self.by_ver[ver] = entry[0]
+                else:
+                    del self.results[('info', jid, None)]
+                    self.counters['invalidated'] += 1
+            self._trim()
+    
+    def invalidate(self, jid, node=None):
+        """Forget the results of jid (at node)"""
+        with self.lock:
+            for kind in ('info', 'items'):
+                self.results.pop((kind, jid, node), None)
+            if node is None:
+                self.caps.pop(jid, None)
+    
+    def _trim(self):
+        for entries in (self.results, self.caps, self.by_ver):
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+    
+    def stats(self):
+        """Return the cache counters and its size"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats['size'] = len(self.results)
+            stats['verified'] = len(self.by_ver)
+            return stats
+
+
+# Shared by all the clients, unless they get their own
+DISCO_CACHE = DiscoCache()
+
+
+class StanzaDispatcher:
+    """
+    Routes the stanzas received on a session: the replies to the <iq/> sent
+    with send_iq() complete their Future (matched by id), the other stanzas
+    go to the handlers registered for their element name and namespace.
+    Many requests can be outstanding at the same time on one session.
+    
+    >>> dispatcher = StanzaDispatcher()
+    >>> messages = []
+    >>> dispatcher.register(messages.append, 'message', 'jabber:client')
+    >>> reply = dispatcher.expect('ping-1')
+    >>> body = parse_body("<body xmlns='http://jabber.org/protocol/httpbind'><message xmlns='jabber:client'/><iq xmlns='jabber:client' type='result' id='ping-1'/></body>")
+    >>> dispatcher.dispatch_body(body)
+    >>> messages, reply.result().get('type')
+    ([<Element {jabber:client}message>], u'result')
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, ns) -> handlers, ns None meaning any namespace
+        self.handlers = {}
+        # iq id -> Future of the reply
+        self.pending = {}
+        # stanzas waiting for the next request (synchronous clients)
+        self.outgoing = []
+        self.counters = collections.defaultdict(int)
+    
+    def new_id(self, name):
+        """Increases the counter of name and returns a new stanza id"""
+        self.lock.acquire()
+        try:
+            self.counters[name] += 1
+            return "%s-%s" % (name, self.counters[name])
+        finally:
+            self.lock.release()
+    
+    def register(self, handler, name, ns=None):
+        """Call handler(stanza) for every stanza name (in the namespace ns)"""
+        self.lock.acquire()
+        try:
+            self.handlers.setdefault((name, ns), []).append(handler)
+        finally:
+            self.lock.release()
+    
+    def unregister(self, handler, name, ns=None):
+        self.lock.acquire()
+        try:
+            self.handlers.get((name, ns), []).remove(handler)
+        finally:
+            self.lock.release()
+    
+    def expect(self, id):
+        """Return the Future of the reply to the <iq/> with the given id"""
+        future = Future()
+        self.lock.acquire()
+        try:
+            self.pending[id] = future
+        finally:
+            self.lock.release()
+        return future
+    
+    def queue(self, stanza, id=None):
+        """
+        Queue a stanza for the next request of a synchronous client (see
+        BOSHClient.receive). Returns the Future of the reply if id is given.
+        """
+        future = None
+        if id is not None:
+            future = self.expect(id)
+        self.lock.acquire()
+        try:
+            self.outgoing.append(stanza)
+        finally:
+            self.lock.release()
+        return future
+    
+    def flush(self):
+        """Return the queued stanzas (a string) and empty the queue"""
+        self.lock.acquire()
+        try:
+            stanzas = ''.join(self.outgoing)
+            del self.outgoing[:]
+            return stanzas
+        finally:
+            self.lock.release()
+    
+    def dispatch(self, stanza):
+        """Route one stanza. Returns False if nobody wanted it."""
+        future = None
+        self.lock.acquire()
+        try:
+            if stanza.name == 'iq' and stanza.get('type') in ('result', 'error'):
+                future = self.pending.pop(stanza.get('id'), None)
+            if future is None:
+                handlers = self.handlers.get((stanza.name, stanza.ns), []) + self.handlers.get((stanza.name, None), [])
+        finally:
+            self.lock.release()
+        if future is not None:
+            future.set_result(stanza)
+            return True
+        for handler in handlers:
+            handler(stanza)
+        return bool(handlers)
+    
+    def dispatch_body(self, body):
+        """Route all the stanzas of a <body/> Element"""
+        for stanza in body.children:
+            self.dispatch(stanza)
+    
+    def dispatch_data(self, data):
+        """Route all the stanzas of a BOSHResponse (as given to on_data)"""
+        if data:
+            self.dispatch_body(data.body)
+
+
+class ReadOnlyDict(dict):
+    """A dict that can't be changed in place, for the defaults shared by all the clients"""
+    
+    def read_only(self, *args, **kwargs):
+        raise TypeError('%s is read-only, change a copy of it' % self.__class__.__name__)
+    
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = read_only
+
+
+# Headers of the requests, shared by all the clients (see
+# BOSHClient.set_header)
+DEFAULT_HEADERS = ReadOnlyDict({
+    "Content-type": "text/plain; charset=UTF-8",
+    "Accept": "text/xml",
+    "Accept-Encoding": ", ".join(CONTENT_ENCODINGS),
+})
+
+# URL -> parsed BOSH service, shared by the clients of a service
+SERVICES = {}
+
+def parse_service(url):
+    """Parsed URL of a BOSH service (an immutable tuple, shared)"""
+    service = SERVICES.get(url)
+    if service is None:
+        if len(SERVICES) > 1000:
+            SERVICES.clear()
+        service = SERVICES[url] = urlparse(url)
+    return service
+
+
+class SessionState(object):
+    """
+    What is needed to take a BOSH session over (see BOSHClient.session_state),
+    kept compact so that many idle sessions fit in memory: no __dict__, the
+    service is shared.
+    
+    >>> state = SessionState(parse_service('http://debian/http-bind/'), u'essai@debian/web', u'b5e6', 1242)
+    >>> state.service.netloc, state.rid
+    ('debian', 1242)
+    """
+    
+    __slots__ = ('service', 'jid', 'sid', 'rid', 'wait', 'hold', 'requests', 'authid')
+    
+    def __init__(self, service, jid, sid, rid, wait=60, hold=1, requests=2, authid=None):
+        self.service = service
+        self.jid = jid
+        self.sid = sid
+        self.rid = rid
+        self.wait = wait
+        self.hold = hold
+        self.requests = requests
+        self.authid = authid
+    
+    def __repr__(self):
+        return '<SessionState %s sid=%s rid=%s>' % (self.jid, self.sid, self.rid)
+
+
+def dump_session(state):
+    """
+    Serialize a SessionState (to JSON), see load_session.
+    
+    >>> state = SessionState(parse_service('http://debian/http-bind/'), u'essai@debian/web', u'b5e6', 1242, authid=u'b5e6')
+    >>> load_session(dump_session(state))
+    <SessionState essai@debian/web sid=b5e6 rid=1242>
+    """
+    return json.dumps({
+        'service': state.service.geturl(),
+        'jid': state.jid,
+        'sid': state.sid,
+        'rid': state.rid,
+        'wait': state.wait,
+        'hold': state.hold,
+        'requests': state.requests,
+        'authid': state.authid,
+    }, separators=(',', ':'))
+
+
+def load_session(data):
+    """Return the SessionState serialized by dump_session. Raises ValueError if data is invalid."""
+    try:
+        values = json.loads(data)
+        return SessionState(parse_service(str(values['service'])), values['jid'], values['sid'], int(values['rid']),
+                            values['wait'], values['hold'], values['requests'], values.get('authid'))
+    except (KeyError, TypeError), e:
+        raise ValueError('Invalid session state: %s' % e)
+
+
+class SessionStore:
+    """
+    Where BOSHClient.checkpoint saves the sessions, for BOSHClient.resume
+    to take them over later. This one keeps them in memory, for a single
+    process: FileSessionStore and SQLiteSessionStore survive a restart.
+    Subclasses only have to override read, write and delete.
+    
+    >>> store = SessionStore()
+    >>> store.save('key', SessionState(parse_service('http://debian/http-bind/'), u'essai@debian/web', u'b5e6', 1242))
+    >>> store.load('key').rid
+    1242
+    >>> store.delete('key')
+    >>> store.load('key') is None
+    True
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+    
+    def load(self, key):
+        """Return the SessionState saved under key, None if there is none (or if it's unreadable)"""
+        data = self.read(key)
+        if data is None:
+            return None
+        try:
+            return load_session(data)
+        except ValueError, e:
+            logger.warning('Ignoring the saved session %s: %s', key, e)
+            return None
+    
+    def save(self, key, state):
+        self.write(key, dump_session(state))
+    
+    def read(self, key):
+        """Return the serialized session saved under key, or None"""
+        self.lock.acquire()
+        try:
+            return self.data.get(key)
+        finally:
+            self.lock.release()
+    
+    def write(self, key, data):
+        self.lock.acquire()
+        try:
+            self.data[key] = data
+        finally:
+            self.lock.release()
+    
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            self.data.pop(key, None)
+        finally:
+            self.lock.release()
+
+
+class FileSessionStore(SessionStore):
+    """
+    One file per session in directory. The files are replaced atomically
+    (written aside then renamed), so a crash never leaves half a session;
+    with fsync, they also survive a crash of the machine (slower). Only
+    the owner can read them (and the directory, if it's created here).
+    """
+    
+    def __init__(self, directory, fsync=False):
+        self.directory = directory
+        self.fsync = fsync
+        if not os.path.isdir(directory):
+            # The sessions can be taken over by anyone who reads them
+            os.makedirs(directory, 0700)
+    
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(utf8(key)).hexdigest() + '.json')
+    
+    def read(self, key):
+        try:
+            with open(self.path(key)) as f:
+                return f.read()
+        except IOError:
+            return None
+    
+    def write(self, key, data):
+        path = self.path(key)
+        temp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        with os.fdopen(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'w') as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(temp, path)
+    
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions in an SQLite database, which several processes can share.
+    The journal is in WAL mode and not synced on every write: a crash of
+    the machine may lose the last checkpoints (but not the database).
+    """
+    
+    def __init__(self, path, timeout=5):
+        import sqlite3
+        self.lock = threading.Lock()
+        if path != ':memory:':
+            # Readable by the owner only (SQLite gives the same mode to the
+            # journal files)
+            os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0600))
+            os.chmod(path, 0600)
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS bosh_sessions (key TEXT PRIMARY KEY, data TEXT NOT NULL)')
+    
+    def read(self, key):
+        self.lock.acquire()
+        try:
+            row = self.connection.execute('SELECT data FROM bosh_sessions WHERE key = ?', (key,)).fetchone()
+        finally:
+            self.lock.release()
+        return row and row[0]
+    
+    def write(self, key, data):
+        self.lock.acquire()
+        try:
+            self.connection.execute('INSERT OR REPLACE INTO bosh_sessions (key, data) VALUES (?, ?)', (key, data))
+        finally:
+            self.lock.release()
+    
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            self.connection.execute('DELETE FROM bosh_sessions WHERE key = ?', (key,))
+        finally:
+            self.lock.release()
+    
+    def close(self):
+        self.connection.close()
+
+
+def backoff_delay(attempt, base=0.5, maximum=30):
+    """
+    Delay before the attempt-th retry: random between 0 and an exponential
+    bound ("full jitter"), so the clients failing together don't retry
+    together.
+    
+    >>> 0 <= backoff_delay(3) <= 4
+    True
+    """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
 class BOSHClient:
     """
-    Quite simple BOSH client used by Django-XMPPAuth.
-    When you initialize the client, it does NOT connect! Here is a mock 
-    connection process with the BOSH Client:
+    Quite simple BOSH client used by Django-XMPPAuth.
+    When you initialize the client, it does NOT connect! Here is a mock 
+    connection process with the BOSH Client (the FakeBOSHServer of
+    boshbench stands for the connection manager):
+    
+    >>> from boshbench import FakeBOSHServer
+    >>> server = FakeBOSHServer(users={'essai': 'essai'}).start()
+    >>> client = BOSHClient(server.url, 'essai@localhost', 'essai', resource='web', debug=False)
+    >>> client.init_connection()
+    >>> client.request_bosh_session()
+    >>> sid = client.authenticate_xmpp()
+    >>> client.close_connection()
+    
+    Many clients can share warm HTTP connections through a ConnectionPool:
+    
+    >>> pool = ConnectionPool(max_per_host=20)
+    >>> client = BOSHClient(server.url, 'essai@localhost', 'essai', debug=False, pool=pool)
+    >>> client.init_connection()
+    >>> client.request_bosh_session()
+    >>> client.close_connection()
+    >>> client.close_connection()
+    >>> pool.stats()['idle']
+    1
+    >>> pool.close()
+    >>> server.stop()
+    """
+    
+    # The defaults live in the class, so idle clients only carry what
+    # differs from them.
+    content_type = "text/xml; charset=utf-8"
+    headers = DEFAULT_HEADERS
+    # Encoding of the requests, if the connection manager accepts one
+    # (see the 'accept' attribute of the session creation response), for
+    # bodies of at least compress_min bytes.
+    request_encoding = None
+    compress_min = 1024
+    
+    server_auth = ()
+    sid = None
+    authid = None
+    register_fields = None
+    terminated = False
+    authenticated = False
+    # Service discovery results, shared with the other clients
+    disco_cache = DISCO_CACHE
+    
+    # BOSH session parameters: what we ask for (wait, hold, window) and
+    # what the connection manager grants (server_*). polling and
+    # inactivity are in seconds, None if the server didn't tell.
+    wait = 60
+    hold = 1
+    window = 5
+    server_hold = 1
+    server_requests = 2
+    server_wait = None
+    server_polling = None
+    server_inactivity = None
+    # When the last response arrived, and the number of stanzas received
+    # (see KeepaliveScheduler)
+    last_response = None
+    received = 0
+    # Second HTTP connection, for the polls of poll()
+    poll_connection = None
+    
+    # Stanzas given to send() within coalesce_window seconds go in one
+    # <body/> (0: each one is sent right away), coalesce_max at most.
+    coalesce_window = 0
+    coalesce_max = 50
+    flush_timer = None
+    
+    # Once authenticated, the session is saved in session_store (see
+    # SessionStore) every checkpoint_every requests and when the connection
+    # is closed, for resume() to take it over after a restart. Between two
+    # checkpoints the saved RID lags behind, and the server only takes it
+    # back within its window (server_requests). resumed tells if resume()
+    # did.
+    session_store = None
+    checkpoint_every = 1
+    checkpointed_rid = None
+    resumed = False
+    # Logins attempted by resume() when the saved session is gone, with
+    # backoff_delay(attempt, backoff_base, backoff_max) between them.
+    login_retries = 5
+    backoff_base = 0.5
+    backoff_max = 30
+    
+    def __init__(self, bosh_service, jid='', password='', resource='web', debug=True, pool=None, instrumentation=None):
+        """
+        Initialize the client.
+        You must specify the Jabber ID, the corresponding password and the URL
+        of the BOSH service to connect to.
+        If pool (a ConnectionPool) is given, the HTTP connection is taken from
+        it and given back to it when the connection is closed.
+        instrumentation (see Metrics) measures the phases and the requests.
+        """
+
+        self.debug = debug
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+        
+        self.connection = None
+        self.pool = pool
+        
+        if jid:
+            self.jid = parse_jid(jid, resource)
+        else:
+            self.jid = ''
+        self.password = password
+        self.bosh_service = parse_service(bosh_service)
+        self.resource = resource
+        
+        self.rid = random.randint(0, 10000000)
+        self.initial_rid = self.rid
+        self.log('Init RID: %s', self.rid)
+        
+        # Receives the stanzas that no flow is waiting for
+        self.dispatcher = StanzaDispatcher()
+        self.dispatcher.register(self.handle_caps, 'presence')
+        # The full JID given by the server when the resource is bound
+        self.bound_jid = self.jid and self.jid.jid_with_resource
+        
+        # Held while a request is in progress, the timer flushes from
+        # another thread
+        self.request_lock = threading.RLock()
+    
+    def log(self, message, *args):
+        """
+        Log a debug message on the 'boshclient' logger. The message is
+        formatted with args only if debug is on and the logger enabled.
+        Warning: this function makes the client very verbose!
+        """
+        if self.debug and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(message, *args)
+    
+    def get_sid(self):
+        """Return the SID assigned to this client"""
+        return self.sid
+    
+    def session_state(self):
+        """The SessionState of the current session, to park it"""
+        return SessionState(self.bosh_service, self.bound_jid, self.sid, self.rid,
+                            int(self.server_wait or 60), self.server_hold, self.server_requests, self.authid)
+    
+    def session_key(self):
+        """Key of the session in the session_store: the service and the JID"""
+        return '%s %s' % (self.bosh_service.geturl(), self.jid.jid_with_resource)
+    
+    def checkpoint(self):
+        """Save the state of the session in the session_store"""
+        if self.session_store is not None and self.sid:
+            self.session_store.save(self.session_key(), self.session_state())
+            self.checkpointed_rid = self.rid
+    
+    def get_rid(self):
+        """Return the RID of this client"""
+        return self.rid
+    
+    def set_rid(self, rid=0):
+        """
+        Create a random RID and use it, except if rid is specified and different
+        from 0.
+        """
+        if rid == 0:
+            self.rid = random.randint(0, 10000000)
+        else:
+            self.rid = rid
+        self.initial_rid = self.rid
+    
+    def init_connection(self):
+        """Initialize the HTTP connection (not the XMPP session!)"""
+        self.log('Initializing connection to %s', self.bosh_service.netloc)
+        with self.instrumentation.phase('connect'):
+            if self.pool is not None:
+                self.connection = self.pool.acquire(self.bosh_service.netloc)
+            else:
+                self.connection = httplib.HTTPConnection(self.bosh_service.netloc)
+            if self.connection.sock is None:
+                try:
+                    self.connection.connect()
+                except socket.error, e:
+                    if self.pool is not None:
+                        # Don't leak the slot of the pool
+                        self.pool.release(self.connection, reusable=False)
+                        self.connection = None
+                    raise ConnectionError('Cannot connect to %s: %s' % (self.bosh_service.netloc, e))
+        self.log('Connection initialized')
+    
+    def close_connection(self, reusable=True):
+        """
+        Close the HTTP connection (not the XMPP session!). Pass
+        reusable=False when the stream is in an unknown state: a pooled
+        connection is then closed instead of being given back.
+        Closing it again does nothing.
+        """
+        if self.connection is None:
+            return
+        self.log('Closing connection')
+        self.cancel_flush()
+        self.close_poll_connection()
+        if self.authenticated and self.checkpointed_rid != self.rid:
+            self.checkpoint()
+        if self.pool is not None:
+            self.pool.release(self.connection, reusable)
+            self.connection = None
+        else:
+            self.connection.close()
+        self.log('Connection closed')
+        # TODO add execptions handler there
+    
+    def close_poll_connection(self):
+        connection, self.poll_connection = self.poll_connection, None
+        if connection is not None:
+            connection.close()
+
+    def set_header(self, name, value):
+        """
+        Set an HTTP header of the requests of this client only: the
+        headers shared with the other clients are copied first.
+        
+        >>> client = BOSHClient('http://localhost:5280/http-bind', debug=False)
+        >>> client.set_header('X-Forwarded-For', '10.0.0.1')
+        >>> client.headers['X-Forwarded-For'], 'X-Forwarded-For' in DEFAULT_HEADERS
+        ('10.0.0.1', False)
+        >>> BOSHClient.headers['Accept'] = 'text/html'
+        Traceback (most recent call last):
+        TypeError: ReadOnlyDict is read-only, change a copy of it
+        """
+        if isinstance(self.headers, ReadOnlyDict):
+            self.headers = dict(self.headers)
+        self.headers[name] = value
+    
+    def wrap_stanza_body(self, stanza, more_body='', rid=None):
+        """
+        Wrap the XMPP stanza with the <body> element (required for BOSH).
+        The body gets the current RID unless rid is given.
+        """
+        if rid is None:
+            rid = self.rid
+        if not stanza == '':
+            return BODY.render(rid=rid, sid=self.sid, more_body=more_body, stanza=stanza)
+        else:
+            return EMPTY_BODY.render(rid=rid, sid=self.sid, more_body=more_body)
+
+    def send_request(self, xml_stanza):
+        """
+        Send a request to self.bosh_service.path using POST containing
+        xml_stanza with self.headers.
+        Returns the data contained in the response (only if status == 200), as
+        a BOSHResponse: the body is parsed while it's read.
+        Returns False if status != 200
+        """
+        started = time.time()
+        body, headers = self.encode_request(xml_stanza)
+        response = self.post(body, headers)
+        if response is False:
+            self.instrumentation.record_request(len(body), 0, time.time() - started)
+            return False
+        parser = BodyParser()
+        parts = []
+        decoder = ContentDecoder(response.getheader('content-encoding'))
+        for chunk in self.read_chunks(response, decoder):
+            parts.append(chunk)
+            parser.feed(chunk)
+        data = BOSHResponse(''.join(parts), parser.close())
+        self.instrumentation.record_request(len(body), decoder.size, time.time() - started)
+        
+        self.log('DATA: %s', data)
+        return data
+    
+    def encode_request(self, xml_stanza):
+        """
+        Encode a request body: UTF-8, compressed when the connection manager
+        accepts it and the body is big enough to be worth it.
+        Returns (body, HTTP headers).
+        """
+        self.log('XML_STANZA: %s', xml_stanza)
+        if isinstance(xml_stanza, unicode):
+            # httplib sends a unicode body apart from the headers, and the
+            # second small write waits for the delayed ACK of the first
+            xml_stanza = xml_stanza.encode('utf-8')
+        if self.request_encoding is None or len(xml_stanza) < self.compress_min:
+            return xml_stanza, self.headers
+        headers = dict(self.headers)
+        headers['Content-Encoding'] = self.request_encoding
+        return compress_body(xml_stanza, self.request_encoding), headers
+    
+    def post(self, body, headers=None):
+        """
+        POST the (encoded) body and return the HTTP response, or False if its
+        status isn't 200.
+        """
+        if headers is None:
+            body, headers = self.encode_request(body)
+        self.write_request(self.connection, body, headers)
+        return self.read_response(self.connection)
+    
+    def write_request(self, connection, body, headers):
+        """Send the request on connection, it takes the current RID"""
+        self.log('Sending the request')
+        try:
+            connection.request("POST", self.bosh_service.path, body, headers)
+        except AttributeError:
+            raise ConnectionError
+        self.rid += 1
+        if self.authenticated and self.session_store is not None and \
+                (self.checkpointed_rid is None or self.rid - self.checkpointed_rid >= self.checkpoint_every):
+            # Saved before the response: if we die waiting for it, the
+            # next RID is still the right one
+            self.checkpoint()
+    
+    def read_response(self, connection):
+        """
+        Wait for the HTTP response on connection, return it or False if its
+        status isn't 200.
+        """
+        response = connection.getresponse()
+        self.last_response = time.time()
+        self.log('Response status code: %s', response.status)
+        if response.status != 200:
+            # Drain the body anyway, so a pooled connection stays reusable
+            response.read()
+            self.log('Something wrong happened!')
+            return False
+        return response
+    
+    def read_chunks(self, response, decoder=None):
+        """
+        Iterate over the body of the HTTP response as it arrives, decoded
+        according to its Content-Encoding.
+        """
+        if decoder is None:
+            decoder = ContentDecoder(response.getheader('content-encoding'))
+        chunk = response.read(8192)
+        while chunk:
+            data = decoder.decode(chunk)
+            if data:
+                yield data
+            chunk = response.read(8192)
+        data = decoder.flush()
+        if data:
+            yield data
+    
+    def iter_stanzas(self, xml_stanza):
+        """
+        Send xml_stanza and yield the children of the response <body/> as
+        soon as each one is parsed, without waiting for the whole response.
+        Sets self.terminated if the session is over.
+        """
+        started = time.time()
+        body, headers = self.encode_request(xml_stanza)
+        for stanza in self.iter_response(self.post(body, headers), len(body), started):
+            yield stanza
+    
+    def iter_response(self, response, sent, started):
+        """
+        Yield the children of the <body/> of the HTTP response (see
+        iter_stanzas), sent is the size of the request.
+        """
+        if response is False:
+            self.terminated = True
+            return
+        stanzas = []
+        parser = BodyParser(stanzas.append)
+        decoder = ContentDecoder(response.getheader('content-encoding'))
+        for chunk in self.read_chunks(response, decoder):
+            parser.feed(chunk)
+            for stanza in stanzas:
+                yield stanza
+            del stanzas[:]
+        self.instrumentation.record_request(sent, decoder.size, time.time() - started)
+        body = parser.close()
+        if body.get('type') == 'terminate':
+            self.terminated = True
+    
+    def receive(self):
+        """
+        One long-poll: send the stanzas queued on the dispatcher (or an empty
+        body) and dispatch the stanzas of the response as they are parsed.
+        It goes through poll(), so send() and the flows don't wait for the
+        server to answer it. Returns False once the session is over.
+        """
+        return self.poll()
+    
+    def poll(self):
+        """
+        The long-poll of receive(), on a second HTTP connection (BOSH allows
+        two requests at a time): request_lock is only held while the request
+        is written, so send() and the flows go on while the server holds the
+        poll. Returns False once the session is over.
+        """
+        started = time.time()
+        with self.request_lock:
+            self.cancel_flush()
+            if self.poll_connection is None:
+                self.poll_connection = httplib.HTTPConnection(self.bosh_service.netloc)
+            connection = self.poll_connection
+            body, headers = self.encode_request(self.wrap_stanza_body(self.dispatcher.flush()))
+            try:
+                self.write_request(connection, body, headers)
+            except (socket.error, httplib.HTTPException):
+                self.close_poll_connection()
+                raise
+        try:
+            response = self.read_response(connection)
+        except (socket.error, httplib.HTTPException):
+            connection.close()
+            raise
+        for stanza in self.iter_response(response, len(body), started):
+            self.received += 1
+            self.dispatcher.dispatch(stanza)
+        return not self.terminated
+    
+    def send(self, stanza, id=None):
+        """
+        Send a stanza, coalesced with the ones sent within coalesce_window
+        seconds (in the same <body/>). Returns the Future of the reply if
+        id is given: the reply is dispatched when it comes back.
+        
+        >>> from boshbench import FakeBOSHServer
+        >>> server = FakeBOSHServer(users={'essai': 'essai'}).start()
+        >>> client = BOSHClient(server.url, 'essai@localhost', 'essai', debug=False)
+        >>> client.coalesce_window = 0.05
+        >>> client.init_connection()
+        >>> client.request_bosh_session()
+        >>> success = client.authenticate_xmpp()
+        >>> requests = server.requests
+        >>> users = client.send(REGISTER_FIELDS, 'reg1')
+        >>> pong = client.send(PING.render(to='localhost', id='ping-1'), 'ping-1')
+        >>> client.flush()
+        >>> users.result().get('type'), pong.result().get('type'), server.requests - requests
+        (u'result', u'result', 1)
+        >>> client.close_connection()
+        >>> server.stop()
+        """
+        future = self.dispatcher.queue(stanza, id)
+        if not self.coalesce_window or len(self.dispatcher.outgoing) >= self.coalesce_max:
+            self.flush()
+        else:
+            with self.request_lock:
+                # Checked with the lock: a single timer per window
+                if self.flush_timer is None:
+                    self.flush_timer = threading.Timer(self.coalesce_window, self.flush)
+                    self.flush_timer.daemon = True
+                    self.flush_timer.start()
+        return future
+    
+    def flush(self):
+        """Send the stanzas queued by send() now, in one <body/>"""
+        with self.request_lock:
+            self.cancel_flush()
+            stanzas = self.dispatcher.flush()
+            if not stanzas:
+                return
+            for stanza in self.iter_stanzas(self.wrap_stanza_body(stanzas)):
+                self.received += 1
+                self.dispatcher.dispatch(stanza)
+    
+    def cancel_flush(self):
+        with self.request_lock:
+            timer, self.flush_timer = self.flush_timer, None
+        if timer is not None:
+            timer.cancel()
+    
+    def receive_loop(self, stop=None):
+        """
+        Receive and dispatch the stanzas until the session is over or stop()
+        is true. Another thread can send() meanwhile, without waiting for
+        the poll held by the server:
+        
+        >>> from boshbench import FakeBOSHServer
+        >>> server = FakeBOSHServer(users={'essai': 'essai'}).start()
+        >>> server.wait = 3
+        >>> client = BOSHClient(server.url, 'essai@localhost', 'essai', debug=False)
+        >>> client.init_connection()
+        >>> client.request_bosh_session()
+        >>> success = client.authenticate_xmpp()
+        >>> stop = threading.Event()
+        >>> receiver = threading.Thread(target=client.receive_loop, args=(stop.is_set,))
+        >>> receiver.start()
+        >>> time.sleep(0.5)
+        >>> started = time.time()
+        >>> pong = client.send(PING.render(to='localhost', id='ping-1'), 'ping-1')
+        >>> pong.result().get('type'), time.time() - started < 1
+        (u'result', True)
+        >>> stop.set()
+        >>> receiver.join()
+        >>> client.close_connection()
+        >>> server.stop()
+        """
+        while self.receive():
+            if stop is not None and stop():
+                break
+    
+    def run_flow(self, flow):
+        """
+        Drive a flow (see register_flow, session_flow...) over the HTTP
+        connection: every stanza yielded by the flow is sent with send_request
+        and the response data is sent back into the flow.
+        A flow may yield a list of bodies with consecutive RIDs: they don't
+        depend on each other's response and may be pipelined. It gets the
+        list of the responses back.
+        A flow may also yield another flow, and gets its value back.
+        Returns the value the flow returned (with the Return exception).
+        """
+        data = None
+        with self.request_lock:
+            try:
+                while True:
+                    xml_stanza = flow.send(data)
+                    if isinstance(xml_stanza, types.GeneratorType):
+                        data = self.run_flow(xml_stanza)
+                    elif isinstance(xml_stanza, list):
+                        data = [self.send_request(body) for body in xml_stanza]
+                    else:
+                        data = self.send_request(xml_stanza)
+            except StopIteration:
+                return None
+            except Return, r:
+                return r.value
+    
+    def register(self, **kwargs):
+        """
+        Create a new user account on the XMPP server, according to XEP-0077 
+        http://xmpp.org/extensions/xep-0077.html
+        Returns True if the account got created.
+        """
+        return self.run_flow(self.register_flow(**kwargs))
+    
+    def register_flow(self, **kwargs):
+        """Flow of register: yields the stanzas to send, receives the responses"""
+        fields = yield self.register_fields_flow()
+        # Then send it
+        data = yield self.wrap_stanza_body(self.register_stanza('reg2', fields, kwargs))
+        
+        # TODO: handle exceptions (conflict, not-acceptable etc)
+        iq = data and data.body.find('iq')
+        raise Return(iq is not None and iq.get('type') == 'result')
+    
+    def register_users(self, credentials):
+        """
+        Create many accounts ((username, password) pairs) on a single stream
+        with one request for all of them. Returns a ProvisioningResult per
+        account.
+        """
+        return self.run_flow(self.register_users_flow(credentials))
+    
+    def register_users_flow(self, credentials):
+        """Flow of register_users"""
+        fields = yield self.register_fields_flow()
+        builder = StanzaBuilder()
+        usernames = []
+        ids = []
+        for username, password in credentials:
+            iq_id = 'reg-%s' % len(ids)
+            usernames.append(username)
+            ids.append(iq_id)
+            builder.raw(self.register_stanza(iq_id, fields, {'username': username, 'password': password}))
+        replies = yield self.replies_flow(builder.getvalue(), ids)
+        results = []
+        for username, iq_id in zip(usernames, ids):
+            results.append(iq_result(username, replies.get(iq_id)))
+        raise Return(results)
+    
+    def register_fields_flow(self):
+        """
+        Flow asking the remote server the registration fields. They are
+        cached, so the following registrations cost one round trip.
+        """
+        if self.register_fields is not None:
+            raise Return(self.register_fields)
+        
+        self.log('Ask the remote server to send the fields list.')
+        xml_stanza = self.wrap_stanza_body(REGISTER_FIELDS)
+        data = yield xml_stanza
+        # The servers send the fields list and an instruction element.
+        fields = []
+        query = data.body.find('query', NS_REGISTER)
+        for child in query.children:
+            if child.name == 'instructions':
+                # This node is the instruction element
+                # TODO: find a smart thing to do with this information
+                pass
+            else:
+                fields.append(child.name)
+        self.register_fields = fields
+        raise Return(fields)
+    
+    def register_stanza(self, id, fields, values):
+        """Build the registration <iq/> filling fields with values"""
+        # It's time to build the dictonary for the response
+        response_dict = {}
+        for element in fields:
+            response_dict[element] = values.get(element, '')
+        # And now, build the response XML stanza
+        builder = StanzaBuilder()
+        builder.start('iq', (('type', 'set'), ('id', id))).start('query', (('xmlns', NS_REGISTER),))
+        for elem, value in response_dict.iteritems():
+            builder.element(elem, value)
+        return builder.end().end().getvalue()
+    
+    def replies_flow(self, xml_stanza, ids, max_polls=10):
+        """
+        Flow sending xml_stanza (carrying <iq/> with the given ids) and
+        polling until every <iq/> got its reply, which may come in later
+        responses. Returns a dict id -> <iq/> Element of the reply.
+        """
+        ids = set(ids)
+        replies = {}
+        data = yield self.wrap_stanza_body(xml_stanza)
+        polls = 0
+        while data:
+            for child in data.body.children:
+                if child.name == 'iq' and child.get('id') in ids:
+                    replies[child.get('id')] = child
+                else:
+                    self.dispatcher.dispatch(child)
+            if len(replies) == len(ids) or data.body.get('type') == 'terminate' or polls == max_polls:
+                break
+            polls += 1
+            data = yield self.wrap_stanza_body('')
+        raise Return(replies)
+    
+    def request_bosh_session(self):
+        """
+        Request a BOSH session according to
+        http://xmpp.org/extensions/xep-0124.html#session-request
+        Returns the new SID (str).
+        This function also fill many fields of this BOSHClient object, such as:
+            * sid
+            * server_wait
+            * server_auth_methods
+        """
+        return self.run_flow(self.session_flow())
+    
+    def session_flow(self):
+        """Flow of request_bosh_session"""
+        self.log('Prepare to request BOSH session')
+        
+        xml_stanza = SESSION_REQUEST.render(rid=self.rid, to=self.jid.host, wait=self.wait, hold=self.hold, window=self.window)
+        with self.instrumentation.phase('session-request'):
+            data = yield xml_stanza
+      
+        # This is XML. response_body contains the <body/> element of the
+        # response.
+        if not data:
+            raise ConnectionError
+        response_body = data.body
+        
+        # Check if this there was a problem during the session request
+        if response_body.get('type') == 'terminate':
+            raise Return(0)
+        
+        # Get the remote Session ID
+        self.sid = response_body.get('sid')
+        self.log('sid = %s', self.sid)
+        
+        # Get the longest time (s) that the XMPP server will wait before
+        # responding to any request.
+        self.server_wait = response_body.get('wait')
+        self.log('wait = %s', self.server_wait)
+        
+        # Get the shortest allowed interval between two polls and the
+        # longest allowed inactivity
+        self.server_polling = response_body.get('polling') and float(response_body.get('polling')) or None
+        self.server_inactivity = response_body.get('inactivity') and float(response_body.get('inactivity')) or None
+        self.log('polling = %s, inactivity = %s', self.server_polling, self.server_inactivity)
+        
+        # Get the authid
+        self.authid = response_body.get('authid')
+        
+        # Get the encodings the connection manager can decompress
+        accept = [e.strip() for e in response_body.get('accept').split(',')]
+        self.request_encoding = None
+        for encoding in CONTENT_ENCODINGS:
+            if encoding in accept:
+                self.request_encoding = encoding
+                break
+        
+        # Get how many requests we may keep open at the same time
+        self.server_hold = int(response_body.get('hold') or self.hold)
+        self.server_requests = int(response_body.get('requests') or self.server_hold + 1)
+        self.log('hold = %s, requests = %s', self.server_hold, self.server_requests)
+        
+        # Get the allowed authentication methods
+        mechanisms = response_body.find('mechanisms', NS_SASL)
+        auth_list = []
+        if mechanisms is not None:
+            if mechanisms.children:
+                for child in mechanisms.children:
+                    auth_method = child.text
+                    auth_list.append(auth_method)
+                    self.log('New AUTH method: %s', auth_method)
+            
+                self.server_auth = tuple([intern(utf8(name)) for name in auth_list])
+                
+            else:
+                self.log('The server didn\'t send the allowed authentication methods')
+        else:
+            self.log('The server didn\'t send the allowed authentication methods')
+            
+            # FIXME: BIG PROBLEM THERE! AUTH METHOD MUSTN'T BE GUEST!
+            auth_list = ['DIGEST-MD5']
+            self.server_auth = tuple(auth_list)
+        
+        #return self.sid
+        
+    def xmpp_disco(self, jid=None):
+        """
+        Retrieve informations about the server services (or about jid) using
+        the Jabber informations discovering.
+        http://xmpp.org/extensions/xep-0030.html
+        Returns the Future of the DiscoInfo (None if the query failed). It is
+        done right away when the result is cached.
+        
+        >>> from boshbench import FakeBOSHServer
+        >>> server = FakeBOSHServer(users={'essai': 'essai'}).start()
+        >>> client = BOSHClient(server.url, 'essai@localhost', 'essai', debug=False)
+        >>> client.init_connection()
+        >>> client.request_bosh_session()
+        >>> success = client.authenticate_xmpp()
+        >>> client.xmpp_disco().result().has_feature(NS_COMMANDS)
+        True
+        >>> client.close_connection()
+        >>> server.stop()
+        """
+        self.log('Using DISCO')
+        jid = jid or self.jid.host
+        id = self.dispatcher.new_id('info')
+        return self.disco_query(self.disco_cache.get_info(jid), parse_disco_info, jid, id,
+                                DISCO_INFO.render(id=id, to=jid, **{'from': self.jid.jid_with_resource}))
+    
+    def xmpp_disco_node(self, node_name, jid=None):
+        """
+        Discover the given node (of the server, or of jid).
+        http://xmpp.org/extensions/xep-0030.html#items
+        Returns the Future of the DiscoInfo, as xmpp_disco.
+        """
+        self.log('DISCO the node %s', node_name)
+        jid = jid or self.jid.host
+        node = 'http://jabber.org/protocol/%s' % node_name
+        id = self.dispatcher.new_id('info')
+        return self.disco_query(self.disco_cache.get_info(jid, node), parse_disco_info, jid, id,
+                                DISCO_INFO_NODE.render(id=id, to=jid, node=node, **{'from': self.jid.jid_with_resource}))
+    
+    def xmpp_disco_items(self, node=None, jid=None):
+        """
+        List the items of the server (or of jid), at node if given.
+        Returns the Future of the DiscoItems, as xmpp_disco.
+        """
+        self.log('DISCO the items of %s', node)
+        jid = jid or self.jid.host
+        id = self.dispatcher.new_id('items')
+        values = {'id': id, 'to': jid, 'from': self.jid.jid_with_resource}
+        if node is None:
+            stanza = DISCO_ITEMS.render(**values)
+        else:
+            stanza = DISCO_ITEMS_NODE.render(node=node, **values)
+        return self.disco_query(self.disco_cache.get_items(jid, node), parse_disco_items, jid, id, stanza)
+    
+    def disco_query(self, cached, parse, jid, id, stanza):
+        """
+        Future of a disco result: the cached one, or the parsed reply to
+        stanza, which gets cached.
+        """
+        future = Future()
+        if cached is not None:
+            future.set_result(cached)
+            return future
+        
+        def done(reply):
+            if reply.error is not None:
+                future.set_exception(reply.error)
+                return
+            result = parse(reply.value, jid)
+            if result is not None:
+                self.disco_cache.put(result)
+            future.set_result(result)
+        
+        self.send(stanza, id).add_done_callback(done)
+        return future
+    
+    def handle_caps(self, presence):
+        """Report the entity capabilities (XEP-0115) of a presence to the disco cache"""
+        caps = presence.find('c', NS_CAPS)
+        if caps is not None and caps.get('hash') == 'sha-1' and presence.get('from'):
+            self.disco_cache.update_caps(presence.get('from'), caps.get('ver'))
+    
+    def authenticate_xmpp(self):
+        """
+        Authenticate the user to the XMPP server via the BOSH connection.
+        You MUST have the following settings set:
+            * self.sid
+            * self.jid
+            * self.password
+            * self.rid
+            * self.server_auth
+        Note also that the connection MUST be opened (see self.init_connection).
+        Returns True if the authenication went fine, otherwise, returns False.
+        """
+        return self.run_flow(self.authenticate_flow())
+    
+    def authenticate_flow(self):
+        """Flow of authenticate_xmpp"""
+        
+        self.log('Prepare the XMPP authentication')
+            
+        mechanism_class = select_mechanism(self.server_auth)
+        if mechanism_class is None:
+            self.log('No supported authentication method in %s', self.server_auth)
+            raise Return(False)
+        
+        self.log('Authenticate with %s', mechanism_class.name)
+        mechanism = mechanism_class(self.jid.user, self.password, self.jid.host)
+        
+        # Start the SASL exchange
+        with self.instrumentation.phase('sasl'):
+            initial = mechanism.initial_response()
+            if initial is None:
+                xml_stanza = self.wrap_stanza_body(SASL_AUTH.render(mechanism=mechanism.name))
+            else:
+                xml_stanza = self.wrap_stanza_body(SASL_AUTH_INITIAL.render(mechanism=mechanism.name, initial=b64encode(initial) or '='))
+            with self.instrumentation.phase('sasl-step'):
+                data = yield xml_stanza
+            
+            # Answer the challenges
+            challenge = data.body.find('challenge', NS_SASL)
+            try:
+                while challenge is not None:
+                    decoded = b64decode(challenge.text)
+                    self.log('Decoded challenge: %s', decoded)
+                    
+                    # Prepare the response
+                    response = b64encode(mechanism.respond(decoded))
+                    self.log('Reponse to challenge: %s', response)
+                    xml_stanza = self.wrap_stanza_body(SASL_RESPONSE.render(response=response))
+                    with self.instrumentation.phase('sasl-step'):
+                        data = yield xml_stanza
+                    challenge = data.body.find('challenge', NS_SASL)
+            except SASLError, e:
+                self.log('Authentication failed: %s', e)
+                raise Return(False)
+            
+            # Check if we succeed the handshake (and if the server is the one
+            # who knows the password)
+            success = data.body.find('success', NS_SASL)
+        if success is not None and mechanism.verify(b64decode(success.text)):
+            # Oh yeah it rocks!
+            self.log('Authentication succeeded!')
+        else:
+            # Shit. So bad :( so just read the code, fix the problem and
+            # commit !
+            self.log('Authentication failed!')
+            raise Return(False)
+        
+        # Restart the stream, bind the resource and establish the IM
+        # session. These requests don't depend on each other's response,
+        # so they are sent as one pipelinable batch.
+        self.log('Asking the server to restart the stream, binding the resource %s and establishing the IM session', self.resource)
+        xml_stanzas = [
+            self.wrap_stanza_body('', RESTART.render(to=self.jid.host), rid=self.rid),
+            self.wrap_stanza_body(BIND.render(resource=self.resource), rid=self.rid + 1),
+            self.wrap_stanza_body(IM_SESSION, rid=self.rid + 2),
+        ]
+        with self.instrumentation.phase('restart-bind-session'):
+            data = yield xml_stanzas
+        for response in data:
+            jid = response and response.body.find('jid', NS_BIND)
+            if jid is not None and jid.text:
+                self.bound_jid = jid.text
+        self.log('The resource got bound to: %s', self.bound_jid)
+        self.log('IM session established')
+        self.authenticated = True
+
+        raise Return(True)
+
+    def prebind(self):
+        """
+        Create and authenticate a session, then hand it over: returns
+        (jid, sid, rid) for a browser client to attach to the session (the
+        next request must use that rid), or None if the login failed.
+        The HTTP connection is closed, the client must not be used anymore.
+        
+        >>> from boshbench import FakeBOSHServer
+        >>> server = FakeBOSHServer(users={'essai': 'essai'}).start()
+        >>> client = BOSHClient(server.url, 'essai@localhost', 'essai', debug=False)
+        >>> jid, sid, rid = client.prebind()
+        >>> jid, rid == client.rid
+        (u'essai@localhost/web', True)
+        >>> BOSHClient(server.url, 'essai@localhost', 'wrong', debug=False).prebind() is None
+        True
+        >>> server.stop()
+        """
+        self.init_connection()
+        try:
+            if self.request_bosh_session() == 0 or not self.authenticate_xmpp():
+                return None
+        finally:
+            self.close_connection()
+        return (self.bound_jid, self.sid, self.rid)
+    
+    def resume(self):
+        """
+        Take over the session saved in the session_store with a single
+        request or, if it's gone, log in again. The logins are retried
+        with a jittered backoff, so that the clients of the restarted
+        processes don't all hit the server at once.
+        The connection must be opened (see init_connection).
+        Returns True once the session is usable (resumed tells whether it's
+        the saved one), False if the authentication failed. Raises a
+        ConnectionError if the server stays unreachable.
+        
+        >>> from boshbench import FakeBOSHServer
+        >>> server = FakeBOSHServer(users={'essai': 'essai'}).start()
+        >>> store = SQLiteSessionStore(':memory:')
+        >>> def restart():
+        ...     client = BOSHClient(server.url, 'essai@localhost', 'essai', debug=False)
+        ...     client.session_store = store
+        ...     client.init_connection()
+        ...     return client
+        >>> client = restart()
+        >>> client.resume(), client.resumed
+        (True, False)
+        >>> info = client.xmpp_disco_items().result()
+        >>> client = restart()
+        >>> client.resume(), client.resumed, client.sid == store.load(client.session_key()).sid
+        (True, True, True)
+        
+        A session the server dropped meanwhile is replaced:
+        
+        >>> server.sessions.clear()
+        >>> client = restart()
+        >>> client.resume(), client.resumed
+        (True, False)
+        >>> client.close_connection()
+        >>> server.stop()
+        """
+        key = self.session_key()
+        state = self.session_store.load(key)
+        self.resumed = False
+        error = None
+        if state is not None:
+            try:
+                self.resumed = self.run_flow(self.resume_flow(state))
+            except (ConnectionError, socket.error, httplib.HTTPException), e:
+                self.log('Cannot resume the session: %s', e)
+                error = e
+            if self.resumed:
+                return True
+            self.session_store.delete(key)
+        for attempt in xrange(self.login_retries + 1):
+            if attempt:
+                time.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_max))
+            try:
+                if error is not None:
+                    self.close_connection()
+                    self.init_connection()
+                self.set_rid()
+                self.sid = None
+                if self.request_bosh_session() == 0:
+                    error = ConnectionError('The session was refused')
+                    continue
+                if not self.authenticate_xmpp():
+                    return False
+                self.checkpoint()
+                return True
+            except (ConnectionError, socket.error, httplib.HTTPException), e:
+                self.log('Login attempt %d failed: %s', attempt + 1, e)
+                error = e
+        raise ConnectionError('Cannot log in after %d attempts: %s' % (self.login_retries + 1, error))
+    
+    def resume_flow(self, state):
+        """Flow of resume: take the session of state over with one request (a ping)"""
+        self.log('Resuming the session %s at RID %s', state.sid, state.rid)
+        self.sid = state.sid
+        self.rid = self.initial_rid = state.rid
+        self.server_wait, self.server_hold, self.server_requests = state.wait, state.hold, state.requests
+        self.authid = state.authid
+        self.bound_jid = state.jid
+        with self.instrumentation.phase('resume'):
+            data = yield self.wrap_stanza_body(PING.render(to=self.jid.host, id='ping_1'))
+        if not data or data.body.get('type') == 'terminate':
+            self.log('The session is gone')
+            self.sid = None
+            raise Return(False)
+        self.authenticated = True
+        # The other stanzas waiting on the session
+        self.dispatcher.dispatch_body(data.body)
+        raise Return(True)
+    
+    def disconnect(self):
+        """Gracefully terminate the session"""
+        return self.run_flow(self.disconnect_flow())
+    
+    def disconnect_flow(self):
+        """Flow of disconnect"""
+        self.log("Terminating the XMPP session")
+        # The stanzas still waiting to be coalesced go with the terminate
+        self.cancel_flush()
+        xml_stanza = self.wrap_stanza_body(self.dispatcher.flush() + UNAVAILABLE, "type='terminate'")
+        with self.instrumentation.phase('disconnect'):
+            yield xml_stanza
+        self.authenticated = False
+        if self.session_store is not None:
+            self.session_store.delete(self.session_key())
+        self.instrumentation.record_session(self.rid - self.initial_rid)
+        self.log("Session terminated")
+        
+        
+class BalancedBOSHClient(BOSHClient):
+    """
+    BOSHClient spreading its sessions over several connection managers.
+    init_connection() picks an endpoint from the balancer (a list of URLs or
+    an EndpointBalancer shared by many clients) and the session stays
+    pinned to it: a BOSH session only lives on the connection manager that
+    created it. The load of an endpoint is the number of clients connected
+    to it.
+    
+    Connecting and requesting the session fail over to another endpoint,
+    trying at most retries other endpoints; prebind() also starts the whole
+    login again elsewhere if the pinned endpoint fails in the middle. Every
+    request feeds the latency and the circuit breaker of its endpoint.
+    
+    >>> from boshbench import FakeBOSHServer
+    >>> servers = [FakeBOSHServer(users={'essai': 'essai'}).start() for i in xrange(3)]
+    >>> servers[0].stop()
+    >>> balancer = EndpointBalancer([server.url for server in servers])
+    >>> client = BalancedBOSHClient(balancer, 'essai@localhost', 'essai', debug=False)
+    >>> jid, sid, rid = client.prebind()
+    >>> [server.url for server in servers].index(client.endpoint.url), client.failed
+    (1, [])
+    
+    An endpoint dropping a request is left for another one:
+    
+    >>> servers[2].drop = 1
+    >>> client = BalancedBOSHClient(balancer, 'essai@localhost', 'essai', debug=False)
+    >>> client.prebind()[0]
+    u'essai@localhost/web'
+    >>> [server.url for server in servers].index(client.endpoint.url), balancer.stats()[servers[2].url]['failures']
+    (1, 1)
+    >>> for server in servers[1:]:
+    ...     server.stop()
+    """
+    
+    FAILURES = (ConnectionError, socket.error, httplib.HTTPException)
+    
+    def __init__(self, endpoints, jid='', password='', resource='web', debug=True, pool=None, instrumentation=None, retries=2):
+        if not isinstance(endpoints, EndpointBalancer):
+            endpoints = EndpointBalancer(endpoints)
+        self.balancer = endpoints
+        self.retries = retries
+        # The endpoint of the session, whether this client is counted in its
+        # load, and the endpoints which failed during the login (prebinding:
+        # the login is prebind's, which tries again elsewhere)
+        self.endpoint = None
+        self.counted = False
+        self.failed = []
+        self.prebinding = False
+        BOSHClient.__init__(self, self.balancer.endpoints[0].url, jid, password, resource, debug, pool, instrumentation)
+    
+    def drop_endpoint(self):
+        """
+        Give up the pinned endpoint (and the session on it) after a failure.
+        Raises ConnectionError once too many endpoints failed.
+        """
+        self.log('Endpoint %s failed', self.endpoint.url)
+        self.close_poll_connection()
+        if self.connection is not None:
+            if self.pool is not None:
+                self.pool.release(self.connection, reusable=False)
+                self.connection = None
+            else:
+                self.connection.close()
+        if self.counted:
+            self.balancer.release(self.endpoint)
+            self.counted = False
+        self.failed.append(self.endpoint)
+        self.endpoint = None
+        self.sid = None
+        self.set_rid()
+        if len(self.failed) > self.retries:
+            raise ConnectionError('%d BOSH endpoints failed' % len(self.failed))
+    
+    def init_connection(self):
+        """Connect to the pinned endpoint, or pick one (failing over if it's down)"""
+        while True:
+            if self.endpoint is None:
+                self.endpoint = self.balancer.acquire(exclude=self.failed)
+                self.bosh_service = self.endpoint.service
+            elif not self.counted:
+                self.balancer.attach(self.endpoint)
+            self.counted = True
+            try:
+                return BOSHClient.init_connection(self)
+            except ConnectionError:
+                self.balancer.record_failure(self.endpoint)
+                self.drop_endpoint()
+    
+    def close_connection(self):
+        """Close the HTTP connection, the session stays pinned"""
+        BOSHClient.close_connection(self)
+        if self.counted:
+            self.balancer.release(self.endpoint)
+            self.counted = False
+    
+    def send_request(self, xml_stanza):
+        started = time.time()
+        try:
+            data = BOSHClient.send_request(self, xml_stanza)
+        except self.FAILURES:
+            self.balancer.record_failure(self.endpoint)
+            raise
+        if data is False:
+            self.balancer.record_failure(self.endpoint)
+        else:
+            self.balancer.record_success(self.endpoint, time.time() - started)
+        return data
+    
+    def request_bosh_session(self):
+        """Request the BOSH session, on another endpoint if the pinned one fails"""
+        while True:
+            try:
+                result = BOSHClient.request_bosh_session(self)
+            except self.FAILURES:
+                self.drop_endpoint()
+                self.init_connection()
+            else:
+                if not self.prebinding:
+                    # Those can take the next session again
+                    self.failed = []
+                return result
+    
+    def prebind(self):
+        """
+        Like BOSHClient.prebind, starting again on another endpoint when the
+        pinned one fails. The endpoint of the session is self.endpoint.
+        """
+        self.failed = []
+        self.prebinding = True
+        try:
+            while True:
+                try:
+                    return BOSHClient.prebind(self)
+                except self.FAILURES:
+                    if self.endpoint is None:
+                        raise
+                    self.drop_endpoint()
+        finally:
+            self.prebinding = False
+            self.failed = []
+    
+    def disconnect(self):
+        """Terminate the session and unpin it"""
+        try:
+            return BOSHClient.disconnect(self)
+        finally:
+            if self.counted:
+                self.balancer.release(self.endpoint)
+                self.counted = False
+            self.endpoint = None
+            self.failed = []
+
+
+class CachedSession(SessionState):
+    """SessionState of a SessionCache: with the password digest and the expiration time"""
+    
+    __slots__ = ('digest', 'expires')
+
+
+class SessionCache:
+    """
+    Per-user cache of prebound sessions, so the repeated page loads of a
+    user reuse a live SID instead of logging in again.
+    Sessions expire after ttl seconds without use (keep it below the
+    inactivity of the connection manager) and the least recently used ones
+    are dropped beyond max_size.
+    
+    The browser client advances the RID: report its last RID with
+    update_rid() (when the page unloads for instance), so the next page gets
+    a RID the connection manager accepts.
+    
+    >>> from boshbench import FakeBOSHServer
+    >>> server = FakeBOSHServer(users={'essai': 'essai'}).start()
+    >>> cache = SessionCache(server.url, ttl=50, pool=ConnectionPool())
+    >>> jid, sid, rid = cache.get('essai@localhost', 'essai')
+    >>> cache.update_rid('essai@localhost', rid + 3)
+    >>> cache.get('essai@localhost', 'essai') == (jid, sid, rid + 3)
+    True
+    >>> cache.get('essai@localhost', 'wrong') is None
+    True
+    >>> cache.get('essai@localhost', 'essai')[1] == sid
+    True
+    >>> server.stop()
+    """
+    
+    def __init__(self, bosh_service, max_size=1000, ttl=50, resource='web', pool=None):
+        self.bosh_service = bosh_service
+        self.max_size = max_size
+        self.ttl = ttl
+        self.resource = resource
+        self.pool = pool
+        self.lock = threading.Lock()
+        # jid -> CachedSession
+        self.sessions = collections.OrderedDict()
+        # Key of the password digests, so the passwords aren't kept around
+        self.secret = os.urandom(16)
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'evictions': 0,
+        }
+    
+    def password_digest(self, password):
+        return hmac.new(self.secret, utf8(password), hashlib.sha256).digest()
+    
+    def get(self, jid, password):
+        """
+        Return (bound jid, sid, rid) of a live session of the user, prebinding
+        a new one if needed. Returns None if the authentication failed.
+        """
+        digest = self.password_digest(password)
+        self.lock.acquire()
+        try:
+            session = self.sessions.get(jid)
+            if session is not None:
+                if session.expires < time.time():
+                    del self.sessions[jid]
+                    self.counters['expired'] += 1
+                elif hmac.compare_digest(session.digest, digest):
+                    # Move it to the most recently used end
+                    del self.sessions[jid]
+                    session.expires = time.time() + self.ttl
+                    self.sessions[jid] = session
+                    self.counters['hits'] += 1
+                    return (session.jid, session.sid, session.rid)
+            self.counters['misses'] += 1
+        finally:
+            self.lock.release()
+        
+        client = BOSHClient(self.bosh_service, jid, password, self.resource, debug=False, pool=self.pool)
+        prebound = client.prebind()
+        if prebound is None:
+            return None
+        session = CachedSession(client.bosh_service, client.bound_jid, client.sid, client.rid,
+                                int(client.server_wait or 60), client.server_hold, client.server_requests)
+        session.digest = digest
+        session.expires = time.time() + self.ttl
+        self.lock.acquire()
+        try:
+            self.sessions.pop(jid, None)
+            self.sessions[jid] = session
+            while len(self.sessions) > self.max_size:
+                self.sessions.popitem(last=False)
+                self.counters['evictions'] += 1
+        finally:
+            self.lock.release()
+        return prebound
+    
+    def update_rid(self, jid, rid):
+        """Record the last RID used by the browser and refresh the session"""
+        self.lock.acquire()
+        try:
+            session = self.sessions.get(jid)
+            if session is not None and rid > session.rid:
+                session.rid = rid
+                session.expires = time.time() + self.ttl
+        finally:
+            self.lock.release()
+    
+    def invalidate(self, jid):
+        """Forget the session of the user (logout, terminated session...)"""
+        self.lock.acquire()
+        try:
+            self.sessions.pop(jid, None)
+        finally:
+            self.lock.release()
+    
+    def stats(self):
+        """Return the cache counters and its size"""
+        self.lock.acquire()
+        try:
+            stats = dict(self.counters)
+            stats['size'] = len(self.sessions)
+            return stats
+        finally:
+            self.lock.release()
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel: adding and expiring a timer are O(1) whatever the
+    number of timers, they expire within a tick of their time. A timer due
+    beyond a turn of the wheel waits in its slot for the right turn.
+    
+    >>> wheel = TimerWheel(tick=1, size=8, now=0)
+    >>> wheel.add(2.5, 'a')
+    >>> wheel.add(20, 'b')
+    >>> wheel.expire(3)
+    ['a']
+    >>> wheel.expire(19), wheel.expire(21), len(wheel)
+    ([], ['b'], 0)
+    """
+    
+    def __init__(self, tick=0.1, size=512, now=None):
+        self.tick = tick
+        self.size = size
+        self.slots = [[] for i in xrange(size)]
+        if now is None:
+            now = time.time()
+        # The last tick expired
+        self.current = int(now / tick)
+        self.count = 0
+    
+    def add(self, when, item):
+        """Add a timer: item expires at the time when"""
+        tick = max(int(math.ceil(when / self.tick)), self.current + 1)
+        self.slots[tick % self.size].append((tick, item))
+        self.count += 1
+    
+    def expire(self, now):
+        """Return the items of the timers due at now"""
+        target = int(now / self.tick)
+        due = []
+        for i in xrange(1, min(target - self.current, self.size) + 1):
+            slot = self.slots[(self.current + i) % self.size]
+            if slot:
+                waiting = []
+                for entry in slot:
+                    if entry[0] <= target:
+                        due.append(entry[1])
+                    else:
+                        waiting.append(entry)
+                slot[:] = waiting
+        self.current = max(self.current, target)
+        self.count -= len(due)
+        return due
+    
+    def __len__(self):
+        return self.count
+
+
+class KeepaliveScheduler:
+    """
+    Keeps many idle BOSHClient sessions alive with as few requests as
+    possible. A thread expires the next polls of the sessions on a
+    TimerWheel, workers run them (client.poll(), which also sends the
+    stanzas queued on the client). A poll goes on the second connection
+    BOSH allows, so the client is not blocked while the server holds it.
+    A session is polled once it has been idle (no response) for its
+    interval. The interval starts at a safe fraction of the inactivity the
+    server allows and goes down to the server's polling interval when the
+    polls bring stanzas back, then doubles again with every empty poll.
+    Every poll is jittered, so the sessions added together spread out.
+    The requests of the client itself reset its idle time: no poll is
+    sent while the client is busy.
+    A poll may be held by the server for up to its wait: keep enough
+    workers for the polls held at the same time (or ask for a shorter
+    wait, see BOSHClient.wait).
+    
+    Here the server holds the polls for 1 second, and terminates the
+    sessions idle for 2 seconds:
+    
+    >>> from boshbench import FakeBOSHServer
+    >>> server = FakeBOSHServer(users={'essai': 'essai'}).start()
+    >>> server.wait, server.polling, server.inactivity = 1, 0.5, 2
+    >>> expired = []
+    >>> scheduler = KeepaliveScheduler(workers=2, on_expired=expired.append).start()
+    >>> client = BOSHClient(server.url, 'essai@localhost', 'essai', debug=False)
+    >>> client.init_connection()
+    >>> client.request_bosh_session()
+    >>> success = client.authenticate_xmpp()
+    >>> scheduler.add(client)
+    >>> time.sleep(4)
+    >>> client.sid in server.sessions, scheduler.stats()['polls'] > 0
+    (True, True)
+    
+    A session the server terminated is reported, then forgotten:
+    
+    >>> server.sessions.clear()
+    >>> time.sleep(3)
+    >>> expired == [client], scheduler.stats()['sessions']
+    (True, 0)
+    >>> scheduler.stop()
+    >>> client.close_connection()
+    >>> server.stop()
+    """
+    
+    def __init__(self, workers=10, tick=0.1, jitter=0.2, safety=0.5, min_interval=1.0, inactivity=30, on_expired=None):
+        """
+        safety is the fraction of the inactivity waited at most between two
+        polls, inactivity the one assumed when the server didn't tell.
+        on_expired(client) is called when a session is over (then removed).
+        """
+        self.workers = workers
+        self.jitter = jitter
+        self.safety = safety
+        self.min_interval = min_interval
+        self.inactivity = inactivity
+        self.on_expired = on_expired
+        self.wheel = TimerWheel(tick)
+        self.lock = threading.Lock()
+        # client -> [interval, generation]; the timers of an older
+        # generation are ignored
+        self.sessions = {}
+        self.polls = Queue.Queue()
+        self.stopped = threading.Event()
+        self.threads = []
+        self.counters = {
+            'polls': 0,
+            'empty': 0,
+            'deferred': 0,
+            'expired': 0,
+        }
+    
+    def start(self):
+        """Start the timer thread and the workers. Returns the scheduler."""
+        self.threads = [threading.Thread(target=self.run)] + [threading.Thread(target=self.work) for i in xrange(self.workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        return self
+    
+    def stop(self):
+        """Stop polling (the polls in progress end)"""
+        self.stopped.set()
+        for thread in self.threads[1:]:
+            self.polls.put(None)
+    
+    def add(self, client):
+        """Keep the (authenticated) session of client alive"""
+        with self.lock:
+            entry = self.sessions[client] = [self.max_interval(client), 0]
+            self.schedule(client, entry, (client.last_response or time.time()) + self.jittered(entry[0]))
+    
+    def remove(self, client):
+        """Stop polling for client (a poll in progress ends)"""
+        with self.lock:
+            self.sessions.pop(client, None)
+    
+    def min_interval_of(self, client):
+        return max(client.server_polling or 0, self.min_interval)
+    
+    def max_interval(self, client):
+        return max((client.server_inactivity or self.inactivity) * self.safety, self.min_interval_of(client))
+    
+    def jittered(self, interval):
+        """Shortened by up to jitter of it, never longer"""
+        return interval * (1 - random.uniform(0, self.jitter))
+    
+    def schedule(self, client, entry, when):
+        # Called with the lock
+        entry[1] += 1
+        self.wheel.add(when, (client, entry[1]))
+    
+    def run(self):
+        """Timer thread: hand the due polls to the workers"""
+        while not self.stopped.wait(self.wheel.tick):
+            now = time.time()
+            with self.lock:
+                for client, generation in self.wheel.expire(now):
+                    entry = self.sessions.get(client)
+                    if entry is None or entry[1] != generation:
+                        continue
+                    idle_since = client.last_response or now
+                    if idle_since + entry[0] * (1 - self.jitter) > now:
+                        # The client made requests meanwhile. Compared with
+                        # the shortest jittered interval, so the next poll
+                        # is never in the past.
+                        self.schedule(client, entry, max(now, idle_since + self.jittered(entry[0])))
+                    else:
+                        self.polls.put(client)
+    
+    def work(self):
+        """Worker thread: poll the sessions"""
+        while True:
+            client = self.polls.get()
+            if client is None:
+                break
+            if not client.request_lock.acquire(False):
+                # Busy with its own request: that keeps it alive
+                with self.lock:
+                    self.counters['deferred'] += 1
+                    entry = self.sessions.get(client)
+                    if entry is not None:
+                        self.schedule(client, entry, time.time() + self.jittered(entry[0]))
+                continue
+            client.request_lock.release()
+            received = client.received
+            try:
+                alive = client.poll()
+            except Exception, e:
+                if self.stopped.is_set():
+                    break
+                logger.warning('Keepalive poll of %s failed: %s', client.bound_jid, e)
+                alive = False
+            self.polled(client, alive, client.received > received)
+    
+    def polled(self, client, alive, traffic):
+        """Adapt the interval of client after a poll and schedule the next one"""
+        with self.lock:
+            self.counters['polls'] += 1
+            entry = self.sessions.get(client)
+            if not alive:
+                self.counters['expired'] += 1
+                self.sessions.pop(client, None)
+            elif entry is not None:
+                if traffic:
+                    entry[0] = self.min_interval_of(client)
+                else:
+                    self.counters['empty'] += 1
+                    entry[0] = min(entry[0] * 2, self.max_interval(client))
+                self.schedule(client, entry, time.time() + self.jittered(entry[0]))
+        if not alive and entry is not None and self.on_expired is not None:
+            self.on_expired(client)
+    
+    def stats(self):
+        """Return the counters, the number of sessions and of pending polls"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats['sessions'] = len(self.sessions)
+            stats['timers'] = len(self.wheel)
+            return stats
+
+
+class FormError(ValueError):
+    """Error raised when a data form can't be filled"""
+    pass
+
+
+FormField = collections.namedtuple('FormField', 'var type label values required options')
+
+
+class DataForm:
+    """
+    Data form (http://xmpp.org/extensions/xep-0004.html): a form to fill
+    (type 'form'), the filled one ('submit') or a 'result'. Its fields are
+    FormField, their values are lists of strings.
+    
+    >>> form = parse_form(parse_body("<body xmlns='http://jabber.org/protocol/httpbind'><x xmlns='jabber:x:data' type='form'>"
+    ...     "<title>Adding a User</title><field type='hidden' var='FORM_TYPE'><value>http://jabber.org/protocol/admin</value></field>"
+    ...     "<field type='jid-single' var='accountjid'><required/></field><field type='boolean' var='notify'/></x></body>").children[0])
+    >>> form.title, form.get('FORM_TYPE')
+    (u'Adding a User', u'http://jabber.org/protocol/admin')
+    >>> print form.fill({'accountjid': 'me@debian', 'notify': True}).string()
+    <x xmlns='jabber:x:data' type='submit'><field var='FORM_TYPE' type='hidden'><value>http://jabber.org/protocol/admin</value></field><field var='accountjid'><value>me@debian</value></field><field var='notify'><value>1</value></field></x>
+    >>> form.fill({})
+    Traceback (most recent call last):
+        ...
+    FormError: The field accountjid is required
+    """
+    
+    def __init__(self, type='form', fields=(), title=None, instructions=()):
+        self.type = type
+        self.fields = list(fields)
+        self.title = title
+        self.instructions = list(instructions)
+    
+    def field(self, var):
+        """Return the FormField var, or None"""
+        for field in self.fields:
+            if field.var == var:
+                return field
+        return None
+    
+    def get(self, var, default=None):
+        """Return the (first) value of the field var"""
+        field = self.field(var)
+        if field is None or not field.values:
+            return default
+        return field.values[0]
+    
+    def values(self):
+        """Return a dict var -> value, a list of values for the *-multi fields"""
+        return dict([(field.var, field.type.endswith('-multi') and field.values or (field.values or [None])[0])
+                     for field in self.fields if field.var])
+    
+    def fill(self, values=None, **kwargs):
+        """
+        Return the submit form answering this one: with the given values (a
+        dict and/or keywords arguments) or the default ones. The values of
+        the fields this form doesn't have are ignored. Raises FormError if
+        a required field is missing.
+        """
+        values = dict(values or {}, **kwargs)
+        fields = []
+        for field in self.fields:
+            if field.type == 'fixed' or not field.var:
+                continue
+            if field.var in values:
+                value = values[field.var]
+                if not isinstance(value, (list, tuple)):
+                    value = [value]
+                submitted = []
+                for item in value:
+                    if isinstance(item, bool):
+                        item = item and '1' or '0'
+                    elif not isinstance(item, basestring):
+                        item = unicode(item)
+                    submitted.append(item)
+            else:
+                submitted = field.values
+            if field.required and not submitted:
+                raise FormError('The field %s is required' % field.var)
+            fields.append(FormField(field.var, field.type, None, submitted, False, []))
+        return DataForm('submit', fields)
+    
+    def write(self, builder):
+        """Write this form into a StanzaBuilder"""
+        builder.start('x', (('xmlns', NS_DATA), ('type', self.type)))
+        if self.title:
+            builder.element('title', self.title)
+        for instructions in self.instructions:
+            builder.element('instructions', instructions)
+        for field in self.fields:
+            attrs = []
+            if field.var:
+                attrs.append(('var', field.var))
+            # The submitted fields don't need their type, except FORM_TYPE
+            if field.type and (self.type != 'submit' or field.type == 'hidden'):
+                attrs.append(('type', field.type))
+            if field.label:
+                attrs.append(('label', field.label))
+            builder.start('field', attrs)
+            if field.required:
+                builder.empty('required')
+            for value in field.values:
+                builder.element('value', value)
+            for label, value in field.options:
+                builder.start('option', label and (('label', label),) or ()).element('value', value).end()
+            builder.end()
+        return builder.end()
+    
+    def string(self):
+        return self.write(StanzaBuilder()).getvalue()
+    
+    def __repr__(self):
+        return '<DataForm %s %s: %d fields>' % (self.type, self.get('FORM_TYPE'), len(self.fields))
+
+
+def parse_form(x):
+    """DataForm of an <x xmlns='jabber:x:data'/> Element (None if x is None)"""
+    if x is None:
+        return None
+    title = None
+    instructions = []
+    fields = []
+    for child in x.children:
+        if child.name == 'title':
+            title = child.text
+        elif child.name == 'instructions':
+            instructions.append(child.text)
+        elif child.name == 'field':
+            values = []
+            options = []
+            required = False
+            for item in child.children:
+                if item.name == 'value':
+                    values.append(item.text)
+                elif item.name == 'required':
+                    required = True
+                elif item.name == 'option':
+                    value = item.find('value')
+                    options.append((item.get('label') or None, value is not None and value.text or u''))
+            fields.append(FormField(child.get('var') or None, child.get('type') or 'text-single',
+                                    child.get('label') or None, values, required, options))
+    return DataForm(x.get('type') or 'form', fields, title, instructions)
+
+
+# Errors of a command refusing the form in its execute request
+COMMAND_REFUSALS = frozenset(['bad-request', 'unexpected-request', 'feature-not-implemented'])
+
+
+class CommandSession:
+    """
+    One run of an ad-hoc command (http://xmpp.org/extensions/xep-0050.html)
+    of jid, stage by stage: stanza() gives the next request, handle() takes
+    its reply, until done. The form of every stage is filled with values
+    (see DataForm.fill). Given the form template of the command (see
+    FormCache), the values are submitted in the first request already;
+    if the command refuses it, the form is fetched first (refused tells).
+    Once done, the command succeeded if status is 'completed' and error
+    None; form is the last form received (the result).
+    
+    >>> session = CommandSession('debian', NS_ADMIN + '#get-registered-users-num')
+    >>> stanza = session.stanza('c-1', 'me@debian/boshclient')
+    >>> session.handle(parse_body("<body xmlns='http://jabber.org/protocol/httpbind'><iq type='result' id='c-1'>"
+    ...     "<command xmlns='http://jabber.org/protocol/commands' status='completed'><x xmlns='jabber:x:data' type='result'>"
+    ...     "<field var='registeredusersnum'><value>10</value></field></x></command></iq></body>").children[0])
+    >>> session.done, session.status, session.form.get('registeredusersnum')
+    (True, u'completed', u'10')
+    """
+    
+    def __init__(self, jid, node, values=None, template=None):
+        self.jid = jid
+        self.node = node
+        self.values = values or {}
+        self.template = template
+        self.sessionid = None
+        self.status = None
+        self.form = None
+        # Form of the first stage, if it had to be fetched
+        self.first_form = None
+        self.error = None
+        self.done = False
+        self.refused = False
+        self.stages = 0
+        # The next request
+        self.action = 'execute'
+        self.submit = None
+        if template is not None:
+            try:
+                self.submit = template.fill(self.values)
+                self.action = 'complete'
+            except FormError:
+                pass
+    
+    def stanza(self, id, sender):
+        """The <iq/> of the next request, sent by sender (a full JID)"""
+        command = AdHocCommand(sender, id=id, to=self.jid, type='set')
+        attrs = {'xmlns': NS_COMMANDS, 'node': self.node, 'action': self.action}
+        if self.sessionid:
+            attrs['sessionid'] = self.sessionid
+        command.set_command(**attrs)
+        command.set_form(self.submit)
+        return command.string()
+    
+    def handle(self, iq):
+        """Take the reply to the last request into account (None: no reply)"""
+        self.stages += 1
+        one_shot = self.sessionid is None and self.submit is not None
+        if iq is None:
+            return self.fail('timeout')
+        if iq.get('type') != 'result':
+            if one_shot and stanza_error(iq) in COMMAND_REFUSALS:
+                self.refused = True
+                self.action = 'execute'
+                self.submit = None
+                return
+            return self.fail(stanza_error(iq) or 'unexpected-reply')
+        command = iq.find('command', NS_COMMANDS)
+        if command is None:
+            return self.fail('unexpected-reply')
+        self.sessionid = command.get('sessionid') or self.sessionid
+        self.status = command.get('status')
+        self.form = parse_form(command.find('x', NS_DATA))
+        self.submit = None
+        if self.status != 'executing' or self.action == 'cancel':
+            self.done = True
+            return
+        if self.stages == 1:
+            self.first_form = self.form
+        
+        # The default action of the stage, or the one allowed
+        actions = command.find('actions', NS_COMMANDS)
+        allowed = actions is not None and [child.name for child in actions.children] or []
+        if actions is not None and actions.get('execute'):
+            self.action = actions.get('execute')
+        elif not allowed or 'complete' in allowed:
+            self.action = 'complete'
+        else:
+            self.action = 'next'
+        if self.form is not None:
+            try:
+                self.submit = self.form.fill(self.values)
+            except FormError, e:
+                # Tell the server the command is abandoned
+                self.error = str(e)
+                self.action = 'cancel'
+    
+    def fail(self, error):
+        self.error = error
+        self.done = True
+    
+    def __repr__(self):
+        return '<CommandSession %s %s: %s>' % (self.node, self.sessionid, self.error or self.status)
+
+
+class FormCache:
+    """
+    Form templates of the ad-hoc commands by jid and node, shared by all
+    the clients (see FORM_CACHE): commands run with the template submit
+    their values in their first request, which saves the round trip that
+    fetches the form. The commands refusing that are remembered, they get
+    no template.
+    """
+    
+    def __init__(self, ttl=3600, max_size=1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # (jid, node) -> [DataForm or None (refused), expiration time]
+        self.forms = collections.OrderedDict()
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'refused': 0,
+        }
+    
+    def get(self, jid, node):
+        """Cached template of the command node of jid, or None"""
+        with self.lock:
+            entry = self.forms.get((jid, node))
+            if entry is not None and entry[1] < time.time():
+                del self.forms[(jid, node)]
+                entry = None
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            self.counters[entry[0] is None and 'refused' or 'hits'] += 1
+            return entry[0]
+    
+    def learn(self, session):
+        """Remember the template of a CommandSession, or that its command refuses one"""
+        key = (session.jid, session.node)
+        with self.lock:
+            if session.refused:
+                self.forms.pop(key, None)
+                self.forms[key] = [None, time.time() + self.ttl]
+            elif session.first_form is not None and session.template is None and key not in self.forms:
+                self.forms[key] = [session.first_form, time.time() + self.ttl]
+            else:
+                return
+            while len(self.forms) > self.max_size:
+                self.forms.popitem(last=False)
+    
+    def invalidate(self, jid, node):
+        with self.lock:
+            self.forms.pop((jid, node), None)
+    
+    def stats(self):
+        """Return the cache counters and its size"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats['size'] = len(self.forms)
+            return stats
+
+
+# Shared by all the clients, unless they get their own
+FORM_CACHE = FormCache()
+
+
+class AdminBOSHClient(BOSHClient):
+    """
+    This is an extended version of the BOSHClient with all the administration
+    functions, such as ad-hoc commands
+    (http://xmpp.org/extensions/xep-0050.html) for administration uses:
+    http://xmpp.org/extensions/xep-0133.html.
+    Be careful: if you use AdminBOSHClient and the user that you log in isn't
+    and administrator, all your commands will return the tuple:
+    (-1,'Your are not an administrator)
+    Have fun.
+    
     
-    >>> client = BOSHClient('http://debian/http-bind/', 'essai@debian', 'essai', resource='web', debug=False)
+    >>> from boshbench import FakeBOSHServer
+    >>> server = FakeBOSHServer(users={'thomas': 'password', 'essai': 'essai'}).start()
+    >>> client = AdminBOSHClient(server.url, jid='thomas@localhost', password='password', resource='boshclient', debug=False)
     >>> client.init_connection()
     >>> client.request_bosh_session()
     >>> sid = client.authenticate_xmpp()
+    >>> client.get_registred_users().result()
+    2
+    >>> client.execute(NS_ADMIN + '#add-user', {'accountjid': 'me@localhost', 'password': 'x', 'password-verify': 'x'}).status
+    u'completed'
+    >>> client.get_registred_users().result()
+    3
     >>> client.close_connection()
+    >>> server.stop()
     """
     
-    def __init__(self, bosh_service, jid='', password='', resource='web', debug=True):
+    # Form templates of the commands, shared with the other clients
+    form_cache = FORM_CACHE
+    
+    def __init__(self, bosh_service, jid='', password='', resource='boshclient', debug=True, pool=None, instrumentation=None):
+        """Initialize the client, just like the BOSHClient"""
+        BOSHClient.__init__(self, bosh_service, jid, password, resource, debug, pool, instrumentation)
+    
+    def get_id(self, name):
         """
-        Initialize the client.
-        You must specify the Jabber ID, the corresponding password and the URL
-        of the BOSH service to connect to.
+        Increases the command counter and returns the id field.
+        """
+        return self.dispatcher.new_id(name)
+    
+    def command_session(self, node, values=None, jid=None):
+        """CommandSession of the command node of jid (the server by default), with its cached template"""
+        jid = jid or self.jid.host
+        return CommandSession(jid, node, values, self.form_cache.get(jid, node))
+    
+    def execute(self, node, values=None, jid=None):
+        """
+        Run the ad-hoc command node of jid (the server by default) to the
+        end, filling its forms with values. Returns the CommandSession.
+        """
+        return self.execute_many([self.command_session(node, values, jid)])[0]
+    
+    def execute_many(self, sessions):
+        """
+        Run many CommandSession at the same time: the requests of a stage of
+        all the commands go in one <body/>. Returns the sessions.
+        """
+        return self.run_flow(self.commands_flow(sessions))
+    
+    def commands_flow(self, sessions):
+        """Flow of execute_many"""
+        running = list(sessions)
+        while running:
+            builder = StanzaBuilder()
+            ids = {}
+            for session in running:
+                id = self.get_id(session.node.split('#')[-1])
+                ids[id] = session
+                builder.raw(session.stanza(id, self.jid.jid_with_resource))
+            replies = yield self.replies_flow(builder.getvalue(), ids.keys())
+            for id, session in ids.iteritems():
+                session.handle(replies.get(id))
+                self.form_cache.learn(session)
+            running = [session for session in running if not session.done]
+        raise Return(sessions)
+    
+    def add_user(self, username, password):
+        """
+        Create a new user account on the XMPP server.
+        http://xmpp.org/extensions/xep-0133.html#add-user
+        Returns True if the account got created.
         """
+        return self.add_users([(username, password)])[0].success
+    
+    def add_users(self, credentials):
+        """
+        Create many accounts ((username, password) pairs): all the commands
+        are sent in one request, then all the forms in another one (only
+        one request once the form is in the form_cache).
+        Returns a ProvisioningResult per account.
+        """
+        return self.run_flow(self.add_users_flow(credentials))
+    
+    def add_users_flow(self, credentials):
+        """Flow of add_users"""
+        node = NS_ADMIN + '#add-user'
+        usernames = []
+        sessions = []
+        for username, password in credentials:
+            usernames.append(username)
+            if '@' not in username:
+                username = '%s@%s' % (username, self.jid.host)
+            sessions.append(self.command_session(node, {'accountjid': username, 'password': password, 'password-verify': password}))
+        self.log('ADD-USER %d accounts', len(sessions))
+        yield self.commands_flow(sessions)
+        results = []
+        for username, session in zip(usernames, sessions):
+            if session.status == 'completed' and session.error is None:
+                results.append(ProvisioningResult(username, True, None))
+            else:
+                results.append(ProvisioningResult(username, False, session.error or 'unexpected-reply'))
+        raise Return(results)
+    
+    def get_registred_users(self):
+        """
+        Retrieve the number of registred users.
+        http://xmpp.org/extensions/xep-0133.html#get-registered-users-num
+        Returns the Future of the number (None if the command failed), the
+        command is sent with send().
+        """
+        self.log('Retrieving the registred users number')
+        session = CommandSession(self.jid.host, NS_ADMIN + '#get-registered-users-num')
+        id = self.get_id('get-registered-users-num')
+        future = Future()
+        def done(reply):
+            session.handle(reply.result())
+            number = None
+            if session.status == 'completed' and session.form is not None:
+                try:
+                    number = int(session.form.get('registeredusersnum'))
+                except (TypeError, ValueError):
+                    pass
+            future.set_result(number)
+        self.send(session.stanza(id, self.jid.jid_with_resource), id).add_done_callback(done)
+        return future
 
-        self.debug = debug
-        
-        self.connection = None
-        
-        if jid:
-            self.jid = JID(jid, resource)
-        else:
-            self.jid = ''
+
+ProvisioningResult = collections.namedtuple('ProvisioningResult', 'username success error')
+
+
+class BulkProvisioner:
+    """
+    Provision many accounts at once. The credentials ((username, password)
+    pairs) are read lazily from any iterable, even a generator over a huge
+    file, and split in batches of batch_size accounts: every step of a batch
+    is a single <body> carrying all its <iq/>. The batches are spread over
+    `sessions` BOSH sessions working in parallel.
+    
+    mode is 'add-user' (XEP-0133, jid/password must be an administrator) or
+    'register' (XEP-0077 in-band registration; only the host of jid is used
+    and the server must accept several registrations per stream).
+    
+    >>> from boshbench import FakeBOSHServer
+    >>> server = FakeBOSHServer(users={'thomas': 'password', 'user0': 'taken'}).start()
+    >>> provisioner = BulkProvisioner(server.url, 'thomas@localhost', 'password', sessions=4)
+    >>> accounts = (('user%d' % i, 'secret%d' % i) for i in xrange(1000))
+    >>> failed = [result for result in provisioner.provision(accounts) if not result.success]
+    >>> provisioner.stats()['provisioned'], [(result.username, result.error) for result in failed]
+    (999, [('user0', u'conflict')])
+    
+    The accounts of a batch that failed are reported, its connection is
+    closed and the next batch gets a new one:
+    
+    >>> pool = ConnectionPool(max_per_host=1)
+    >>> provisioner = BulkProvisioner(server.url, 'thomas@localhost', 'password', sessions=1, batch_size=2, pool=pool)
+    >>> server.drop = 1
+    >>> [(result.username, result.success) for result in provisioner.provision([('a', 'p'), ('b', 'p'), ('c', 'p')])]
+    [('a', False), ('b', False), ('c', True)]
+    >>> pool.close()
+    
+    An error reading the credentials is raised once the workers are done:
+    
+    >>> def accounts():
+    ...     yield 'd', 'p'
+    ...     raise IOError('truncated file')
+    >>> list(BulkProvisioner(server.url, 'thomas@localhost', 'password', batch_size=1).provision(accounts()))
+    Traceback (most recent call last):
+    IOError: truncated file
+    >>> server.stop()
+    """
+    
+    def __init__(self, bosh_service, jid, password='', sessions=4, batch_size=20, mode='add-user', pool=None):
+        self.bosh_service = bosh_service
+        self.jid = jid
         self.password = password
-        self.bosh_service = urlparse(bosh_service)
-        self.resource = resource
-        
-        self.rid = random.randint(0, 10000000)
-        self.log('Init RID: %s' % self.rid)
-        
-        self.content_type = "text/xml; charset=utf-8"
-        self.headers = {
-            "Content-type": "text/plain; charset=UTF-8",
-            "Accept": "text/xml",
+        self.sessions = sessions
+        self.batch_size = batch_size
+        self.mode = mode
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.counters = {
+            'provisioned': 0,
+            'failed': 0,
+            'batches': 0,
         }
+        # error condition -> number of accounts
+        self.errors = collections.defaultdict(int)
+        self.started = self.finished = None
+        # exc_info of the credentials iterator, if it failed
+        self.error = None
+    
+    def provision(self, credentials):
+        """
+        Provision the accounts. Yields a ProvisioningResult per account, as
+        soon as its batch is done (not in the order of credentials).
+        An exception raised by credentials is raised again after the
+        results of the batches read before it.
+        """
+        batches = Queue.Queue(self.sessions * 2)
+        results = Queue.Queue()
+        self.started = time.time()
+        self.finished = None
+        self.error = None
+        producer = threading.Thread(target=self.produce, args=(credentials, batches))
+        producer.daemon = True
+        producer.start()
+        for i in xrange(self.sessions):
+            worker = threading.Thread(target=self.work, args=(batches, results))
+            worker.daemon = True
+            worker.start()
+        running = self.sessions
+        while running:
+            batch_results = results.get()
+            if batch_results is None:
+                running -= 1
+                continue
+            for result in batch_results:
+                yield result
+        self.finished = time.time()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+    
+    def stats(self):
+        """Return the counters, the errors by condition and the throughput"""
+        self.lock.acquire()
+        try:
+            stats = dict(self.counters)
+            stats['errors'] = dict(self.errors)
+        finally:
+            self.lock.release()
+        elapsed = 0
+        if self.started is not None:
+            elapsed = (self.finished or time.time()) - self.started
+        stats['elapsed'] = elapsed
+        stats['accounts_per_second'] = elapsed and (stats['provisioned'] + stats['failed']) / elapsed
+        return stats
+    
+    def produce(self, credentials, batches):
+        """Split the credentials in batches, then tell every worker to stop"""
+        batch = []
+        try:
+            for account in credentials:
+                batch.append(account)
+                if len(batch) == self.batch_size:
+                    batches.put(batch)
+                    batch = []
+            if batch:
+                batches.put(batch)
+        except Exception:
+            # provision() raises it again once the workers are done
+            self.error = sys.exc_info()
+        finally:
+            for i in xrange(self.sessions):
+                batches.put(None)
+    
+    def connect(self):
+        """Return a new client, with an authenticated session if needed"""
+        if self.mode == 'register':
+            client = BOSHClient(self.bosh_service, self.jid, debug=False, pool=self.pool)
+        else:
+            client = AdminBOSHClient(self.bosh_service, self.jid, self.password, debug=False, pool=self.pool)
+        client.init_connection()
+        try:
+            if client.request_bosh_session() == 0:
+                raise ConnectionError('Session refused by %s' % self.bosh_service)
+            if self.mode != 'register' and not client.authenticate_xmpp():
+                raise ConnectionError('Authentication of %s failed' % self.jid)
+        except Exception:
+            self.discard(client)
+            raise
+        return client
+    
+    def discard(self, client):
+        """Close the connection of a client in an unknown state"""
+        try:
+            client.close_connection(reusable=False)
+        except Exception:
+            pass
+    
+    def work(self, batches, results):
+        """Provision the batches on one session"""
+        client = None
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            try:
+                if client is None:
+                    client = self.connect()
+                if self.mode == 'register':
+                    batch_results = client.register_users(batch)
+                else:
+                    batch_results = client.add_users(batch)
+            except Exception, e:
+                # The session is in an unknown state: open a new one for the
+                # next batch.
+                batch_results = [ProvisioningResult(account[0], False, str(e) or e.__class__.__name__) for account in batch]
+                if client is not None:
+                    self.discard(client)
+                client = None
+            self.count(batch_results)
+            results.put(batch_results)
+        if client is not None:
+            try:
+                client.disconnect()
+                client.close_connection()
+            except Exception:
+                pass
+        results.put(None)
+    
+    def count(self, batch_results):
+        self.lock.acquire()
+        try:
+            self.counters['batches'] += 1
+            for result in batch_results:
+                if result.success:
+                    self.counters['provisioned'] += 1
+                else:
+                    self.counters['failed'] += 1
+                    self.errors[result.error] += 1
+        finally:
+            self.lock.release()
+
+
+class AdHocCommand:
+    """Extensible way to implement ad hoc commands"""
+
+    def __init__(self, jid, **kwargs):
+        """
+        The keywords arguments specifythe parameters of the <iq> element. Use
+        set_command with kwargs to set the <command> element.
+        
+        >>> my_command = AdHocCommand('me@debian', id='get-registred-users-num-1', to='debian', type='set')
+        >>> my_command.set_command(xmlns=NS_COMMANDS, action='execute', node='http://jabber.org/protocol/admin#get-registered-users-num').string()
+        "<iq from='me@debian' to='debian' type='set' id='get-registred-users-num-1' xml:lang='en'><command action='execute' node='http://jabber.org/protocol/admin#get-registered-users-num' xmlns='http://jabber.org/protocol/commands'/></iq>"
+        """
+        self.jid = jid
+        self.iq_attrs = [('from', jid)] + kwargs.items() + [('xml:lang', 'en')]
+        self.command_attrs = []
+        self.form = None
+
+    def set_command(self, **kwargs):
+        """
+        Generate the <command> of the XML stanza.
+        """
+        self.command_attrs = kwargs.items()
+        return self
+
+    def set_form(self, form):
+        """Set the DataForm carried by the <command> (None: no form)"""
+        self.form = form
+        return self
+
+    def write(self, builder):
+        """Write this command into a StanzaBuilder"""
+        builder.start('iq', self.iq_attrs)
+        if self.form is None:
+            builder.empty('command', self.command_attrs)
+        else:
+            self.form.write(builder.start('command', self.command_attrs)).end()
+        return builder.end()
+
+    def string(self):
+        """Returns the string version of this command"""
+        return self.write(StanzaBuilder()).getvalue()
+
+    __str__ = string
+
+
+class JIDError(ValueError):
+    """Error raised when a JID is not valid (RFC 6122)"""
+    pass
+
+
+# Characters nodeprep prohibits on top of the stringprep tables
+NODEPREP_PROHIBITED = frozenset(u'"&\'/:<>@')
+# Table checks shared by nodeprep and resourceprep (RFC 3454, C.1.2 to C.9),
+# in the stringprep module
+PREP_TABLES = ('in_table_c12', 'in_table_c21', 'in_table_c22', 'in_table_c3', 'in_table_c4',
+               'in_table_c5', 'in_table_c6', 'in_table_c7', 'in_table_c8', 'in_table_c9')
+ASCII_CONTROLS = re.compile('[\x00-\x1f\x7f]')
+DOMAIN_PROHIBITED = re.compile('[\x00-\x20\x7f@/]')
+
+
+def stringprep_profile(value, casefold, prohibited=frozenset(), space=True):
+    """
+    Apply a stringprep profile (RFC 3454): mapping (B.1, and B.2 if
+    casefold), NFKC, prohibited characters and bidirectional check.
+    space tells if the ASCII space (C.1.1) is allowed.
+    """
+    # Only loaded for the JIDs that aren't plain ASCII
+    import stringprep, unicodedata
+    if isinstance(value, str):
+        try:
+            value = value.decode('utf-8')
+        except UnicodeDecodeError:
+            raise JIDError('JID parts must be UTF-8: %r' % value)
+    chars = []
+    for char in value:
+        if stringprep.in_table_b1(char):
+            continue
+        chars.append(casefold and stringprep.map_table_b2(char) or char)
+    value = unicodedata.normalize('NFKC', u''.join(chars))
+    tables = [getattr(stringprep, name) for name in PREP_TABLES]
+    for char in value:
+        if (char in prohibited or (not space and stringprep.in_table_c11(char)) or
+            [1 for table in tables if table(char)]):
+            raise JIDError('Prohibited character %r in %r' % (char, value))
+    if [1 for char in value if stringprep.in_table_d1(char)]:
+        if ([1 for char in value if stringprep.in_table_d2(char)] or
+            not stringprep.in_table_d1(value[0]) or not stringprep.in_table_d1(value[-1])):
+            raise JIDError('Invalid bidirectional text in %r' % value)
+    return value
+
+
+def nodeprep(node):
+    """
+    Nodeprep profile of the localpart of a JID (RFC 6122, appendix A).
+    
+    >>> nodeprep('Romeo')
+    'romeo'
+    >>> nodeprep(u'J\\xfcliet')
+    u'j\\xfcliet'
+    """
+    if isinstance(node, str) and not ASCII_CONTROLS.search(node):
+        try:
+            node.decode('ascii')
+        except UnicodeDecodeError:
+            pass
+        else:
+            # Fast path: ASCII only needs lowercasing and the checks
+            node = node.lower()
+            if ' ' in node or [1 for char in node if char in NODEPREP_PROHIBITED]:
+                raise JIDError('Prohibited character in %r' % node)
+            return node
+    return stringprep_profile(node, True, NODEPREP_PROHIBITED, space=False)
+
+
+def resourceprep(resource):
+    """Resourceprep profile of the resourcepart of a JID (RFC 6122, appendix B)"""
+    if isinstance(resource, str) and not ASCII_CONTROLS.search(resource):
+        try:
+            resource.decode('ascii')
+            return resource
+        except UnicodeDecodeError:
+            pass
+    return stringprep_profile(resource, False)
+
+
+def domainprep(domain):
+    """Nameprep of every label of the domainpart of a JID (RFC 6122, 2.2)"""
+    from encodings.idna import nameprep
+    if DOMAIN_PROHIBITED.search(domain):
+        raise JIDError('Invalid domain %r' % domain)
+    if isinstance(domain, str):
+        try:
+            domain.decode('ascii')
+            return domain.lower()
+        except UnicodeDecodeError:
+            domain = domain.decode('utf-8')
+    try:
+        return u'.'.join([nameprep(label) for label in domain.split(u'.')])
+    except UnicodeError, e:
+        raise JIDError('Invalid domain %r: %s' % (domain, e))
+
+
+# (jid, resource) -> JID, see parse_jid
+JID_CACHE = collections.OrderedDict()
+JID_CACHE_SIZE = 100000
+JID_CACHE_LOCK = threading.Lock()
+
+def parse_jid(jid, resource=None):
+    """
+    Return the JID of a string (and resource), shared with every client
+    parsing the same one: JIDs are immutable, their strings are built once.
+    
+    >>> parse_jid('Essai@Debian', 'web') is parse_jid('Essai@Debian', 'web')
+    True
+    >>> print parse_jid('Essai@Debian', 'web').jid_with_resource
+    essai@debian/web
+    """
+    key = (jid, resource)
+    with JID_CACHE_LOCK:
+        parsed = JID_CACHE.pop(key, None)
+        if parsed is not None:
+            JID_CACHE[key] = parsed
+            return parsed
+    parsed = JID(jid, resource)
+    with JID_CACHE_LOCK:
+        JID_CACHE[key] = parsed
+        while len(JID_CACHE) > JID_CACHE_SIZE:
+            JID_CACHE.popitem(last=False)
+    return parsed
+
+
+class JID(object):
+    """
+    Class built for ease to use JIDs. The parts are prepared as RFC 6122
+    says (nodeprep, nameprep, resourceprep); use parse_jid to share them.
+    
+    >>> my_jid = JID('me@myserver.com')
+    >>> print my_jid
+    me@myserver.com
+    >>> print my_jid.user
+    me
+    >>> print my_jid.host
+    myserver.com
+    >>> print my_jid.full_jid
+    me@myserver.com
+    """
+    
+    __slots__ = ('user', 'host', 'resource', 'full_jid', 'jid_with_resource')
+    
+    def __init__(self, jid, resource=None):
+        """
+        Initialize the JID object: cut the various par of the given string
+        The JID must match the following form: user@domain, the resource
+        may also be given after a slash.
+        """
+        if '/' in jid:
+            jid, resource = jid.split('/', 1)
+        if '@' in jid:
+            user, host = jid.split('@', 1)
+            self.user = nodeprep(user)
+        else:
+            host = jid
+            self.user = ''
+        self.host = domainprep(host)
+        if not self.host or ('@' in jid and not self.user):
+            raise JIDError('Invalid JID: %r' % jid)
+        self.resource = resource and resourceprep(resource)
+        if self.user:
+            self.full_jid = '%s@%s' % (self.user, self.host)
+        else:
+            self.full_jid = self.host
+        if self.resource:
+            self.jid_with_resource = '%s/%s' % (self.full_jid, self.resource)
+        else:
+            self.jid_with_resource = self.full_jid
+        if isinstance(self.full_jid, str):
+            self.full_jid = intern(self.full_jid)
+            self.jid_with_resource = intern(self.jid_with_resource)
         
-        self.server_auth = []
+    def __str__(self):
+        """String representation for ease of use. Returns the full jid."""
+        return self.full_jid
+
+
+class Future:
+    """
+    Result of an asynchronous operation (an HTTP request, a coroutine...).
+    Callbacks added with add_done_callback are called with the future once
+    it's done.
+    """
+    
+    def __init__(self):
+        self.done = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+    
+    def set_result(self, value):
+        """Mark the future as done with the given value"""
+        self.value = value
+        self._finish()
+    
+    def set_exception(self, error):
+        """Mark the future as failed. error is a sys.exc_info() tuple."""
+        self.error = error
+        self._finish()
+    
+    def result(self):
+        """Return the value of the future, or raise its exception"""
+        if not self.done:
+            raise RuntimeError('The future is not done yet')
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+    
+    def add_done_callback(self, callback):
+        """Call callback(future) when the future is done (now if it is)"""
+        if self.done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+    
+    def _finish(self):
+        self.done = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class Task(Future):
+    """
+    Run a coroutine (a generator) on an EventLoop. The coroutine yields
+    futures or other coroutines and gets their result back; it returns a
+    value by raising Return.
+    """
+    
+    def __init__(self, loop, coroutine):
+        Future.__init__(self)
+        self.loop = loop
+        self.coroutine = coroutine
+        self.step(None, None)
+    
+    def step(self, value, error):
+        """Resume the coroutine with a value or an exception"""
+        try:
+            if error is not None:
+                yielded = self.coroutine.throw(*error)
+            else:
+                yielded = self.coroutine.send(value)
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Return, r:
+            self.set_result(r.value)
+            return
+        except Exception:
+            self.set_exception(sys.exc_info())
+            return
+        if isinstance(yielded, types.GeneratorType):
+            yielded = Task(self.loop, yielded)
+        yielded.add_done_callback(self.wakeup)
+    
+    def wakeup(self, future):
+        """Called when the future the coroutine waits for is done"""
+        if future.error is not None:
+            self.step(None, future.error)
+        else:
+            self.step(future.value, None)
+
+
+class EventLoop:
+    """
+    Tiny event loop on top of asyncore: it runs coroutines (see Task) and
+    non-blocking HTTP connections (see AsyncHTTPConnection) sharing one
+    socket map, so thousands of BOSH sessions can live in a single thread.
+    
+    >>> def double(x):
+    ...     yield sleep_future(loop, 0)
+    ...     raise Return(x * 2)
+    >>> loop = EventLoop()
+    >>> loop.run(double(1), double(21))
+    [2, 42]
+    """
+    
+    def __init__(self, poll_timeout=1.0):
+        self.map = {}
+        self.timers = []
+        self.poll_timeout = poll_timeout
+        # (host, port) -> (family, address), see resolve
+        self.addresses = {}
+    
+    def spawn(self, coroutine):
+        """Schedule the coroutine and return its Task"""
+        return Task(self, coroutine)
+    
+    def resolve(self, host, port):
+        """
+        Return the (family, address) to connect to host:port. The name is
+        only looked up (which blocks) the first time: every connection to
+        the same server then reuses the result.
+        """
+        key = (host, port)
+        if key not in self.addresses:
+            family, socktype, proto, name, address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+            self.addresses[key] = (family, address)
+        return self.addresses[key]
+    
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) in delay seconds"""
+        heapq.heappush(self.timers, (time.time() + delay, callback, args))
+    
+    def run(self, *coroutines):
+        """
+        Run the coroutines until they are all done and return their results.
+        """
+        tasks = [self.spawn(coroutine) for coroutine in coroutines]
+        self.run_until(lambda: all([task.done for task in tasks]))
+        return [task.result() for task in tasks]
+    
+    def run_until(self, condition):
+        """Run the loop until condition() is true"""
+        while not condition():
+            if not self.map and not self.timers:
+                raise RuntimeError('Nothing left to run: coroutines are stuck')
+            self.run_once()
+    
+    def run_once(self):
+        """Wait for the sockets (poll_timeout at most) and run what is ready"""
+        timeout = self.poll_timeout
+        if self.timers:
+            timeout = max(0, min(timeout, self.timers[0][0] - time.time()))
+        if self.map:
+            # poll() rather than select(): no limit on the descriptor numbers
+            asyncore.loop(timeout=timeout, map=self.map, use_poll=True, count=1)
+        else:
+            time.sleep(timeout)
+        self.run_timers()
+    
+    def run_timers(self):
+        """Run the callbacks of the expired timers"""
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            deadline, callback, args = heapq.heappop(self.timers)
+            callback(*args)
+
+
+def gather(futures):
+    """Return a future done with the list of the results of the futures"""
+    result = Future()
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+    
+    def done(index, future):
+        if result.done:
+            return
+        if future.error is not None:
+            result.set_exception(future.error)
+            return
+        results[index] = future.value
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            result.set_result(results)
+    
+    if not futures:
+        result.set_result(results)
+    for index, future in enumerate(futures):
+        future.add_done_callback(lambda future, index=index: done(index, future))
+    return result
+
+
+def sleep_future(loop, delay):
+    """Return a future done in delay seconds"""
+    future = Future()
+    loop.call_later(delay, future.set_result, None)
+    return future
+
+
+class HTTPResponseParser:
+    """
+    Incremental HTTP/1.1 response parser: feed it the bytes read from the
+    socket and it tells when the response is complete. Handles
+    Content-Length, chunked and connection-close delimited bodies, and
+    decodes gzip or deflate content as it arrives. size counts the bytes of
+    the body as sent.
+    
+    >>> parser = HTTPResponseParser()
+    >>> parser.feed('HTTP/1.1 200 OK\\r\\nTransfer-Encoding: chunked\\r\\n\\r\\n3\\r\\n<bo')
+    False
+    >>> parser.feed('\\r\\n4\\r\\ndy/>\\r\\n0\\r\\n\\r\\n')
+    True
+    >>> parser.status, parser.body()
+    (200, '<body/>')
+    >>> parser.xml.close()
+    <Element body>
+    """
+    
+    def __init__(self):
+        # The body of a successful response is parsed as it arrives
+        self.xml = BodyParser()
+        self.buffer = ''
+        self.state = 'head'
+        self.status = None
+        self.headers = {}
+        self.remaining = 0
+        self.parts = []
+        self.decoder = None
+        self.size = 0
+        self.complete = False
+    
+    def feed(self, data):
+        """Feed bytes to the parser. Returns True once the response is complete."""
+        self.buffer += data
+        progress = True
+        while progress and not self.complete:
+            progress = getattr(self, 'parse_' + self.state.replace('-', '_'))()
+        return self.complete
+    
+    def feed_eof(self):
+        """The server closed the connection. Returns True if the response is complete."""
+        if self.state == 'eof':
+            self.handle_body(self.buffer)
+            self.buffer = ''
+            self.finish()
+        return self.complete
+    
+    def body(self):
+        """Return the whole body of the response"""
+        return ''.join(self.parts)
+    
+    def handle_body(self, data):
+        """Called with every piece of the body"""
+        if data:
+            self.size += len(data)
+            self.handle_content(self.decoder.decode(data))
+    
+    def handle_content(self, data):
+        """Called with every piece of the decoded body"""
+        if data:
+            self.parts.append(data)
+            if self.status == 200:
+                self.xml.feed(data)
+    
+    def finish(self):
+        if self.decoder is not None:
+            self.handle_content(self.decoder.flush())
+        self.complete = True
+    
+    def will_close(self):
+        """True if the server closes the connection after this response"""
+        return self.headers.get('connection', '').lower() == 'close' or self.state == 'eof'
+    
+    def parse_head(self):
+        end = self.buffer.find('\r\n\r\n')
+        if end < 0:
+            return False
+        lines = self.buffer[:end].split('\r\n')
+        self.buffer = self.buffer[end + 4:]
+        self.status = int(lines[0].split(None, 2)[1])
+        for line in lines[1:]:
+            name, value = line.split(':', 1)
+            self.headers[name.strip().lower()] = value.strip()
+        self.decoder = ContentDecoder(self.headers.get('content-encoding'))
+        if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            self.state = 'chunk-size'
+        elif 'content-length' in self.headers:
+            self.remaining = int(self.headers['content-length'])
+            self.state = 'body'
+        elif self.status in (204, 304) or 100 <= self.status < 200:
+            self.finish()
+        else:
+            self.state = 'eof'
+        return True
+    
+    def parse_body(self):
+        data = self.buffer[:self.remaining]
+        self.buffer = self.buffer[self.remaining:]
+        self.remaining -= len(data)
+        self.handle_body(data)
+        if self.remaining == 0:
+            self.finish()
+        return False
+    
+    def parse_chunk_size(self):
+        end = self.buffer.find('\r\n')
+        if end < 0:
+            return False
+        self.remaining = int(self.buffer[:end].split(';')[0], 16)
+        self.buffer = self.buffer[end + 2:]
+        if self.remaining == 0:
+            self.state = 'trailer'
+        else:
+            self.state = 'chunk'
+        return True
+    
+    def parse_chunk(self):
+        data = self.buffer[:self.remaining]
+        self.buffer = self.buffer[self.remaining:]
+        self.remaining -= len(data)
+        self.handle_body(data)
+        if self.remaining == 0 and len(self.buffer) >= 2:
+            self.buffer = self.buffer[2:]
+            self.state = 'chunk-size'
+            return True
+        return False
+    
+    def parse_trailer(self):
+        end = self.buffer.find('\r\n')
+        if end < 0:
+            return False
+        line, self.buffer = self.buffer[:end], self.buffer[end + 2:]
+        if not line:
+            self.finish()
+        return True
+    
+    def parse_eof(self):
+        self.handle_body(self.buffer)
+        self.buffer = ''
+        return False
+
+
+class AsyncHTTPConnection(asyncore.dispatcher):
+    """
+    Non-blocking keep-alive HTTP connection running on an EventLoop.
+    Requests are sent one after the other; request() returns a Future done
+    with the HTTPResponseParser of the response.
+    """
+    
+    def __init__(self, loop, netloc):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.loop = loop
+        self.netloc = netloc
+        host, port = netloc, 80
+        if ':' in netloc:
+            host, port = netloc.rsplit(':', 1)
+            port = int(port)
+        self.queue = collections.deque()
+        self.out_buffer = ''
+        self.parser = None
+        self.future = None
+        self.closed = False
+        family, address = loop.resolve(host, port)
+        self.create_socket(family, socket.SOCK_STREAM)
+        self.connect(address)
+    
+    def request(self, method, path, body, headers):
+        """Queue a request and return the Future of its response"""
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % self.netloc,
+                 'Content-Length: %d' % len(body)]
+        for name, value in headers.iteritems():
+            lines.append('%s: %s' % (name, value))
+        future = Future()
+        self.queue.append(('\r\n'.join(lines) + '\r\n\r\n' + body, future))
+        self.next_request()
+        return future
+    
+    def next_request(self):
+        """Start sending the next queued request, if the connection is free"""
+        if self.future is None and self.queue:
+            self.out_buffer, self.future = self.queue.popleft()
+            self.parser = HTTPResponseParser()
+    
+    def writable(self):
+        return bool(self.out_buffer) or not self.connected
+    
+    def readable(self):
+        return True
+    
+    def handle_connect(self):
+        pass
+    
+    def handle_write(self):
+        sent = self.send(self.out_buffer)
+        self.out_buffer = self.out_buffer[sent:]
+    
+    def handle_read(self):
+        data = self.recv(65536)
+        if self.parser is None:
+            # Nothing is expected from the server
+            return
+        if self.parser.feed(data):
+            self.finish_response()
+    
+    def handle_close(self):
+        if self.parser is not None and self.parser.feed_eof():
+            self.finish_response()
+        self.fail(ConnectionError('Connection closed by %s' % self.netloc))
+    
+    def handle_error(self):
+        self.fail(sys.exc_info()[1])
+    
+    def finish_response(self):
+        parser, future = self.parser, self.future
+        self.parser = self.future = None
+        if parser.will_close():
+            self.fail(ConnectionError('Connection closed by %s' % self.netloc))
+        else:
+            self.next_request()
+        future.set_result(parser)
+    
+    def fail(self, error):
+        """Close the connection and fail all the pending requests"""
+        self.close()
+        self.closed = True
+        pending = list(self.queue)
+        self.queue.clear()
+        if self.future is not None:
+            pending.insert(0, (None, self.future))
+        self.parser = self.future = None
+        for request, future in pending:
+            try:
+                raise error
+            except Exception:
+                future.set_exception(sys.exc_info())
+
+
+class AsyncBOSHClient(BOSHClient):
+    """
+    BOSH client running on an EventLoop. It follows the same flows as the
+    BOSHClient, but request_bosh_session, authenticate_xmpp, register and
+    disconnect return coroutines, so many sessions share a single thread:
     
-    def log(self, message):
+    >>> from boshbench import FakeBOSHServer
+    >>> server = FakeBOSHServer(users={'essai': 'essai', 'thomas': 'password'}).start()
+    >>> loop = EventLoop()
+    >>> def login(jid, password):
+    ...     client = AsyncBOSHClient(server.url, jid, password, debug=False, loop=loop)
+    ...     client.init_connection()
+    ...     yield client.request_bosh_session()
+    ...     success = yield client.authenticate_xmpp()
+    ...     client.close_connection()
+    ...     raise Return(success)
+    >>> loop.run(login('essai@localhost', 'essai'), login('thomas@localhost', 'password'), login('thomas@localhost', 'bad'))
+    [True, True, False]
+    >>> server.stop()
+    """
+    
+    def __init__(self, bosh_service, jid='', password='', resource='web', debug=True, loop=None, instrumentation=None):
+        """Initialize the client, just like the BOSHClient"""
+        BOSHClient.__init__(self, bosh_service, jid, password, resource, debug, instrumentation=instrumentation)
+        if loop is None:
+            loop = EventLoop()
+        self.loop = loop
+        self.scheduler = None
+    
+    def start_scheduler(self, on_data=None, retries=3, poll=True):
         """
-        Print a message in the standard output. Warning: this function makes the
-        client very verbose!
+        Pipeline the next requests of the session with a RequestScheduler.
+        Call it once the BOSH session is created. The received stanzas go to
+        the dispatcher, unless on_data is given.
         """
-        if self.debug:
-            print '[DEBUG] ' + message
-    
-    def get_sid(self):
-        """Return the SID assigned to this client"""
-        return self.sid
+        self.scheduler = RequestScheduler(self, on_data or self.dispatcher.dispatch_data, retries, poll)
+        return self.scheduler
     
-    def get_rid(self):
-        """Return the RID of this client"""
-        return self.rid
+    def send_iq(self, stanza, id):
+        """
+        Send an <iq/> (with the given id) through the scheduler and return
+        the Future of its reply. Many <iq/> can be outstanding at once.
+        """
+        future = self.dispatcher.expect(id)
+        self.scheduler.send(stanza)
+        return future
     
-    def set_rid(self, rid=0):
+    def send(self, stanza, id=None):
         """
-        Create a random RID and use it, except if rid is specified and different
-        from 0.
+        Send a stanza through the scheduler, coalesced with the ones sent
+        within coalesce_window seconds. Returns the Future of the reply if
+        id is given.
         """
-        if rid == 0:
-            self.rid = random.randint(0, 10000000)
-        else:
-            self.rid = rid
+        if id is not None:
+            return self.send_iq(stanza, id)
+        self.scheduler.send(stanza)
+    
+    def flush(self):
+        """Send the stanzas waiting to be coalesced now"""
+        if self.scheduler is not None:
+            self.scheduler.flush()
     
     def init_connection(self):
-        """Initialize the HTTP connection (not the XMPP session!)"""
-        self.log('Initializing connection to %s' % (self.bosh_service.netloc))
-        self.connection = httplib.HTTPConnection(self.bosh_service.netloc)
-        self.log('Connection initialized')
-        # TODO add exceptions handler there (URL not found etc)
+        """Open the non-blocking HTTP connection (not the XMPP session!)"""
+        self.log('Initializing connection to %s', self.bosh_service.netloc)
+        with self.instrumentation.phase('connect'):
+            self.connection = AsyncHTTPConnection(self.loop, self.bosh_service.netloc)
     
-    def close_connection(self):
-        """Close the HTTP connection (not the XMPP session!)"""
+    def close_connection(self, reusable=True):
+        """
+        Close the HTTP connection (not the XMPP session!). Pass
+        reusable=False when the stream is in an unknown state: a pooled
+        connection is then closed instead of being given back.
+        Closing it again does nothing.
+        """
+        if self.connection is None:
+            return
         self.log('Closing connection')
         self.connection.close()
         self.log('Connection closed')
-        # TODO add execptions handler there
-
-    def wrap_stanza_body(self, stanza, more_body=''):
-        """Wrap the XMPP stanza with the <body> element (required for BOSH)"""
-        if not stanza == '':
-            return "<body rid='%s' sid='%s' %s xmlns='http://jabber.org/protocol/httpbind'>%s</body>" % (self.rid, self.sid, more_body, stanza)
-        else:
-            return "<body rid='%s' sid='%s' %s xmlns='http://jabber.org/protocol/httpbind' />" % (self.rid, self.sid, more_body)
-
+    
     def send_request(self, xml_stanza):
         """
-        Send a request to self.bosh_service.path using POST containing
-        xml_stanza with self.headers.
-        Returns the data contained in the response (only if status == 200)
-        Returns False if status != 200
+        Send xml_stanza to the BOSH service. Returns a Future done with the
+        data of the response, or False if the status isn't 200.
         """
-        self.log('XML_STANZA:')
-        self.log(xml_stanza)
-        self.log('Sending the request')
-        try:
-            self.connection.request("POST", self.bosh_service.path, xml_stanza, self.headers)
-        except AttributeError:
+        if self.scheduler is not None:
+            self.log('XML_STANZA: %s', xml_stanza)
+            return self.scheduler.send_body(xml_stanza)
+        if self.connection is None:
             raise ConnectionError
-            return False
+        if self.connection.closed:
+            # The server closed the keep-alive connection: open a new one
+            self.init_connection()
+        body, headers = self.encode_request(xml_stanza)
+        response = self.connection.request("POST", self.bosh_service.path, body, headers)
         self.rid += 1
-        response = self.connection.getresponse()
-        data = ''
-        self.log('Response status code: %s' % response.status)
-        if response.status == 200:
-            data = response.read()
-        else:
-            self.log('Something wrong happened!')
-            return False
-            
-        self.log('DATA:')
-        self.log(data)
-        return data
-    
-    def register(self, **kwargs):
-        """
-        Create a new user account on the XMPP server, according to XEP-0077 
-        http://xmpp.org/extensions/xep-0077.html
-        """
-
-        self.log('Ask the remote server to send the fields list.')
-        xml_stanza = self.wrap_stanza_body("<iq type='get' id='reg1'><query xmlns='jabber:iq:register'/></iq>")
-        data = self.send_request(xml_stanza)
-        # The servers send the fields list and an instruction element.
-        fields = []
-        response_body = minidom.parseString(data).documentElement
-        query = response_body.getElementsByTagName('query')[0]
-        for child in query.childNodes:
-            if child.localName == 'instructions':
-                # This node is the instruction element
-                # TODO: find a smart thing to do with this information
-                pass
-            else:
-                fields.append(child.localName)
-        # It's time to build the dictonary for the response
-        response_dict = {}
-        for element in fields:
-            response_dict[element] = kwargs.get(element, '')
-        # And now, build the response XML stanza
-        xml_stanza_top = "<iq type='set' id='reg2'><query xmlns='jabber:iq:register'>"
-        xml_stanza_bottom = "</query></iq>"
-        xml_stanza = xml_stanza_top
-        for elem, value in response_dict.iteritems():
-            xml_stanza = xml_stanza + "<%s>%s</%s>" % (elem, value, elem)
-        xml_stanza = xml_stanza + xml_stanza_bottom
-        # Then send it
-        data = self.send_request(self.wrap_stanza_body(xml_stanza))
+        future = Future()
+        started = time.time()
         
-        # TODO: handle exceptions (conflict, not-acceptable etc)
-    
-    def request_bosh_session(self):
-        """
-        Request a BOSH session according to
-        http://xmpp.org/extensions/xep-0124.html#session-request
-        Returns the new SID (str).
-        This function also fill many fields of this BOSHClient object, such as:
-            * sid
-            * server_wait
-            * server_auth_methods
-        """
-        self.log('Prepare to request BOSH session')
-        
-        xml_stanza = "<body rid='%s' xmlns='http://jabber.org/protocol/httpbind' to='%s' xml:lang='en' wait='60' hold='1' window='5' content='text/xml; charset=utf-8' ver='1.6' xmpp:version='1.0' xmlns:xmpp='urn:xmpp:xbosh'/>" % (self.rid, self.jid.host)
-        data = self.send_request(xml_stanza)
-      
-        # This is XML. response_body contains the <body/> element of the
-        # response.
-        try:
-            response_body = minidom.parseString(data).documentElement
-        except TypeError:
-            raise ConnectionError
-            return 0;
-        
-        # Check if this there was a problem during the session request
-        if response_body.getAttribute('type') == 'terminate':
-            return 0;
-        
-        # Get the remote Session ID
-        self.sid = response_body.getAttribute('sid')
-        self.log('sid = %s' % self.sid)
-        
-        # Get the longest time (s) that the XMPP server will wait before
-        # responding to any request.
-        self.server_wait = response_body.getAttribute('wait')
-        self.log('wait = %s' % self.server_wait)
-        
-        # Get the authid
-        self.authid = response_body.getAttribute('authid')
-        
-        # Get the allowed authentication methods
-        stream_features = response_body.firstChild
-        auth_list = []
-        try:
-            mechanisms = stream_features.getElementsByTagNameNS('urn:ietf:params:xml:ns:xmpp-sasl', 'mechanisms')[0]
-            if mechanisms.hasChildNodes():
-                for child in mechanisms.childNodes:
-                    auth_method = child.firstChild.data
-                    auth_list.append(auth_method)
-                    self.log('New AUTH method: %s' % auth_method)
-            
-                self.server_auth = auth_list
-                
+        def done(response):
+            if response.error is not None:
+                future.set_exception(response.error)
+                return
+            parser = response.value
+            self.instrumentation.record_request(len(body), parser.size, time.time() - started)
+            self.log('Response status code: %s', parser.status)
+            if parser.status == 200:
+                data = BOSHResponse(parser.body(), parser.xml.close())
+                self.log('DATA: %s', data)
+                future.set_result(data)
             else:
-                self.log('The server didn\'t send the allowed authentication methods')
-        except AttributeError:
-            self.log('The server didn\'t send the allowed authentication methods')
-            
-            # FIXME: BIG PROBLEM THERE! AUTH METHOD MUSTN'T BE GUEST!
-            auth_list = ['DIGEST-MD5']
-            self.server_auth = auth_list
-        
-        #return self.sid
+                self.log('Something wrong happened!')
+                future.set_result(False)
         
-    def xmpp_disco(self):
-        """
-        Retrieve informations about the server services using the Jabber 
-        informations discovering.
-        http://xmpp.org/extensions/xep-0030.html
-        """
-        self.log('Using DISCO')
-        xml_stanza = self.wrap_stanza_body("<iq type='get' from='%s' to='%s' id='info1'><query xmlns='http://jabber.org/protocol/disco#info'/></iq>" % (self.jid.jid_with_resource, self.jid.host))
-        data = self.send_request(xml_stanza)
-
-    def xmpp_disco_node(self, node_name):
-        """
-        Discover the given node.
-        http://xmpp.org/extensions/xep-0030.html#items
-        """
-        self.log('DISCO the node %s' % node_name)
-        xml_stanza = self.wrap_stanza_body("<iq type='get' from='%s' to='%s' id='info2'><query xmlns='http://jabber.org/protocol/disco#info' node='http://jabber.org/protocol/%s'/></iq>" % (self.jid.jid_with_resource, self.jid.host, node_name))
-        data = self.send_request(xml_stanza)
+        response.add_done_callback(done)
+        return future
     
-    def authenticate_xmpp(self):
+    def run_flow(self, flow):
         """
-        Authenticate the user to the XMPP server via the BOSH connection.
-        You MUST have the following settings set:
-            * self.sid
-            * self.jid
-            * self.password
-            * self.rid
-            * self.server_auth
-        Note also that the connection MUST be opened (see self.init_connection).
-        Returns True if the authenication went fine, otherwise, returns False.
+        Coroutine driving a flow over the non-blocking connection. The
+        batches of bodies are pipelined when a scheduler is started.
         """
-        
-        self.log('Prepare the XMPP authentication')
-            
-        if 'DIGEST-MD5' in self.server_auth:
-            self.log('Authenticate with DIGEST-MD5')
-            
-            # Ask for the MD5 challenge
-            xml_stanza = "<body rid='%s' xmlns='http://jabber.org/protocol/httpbind' sid='%s'><auth xmlns='urn:ietf:params:xml:ns:xmpp-sasl' mechanism='DIGEST-MD5'/></body>" % (self.rid, self.sid)
-            data = self.send_request(unicode(xml_stanza))
-        
-            # Decode the challenges
-            continue_challenges = True
-            while continue_challenges:
-                hash = minidom.parseString(data).documentElement.getElementsByTagName('challenge')[0].firstChild.data
-                decoded = b64decode(hash)
-                self.log('Decoded challenge: %s' % decoded)
-                
-                # Prepare the response
-                digest_object = DigestMD5('xmpp', self.jid.host, None, self.jid.user, self.password)
-                response = b64encode(digest_object.getResponse(decoded))
-                self.log('Reponse to challenge: %s' % response)
-                xml_stanza = self.wrap_stanza_body("<response xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>%s</response>" % response)
-                data = self.send_request(xml_stanza)
-                if not minidom.parseString(data).documentElement.getElementsByTagName('challenge'):
-                    # It's not a challenge
-                    continue_challenges = False
-            
-            # Check if we succeed the handshake
-            is_success = minidom.parseString(data).documentElement.getElementsByTagName('success')
-            if is_success:
-                # Oh yeah it rocks!
-                self.log('Authentication succeeded!')
+        data = None
+        while True:
+            try:
+                xml_stanza = flow.send(data)
+            except StopIteration:
+                raise Return(None)
+            if isinstance(xml_stanza, types.GeneratorType):
+                data = yield self.run_flow(xml_stanza)
+            elif isinstance(xml_stanza, list):
+                data = yield gather([self.send_request(body) for body in xml_stanza])
             else:
-                # Shit. So bad :( so just read the code, fix the problem and
-                # commit !
-                self.log('Authentication failed!')
-                return  False
-            
-            # Ask the server to restart the stream
-            self.log('Asking the server to restart the stream')
-            xml_stanza = self.wrap_stanza_body('', "to='%s' xml:lang='en' xmpp:restart='true' xmlns:xmpp='urn:xmpp:xbosh'" % self.jid.host)
-            data = self.send_request(xml_stanza)
-            self.log('The stream just restarted')
-            
-            # Bind the resource
-            self.log('Binding the resource')
-            xml_stanza = self.wrap_stanza_body("<iq id='bind_1' type='set' xmlns='jabber:client'><bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'><resource>%s</resource></bind></iq>" % self.resource)
-            data = self.send_request(xml_stanza)
-            self.log('The resource got bound to: %s' % self.resource)
-
-            # Establish the IM session
-            self.log('Establishing the IM session')
-            xml_stanza = self.wrap_stanza_body("<iq type='set' id='bind_2'><session xmlns='urn:ietf:params:xml:ns:xmpp-session'/></iq>")
-            data = self.send_request(xml_stanza)
-            self.log('IM session established')            
+                data = yield self.send_request(xml_stanza)
 
-            return True
-            
-        elif 'PLAIN' in self.server_auth:
-            
-            #
-            # PLAIN authentication isn't finished (== it doesn't work)
-            #
-            
-            self.log('Authenticate with PLAIN text')
-            
-            # Request authentication fields
-            xml_stanza = self.wrap_stanza_body("<iq type='get' to='%s' id='auth1'><query xmlns='jabber:iq:auth'/></iq>" % self.jid.host)
-            data = self.send_request(xml_stanza)
-     
-    def disconnect(self):
-        """Gracefully terminate the session"""
-        self.log("Terminating the XMPP session")
-        xml_stanza = self.wrap_stanza_body("<presence type='unavailable' xmlns='jabber:client'/>", "type='terminate'")
-        self.send_request(xml_stanza)
-        self.log("Session terminated")
-        
-        
-class AdminBOSHClient(BOSHClient):
+
+
+class RequestScheduler:
     """
-    This is an extended version of the BOSHClient with all the administration
-    functions, such as ad-hoc commands
-    (http://xmpp.org/extensions/xep-0050.html) for administration uses:
-    http://xmpp.org/extensions/xep-0133.html.
-    Be careful: if you use AdminBOSHClient and the user that you log in isn't
-    and administrator, all your commands will return the tuple:
-    (-1,'Your are not an administrator)
-    Have fun.
+    Pipelines the requests of an AsyncBOSHClient session, as allowed by
+    http://xmpp.org/extensions/xep-0124.html#overactive:
+        * up to server_requests requests are in flight at the same time, each
+          one on its own HTTP connection;
+        * no request goes further than window RIDs past the oldest
+          unanswered one;
+        * when there is nothing to send, up to server_hold empty requests
+          are parked on the connection manager, so it can push data at any
+          time.
+    The responses are delivered in RID order, whatever order they come back
+    in. The stanzas waiting for a free slot (or for the coalesce_window of
+    the client) are coalesced in one request. A request that failed at the HTTP level is sent again with the same
+    RID (and the same content), which fills the RID gap on the server side.
+    Once it failed retries times, the session is lost: every pending and
+    queued future fails, so does every later send.
     
+    Once the session is created, use it with client.start_scheduler().
     
-    >>> client = AdminBOSHClient('http://debian/http-bind/', jid='thomas@debian', password='password', resource='boshclient', debug=False)
-    >>> client.init_connection()
-    >>> client.request_bosh_session()
-    >>> sid = client.authenticate_xmpp()
-    >>> client.get_registred_users()
-    10
-    >>> client.close_connection()
+    >>> from boshbench import FakeBOSHServer
+    >>> server = FakeBOSHServer(users={'essai': 'essai'}).start()
+    >>> loop = EventLoop()
+    >>> def ping_once_dropped():
+    ...     client = AsyncBOSHClient(server.url, 'essai@localhost', 'essai', debug=False, loop=loop)
+    ...     client.init_connection()
+    ...     yield client.request_bosh_session()
+    ...     yield client.authenticate_xmpp()
+    ...     scheduler = client.start_scheduler(retries=1, poll=False)
+    ...     server.drop = 1
+    ...     data = yield scheduler.send(PING.render(to='localhost', id='ping-1'))
+    ...     raise Return(data.body.find('iq').get('type'))
+    >>> loop.run(ping_once_dropped())
+    [u'result']
+    >>> client = AsyncBOSHClient(server.url, 'essai@localhost', 'essai', debug=False, loop=loop)
+    >>> def lose_session():
+    ...     client.init_connection()
+    ...     yield client.request_bosh_session()
+    ...     yield client.authenticate_xmpp()
+    ...     scheduler = client.start_scheduler(retries=1, poll=False)
+    ...     server.stop()
+    ...     futures = [scheduler.send('<presence/>') for i in xrange(3)]
+    ...     try:
+    ...         yield futures[-1]
+    ...     except socket.error:
+    ...         pass
+    ...     raise Return(([future.done and future.error is not None for future in futures], client.terminated))
+    >>> loop.run(lose_session())
+    [([True, True, True], True)]
     """
     
-    def __init__(self, bosh_service, jid='', password='', resource='boshclient', debug=True):
-        """Initialize the client, just like the BOSHClient"""
-        BOSHClient.__init__(self, bosh_service, jid, password, resource, debug)
-        
-        self.ad_hoc_commands = {
-            'get-registred-users-num': 0,
-            'add-user': 0,
-        }
-    
-    def get_id(self, name):
+    def __init__(self, client, on_data=None, retries=3, poll=True):
         """
-        Increases the command counter and returns the id field.
+        client: the AsyncBOSHClient, with a BOSH session.
+        on_data: called with the data of every response, in RID order.
+        retries: how many times a request is sent again before giving up.
+        poll: keep long-polls parked on the connection manager.
         """
-        self.ad_hoc_commands[name] += 1
-        string = "%s-%s" % (name, self.ad_hoc_commands[name])
-        return string
+        self.client = client
+        self.on_data = on_data
+        self.retries = retries
+        self.poll = poll
+        # (stanza, more_body, wrapped, future) waiting for a free slot
+        self.outgoing = collections.deque()
+        # rid -> [body, future, attempts, is_poll]
+        self.pending = {}
+        # rid -> data, received before the responses to the lower RIDs
+        self.received = {}
+        self.next_rid = client.rid
+        self.connections = []
+        self.stopped = False
+        self.parking = False
+        self.coalescing = False
+        # Why the session was given up (exc_info), see fail
+        self.error = None
     
-    def add_user(self, username, password):
+    def send(self, stanza, more_body=''):
+        """Queue a stanza. Returns a Future done with the response data."""
+        return self.queue(stanza, more_body, False)
+    
+    def send_body(self, body):
         """
-        Create a new user account on the XMPP server.
-        http://xmpp.org/extensions/xep-0133.html#add-user
+        Queue an already wrapped <body>. Its RID must be the one of the
+        client when the body was built, as for client.send_request.
         """
-        
-        self.log('ADD-USER ask the server for the form.')
-        id = self.get_id('add-user')
-        xml_stanza = self.wrap_stanza_body("<iq from='%s' id='%s' to='%s' type='set' xml:lang='en'><command xmlns='http://jabber.org/protocol/commands' action='execute' node='http://jabber.org/protocol/admin#add-user'/></iq>" % (self.jid.jid_with_resource, id, self.jid.host))
-        data = self.send_request(xml_stanza)
+        return self.queue(body, '', True)
     
-    def get_registred_users(self):
+    def queue(self, stanza, more_body, wrapped):
+        future = Future()
+        if self.error is not None:
+            future.set_exception(self.error)
+            return future
+        self.outgoing.append((stanza, more_body, wrapped, future))
+        if wrapped or more_body or not self.client.coalesce_window:
+            self.pump()
+        elif not self.coalescing:
+            self.coalescing = True
+            self.client.loop.call_later(self.client.coalesce_window, self.flush)
+        return future
+    
+    def flush(self):
+        """End the coalesce window: send what the limits allow"""
+        self.coalescing = False
+        self.pump()
+    
+    def stop(self):
+        """Stop parking new long-polls and close the idle connections"""
+        self.stopped = True
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+    
+    def polls(self):
+        """Number of empty requests parked on the connection manager"""
+        return len([1 for request in self.pending.itervalues() if request[3]])
+    
+    def can_send(self):
+        """True if one more request fits in the requests and window limits"""
+        return (len(self.pending) < self.client.server_requests and
+                self.client.rid < self.next_rid + self.client.window)
+    
+    def pump(self):
+        """Send as many requests as the limits allow"""
+        while self.outgoing and self.can_send():
+            stanza, more_body, wrapped, future = self.outgoing.popleft()
+            if wrapped:
+                body = stanza
+            else:
+                stanzas, futures = [stanza], [future]
+                while (not more_body and self.outgoing and len(stanzas) < self.client.coalesce_max and
+                       not self.outgoing[0][2] and not self.outgoing[0][1]):
+                    stanzas.append(self.outgoing[0][0])
+                    futures.append(self.outgoing.popleft()[3])
+                if len(futures) > 1:
+                    future = Future()
+                    future.add_done_callback(lambda done, futures=futures: self.fan_out(done, futures))
+                body = self.client.wrap_stanza_body(''.join(stanzas), more_body)
+            self.dispatch(self.client.rid, body, future, False)
+        # The long-polls are parked from the event loop, so that the bodies
+        # queued in a row (built with consecutive RIDs) are not split by one.
+        if self.poll and not self.parking and not self.stopped:
+            self.parking = True
+            self.client.loop.call_later(0, self.park)
+    
+    def fan_out(self, done, futures):
+        """Give the result of a coalesced request to the futures of its stanzas"""
+        for future in futures:
+            if done.error is not None:
+                future.set_exception(done.error)
+            else:
+                future.set_result(done.value)
+    
+    def park(self):
+        """Park empty requests, keeping one slot free for the outgoing stanzas"""
+        self.parking = False
+        while (not self.outgoing and not self.stopped and self.can_send() and
+               self.polls() < min(self.client.server_hold, self.client.server_requests - 1)):
+            body = self.client.wrap_stanza_body('')
+            self.dispatch(self.client.rid, body, Future(), True)
+    
+    def dispatch(self, rid, body, future, is_poll):
+        self.client.rid = rid + 1
+        self.pending[rid] = [body, future, 0, is_poll]
+        self.transmit(rid)
+    
+    def transmit(self, rid):
+        """Send (or send again) the request with the given RID"""
+        body = self.pending[rid][0]
+        self.client.log('Sending RID %s (%s in flight)', rid, len(self.pending))
+        connection = None
+        while self.connections and connection is None:
+            connection = self.connections.pop()
+            if connection.closed:
+                connection = None
+        if connection is None:
+            connection = AsyncHTTPConnection(self.client.loop, self.client.bosh_service.netloc)
+        body, headers = self.client.encode_request(body)
+        response = connection.request("POST", self.client.bosh_service.path, body, headers)
+        started = time.time()
+        response.add_done_callback(lambda response: self.handle_response(rid, connection, response, started, len(body)))
+    
+    def handle_response(self, rid, connection, response, started, sent):
+        """sent is the size of the request on the wire (compressed or not)"""
+        request = self.pending.get(rid)
+        if request is None:
+            # The session was given up meanwhile
+            return
+        if response.error is not None:
+            request[2] += 1
+            if request[2] <= self.retries and not self.stopped:
+                self.client.log('RID %s failed, sending it again', rid)
+                self.transmit(rid)
+            else:
+                self.fail(response.error)
+            return
+        if not connection.closed:
+            self.connections.append(connection)
+        parser = response.value
+        self.client.instrumentation.record_request(sent, parser.size, time.time() - started)
+        if parser.status == 200:
+            data = BOSHResponse(parser.body(), parser.xml.close())
+            if data.body.get('type') == 'terminate':
+                self.stopped = True
+        else:
+            self.client.log('RID %s: status code %s', rid, parser.status)
+            data = False
+            self.stopped = True
+        self.received[rid] = data
+        self.deliver()
+        self.pump()
+    
+    def fail(self, error):
         """
-        Retrieve the number of registred users.
-        http://xmpp.org/extensions/xep-0133.html#get-registered-users-num
+        Give the session up: the RIDs must be used in order, so nothing
+        after a lost request can be delivered. Every pending and queued
+        future fails with error (an exc_info tuple).
         """
-        self.log('Retrieving the registred users number')
-        id = self.get_id('get-registred-users-num')
-        command = AdHocCommand(self.jid.jid_with_resource, id=id, to=self.jid.host, type='set')
-        command.set_command(xmlns=NS_COMMANDS, action='execute', node='http://jabber.org/protocol/admin#get-registered-users-num')
-        self.log('XML: %s' % command.string())
-        xml_stanza = self.wrap_stanza_body(command.string())
-        data = self.send_request(xml_stanza)
+        self.client.log('Giving the session up: %s', error[1])
+        self.error = error
+        self.client.terminated = True
+        self.stop()
+        futures = [request[1] for rid, request in sorted(self.pending.items())]
+        futures.extend([item[3] for item in self.outgoing])
+        self.pending.clear()
+        self.received.clear()
+        self.outgoing.clear()
+        for future in futures:
+            future.set_exception(error)
+    
+    def deliver(self):
+        """Hand the responses over in RID order"""
+        while self.next_rid in self.received:
+            rid = self.next_rid
+            data = self.received.pop(rid)
+            future = self.pending.pop(rid)[1]
+            self.next_rid += 1
+            if data and self.on_data is not None:
+                self.on_data(data)
+            future.set_result(data)
 
 
-class AdHocCommand:
-    """Extensible way to implement ad hoc commands"""
+def auth_worker(bosh_service, requests, results, concurrency=50, stats_interval=5):
+    """
+    Body of an AuthService worker process: checks the (id, jid, password)
+    requests of the requests queue with AsyncBOSHClient sessions (up to
+    concurrency at once on one EventLoop) and puts ('result', id, success)
+    on the results queue. success is None when the check itself failed.
+    Its stats are sent every stats_interval seconds, as ('stats', pid, dict).
+    A None request stops the worker.
+    """
+    loop = EventLoop(poll_timeout=0.05)
+    pid = os.getpid()
+    started = time.time()
+    counters = {'checks': 0, 'accepted': 0, 'rejected': 0, 'errors': 0}
+    tasks = []
+    
+    def check(id, jid, password):
+        client = AsyncBOSHClient(bosh_service, jid, password, debug=False, loop=loop)
+        success = None
+        try:
+            client.init_connection()
+            yield client.request_bosh_session()
+            success = bool((yield client.authenticate_xmpp()))
+            if success:
+                yield client.disconnect()
+        except Exception, e:
+            logger.warning('Worker %s: checking %s failed: %s', pid, jid, e)
+        if client.connection is not None:
+            client.close_connection()
+        counters['checks'] += 1
+        counters[{True: 'accepted', False: 'rejected', None: 'errors'}[success]] += 1
+        results.put(('result', id, success))
+    
+    def report():
+        elapsed = time.time() - started
+        stats = dict(counters, uptime=elapsed, active=len(tasks),
+                     checks_per_sec=counters['checks'] / max(elapsed, 1e-6))
+        results.put(('stats', pid, stats))
+    
+    last_report = time.time()
+    stopping = False
+    while not stopping or tasks:
+        # Take new checks while there is room, wait for one when idle
+        while not stopping and len(tasks) < concurrency:
+            try:
+                request = requests.get(not tasks, 0.5)
+            except Queue.Empty:
+                break
+            if request is None:
+                stopping = True
+            else:
+                tasks.append(loop.spawn(check(*request)))
+        if tasks:
+            loop.run_once()
+            tasks = [task for task in tasks if not task.done]
+        if time.time() - last_report >= stats_interval:
+            report()
+            last_report = time.time()
+    report()
 
-    def __init__(self, jid, **kwargs):
-        """
-        The keywords arguments specifythe parameters of the <iq> element. Use
-        set_command with kwargs to set the <command> element.
-        
-        >>> my_command = AdHocCommand('me@debian', id='get-registred-users-num-1', to='debian', type='set')
-        >>> my_command.set_command(xmlns=NS_COMMANDS, action='execute', node='http://jabber.org/protocol/admin#get-registered-users-num').string()
-        "<iq from='me@debian' to='debian' type='set' id='get-registred-users-num-1'  xml:lang='en'><command action='execute' node='http://jabber.org/protocol/admin#get-registered-users-num' xmlns='http://jabber.org/protocol/commands' /></iq>"
-        """
-        self.jid = jid
-        self.iq_stanza = "<iq from='%s'" % self.jid
-        self.iq_stanza_middle = "xml:lang='en'>"
-        self.iq_end_stanza = "</iq>"
-        for k, v in kwargs.iteritems():
-            self.iq_stanza = "%s %s='%s'" % (self.iq_stanza, k, v)
-        self.iq_stanza = "%s %s" % (self.iq_stanza, self.iq_stanza_middle) 
 
-    def set_command(self, **kwargs):
+class AuthService:
+    """
+    Credential checks spread over worker processes (see auth_worker), so
+    the SASL hashing and the XML parsing use every core. check() is
+    thread-safe and blocks until the answer comes back; serve() answers
+    checks on a Unix socket.
+    
+    >>> from boshbench import FakeBOSHServer
+    >>> server = FakeBOSHServer(users={'essai': 'essai'}).start()
+    >>> service = AuthService(server.url, workers=2).start()
+    >>> service.check('essai@localhost', 'essai'), service.check('essai@localhost', 'wrong')
+    (True, False)
+    
+    A check that timed out is forgotten:
+    
+    >>> service.check('essai@localhost', 'essai', timeout=0.001), len(service.pending)
+    (None, 0)
+    >>> service.stop()
+    >>> server.stop()
+    """
+    
+    def __init__(self, bosh_service, workers=None, concurrency=50, stats_interval=5):
         """
-        Generate the <command> of the XML stanza.
+        workers: number of processes (the number of CPUs by default).
+        concurrency: sessions checked at the same time by a worker.
         """
-        self.command_stanza = "<command"
-        self.command_end_stanza = "/>"
-        for k,v in kwargs.iteritems():
-            self.command_stanza = "%s %s='%s'" % (self.command_stanza, k, v)
-        self.command_stanza = "%s %s" % (self.command_stanza, self.command_end_stanza)
+        import multiprocessing
+        self.bosh_service = bosh_service
+        self.workers = workers or multiprocessing.cpu_count()
+        self.concurrency = concurrency
+        self.stats_interval = stats_interval
+        self.requests = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.processes = []
+        self.lock = threading.Lock()
+        # id -> [threading.Event, success, id]
+        self.pending = {}
+        self.next_id = 0
+        # pid -> last stats sent by the worker
+        self.worker_stats = {}
+        self.collector = None
+    
+    def start(self):
+        """Start the workers. Returns the service."""
+        import multiprocessing
+        for i in xrange(self.workers):
+            process = multiprocessing.Process(target=auth_worker, args=(
+                self.bosh_service, self.requests, self.results, self.concurrency, self.stats_interval))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        self.collector = threading.Thread(target=self.collect)
+        self.collector.daemon = True
+        self.collector.start()
         return self
-
-    def string(self):
-        """Returns the string version of this command"""
-        return "%s%s%s" % (self.iq_stanza, self.command_stanza, self.iq_end_stanza)
-
-
-class JID:
-    """
-    Class built for ease to use JIDs
     
-    >>> my_jid = JID('me@myserver.com')
-    >>> print my_jid
-    me@myserver.com
-    >>> print my_jid.user
-    me
-    >>> print my_jid.host
-    myserver.com
-    >>> print my_jid.full_jid
-    me@myserver.com
-    """
+    def collect(self):
+        """Hand the results of the workers over to the waiting checks"""
+        while True:
+            message = self.results.get()
+            if message is None:
+                break
+            kind, key, value = message
+            self.lock.acquire()
+            try:
+                if kind == 'stats':
+                    self.worker_stats[key] = value
+                    continue
+                waiting = self.pending.pop(key, None)
+            finally:
+                self.lock.release()
+            if waiting is not None:
+                waiting[1] = value
+                waiting[0].set()
+    
+    def submit(self, jid, password):
+        """Queue a check and return its [event, success, id] (see check)"""
+        self.lock.acquire()
+        try:
+            self.next_id += 1
+            waiting = self.pending[self.next_id] = [threading.Event(), None, self.next_id]
+        finally:
+            self.lock.release()
+        self.requests.put((waiting[2], jid, password))
+        return waiting
+    
+    def wait(self, waiting, timeout=None):
+        """Wait for a submitted check, forget it if it timed out"""
+        if not waiting[0].wait(timeout):
+            self.lock.acquire()
+            try:
+                self.pending.pop(waiting[2], None)
+            finally:
+                self.lock.release()
+        return waiting[1]
     
-    def __init__(self, jid, resource):
+    def check(self, jid, password, timeout=None):
         """
-        Initialize the JID object: cut the various par of the given string
-        The JID must match the following form: user@domain
-        So, DON'T provide the RESOURCE!
+        True if the credentials are valid, False if they are not, None if
+        the check failed (or timed out).
         """
+        return self.wait(self.submit(jid, password), timeout)
+    
+    def check_many(self, credentials, timeout=None):
+        """Check many (jid, password) pairs at once, returns the results in order"""
+        waiting = [self.submit(jid, password) for jid, password in credentials]
+        return [self.wait(check, timeout) for check in waiting]
+    
+    def stats(self):
+        """Last stats of every worker (by pid), and their total"""
+        self.lock.acquire()
+        try:
+            stats = dict(self.worker_stats)
+        finally:
+            self.lock.release()
+        total = collections.defaultdict(float)
+        for worker in stats.values():
+            for name in ('checks', 'accepted', 'rejected', 'errors', 'active', 'checks_per_sec'):
+                total[name] += worker[name]
+        stats['total'] = dict(total)
+        return stats
+    
+    def serve(self, path):
+        """
+        Answer checks on the Unix socket path, one command per line:
+            CHECK <jid> <password>   ->  OK, FAIL or ERROR
+            STATS                    ->  the stats, as JSON
+        Anyone who can connect can test passwords: the socket is only
+        accessible to the user running the service (mode 0600).
+        Blocks until the server is shut down.
+        """
+        import SocketServer
+        service = self
         
-        val = jid.split('@')
-        self.user = val[0]
-        self.host = val[1]
-        self.resource = resource
-        self.full_jid = jid
-        self.jid_with_resource = '%s/%s' % (self.full_jid, self.resource)
-        
-    def __str__(self):
-        """String representation for ease of use. Returns the full jid."""
-        return self.full_jid
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    command = line.rstrip('\r\n').split(' ', 2)
+                    if command[0] == 'CHECK' and len(command) == 3:
+                        answer = {True: 'OK', False: 'FAIL', None: 'ERROR'}[service.check(command[1], command[2])]
+                    elif command[0] == 'STATS':
+                        answer = json.dumps(service.stats())
+                    else:
+                        answer = 'ERROR unknown command'
+                    self.wfile.write(answer + '\n')
         
+        class Server(SocketServer.ThreadingUnixStreamServer):
+            daemon_threads = True
         
+        if not isinstance(path, basestring):
+            raise ValueError('AuthService only serves on a Unix socket, not on %r' % (path,))
+        if os.path.exists(path):
+            os.unlink(path)
+        umask = os.umask(0177)
+        try:
+            self.server = Server(path, Handler)
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0600)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+    
+    def stop(self):
+        """Stop the workers (once they are done with their checks)"""
+        for process in self.processes:
+            self.requests.put(None)
+        for process in self.processes:
+            process.join()
+        self.results.put(None)
+        self.collector.join()
+        self.processes = []
+
+
 if __name__ == '__main__':
     action = sys.argv[1]    
+    logging.basicConfig(level=logging.DEBUG, format='[%(levelname)s] %(message)s')
     if action == 'test':
         import doctest
         doctest.testmod()
+    elif action == 'bench-stanza':
+        for name, rate in sorted(benchmark_stanzas().items()):
+            print '%s: %d stanzas/s' % (name, rate)
+    elif action == 'auth-service':
+        # auth-service <socket path> <BOSH service> [workers]
+        ADDRESS = sys.argv[2]
+        SERVICE = sys.argv[3]
+        WORKERS = len(sys.argv) > 4 and int(sys.argv[4]) or None
+        service = AuthService(SERVICE, workers=WORKERS).start()
+        try:
+            service.serve(ADDRESS)
+        finally:
+            service.stop()
     else:
         USERNAME = sys.argv[2]
         PASSWORD = sys.argv[3]
@@ -521,4 +5307,4 @@ if __name__ == '__main__':
             client.add_user('testme','imfamous')
             client.close_connection()            
         else:
-            print 'Unknown action "%s". Please use "auth" or "register".' % action
\ No newline at end of file
+            print 'Unknown action "%s". Please use "auth", "register", "admin", "auth-service", "bench-stanza" or "test".' % action
\ No newline at end of file